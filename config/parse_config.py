@@ -5,12 +5,18 @@
 
 # pylint: disable=too-few-public-methods, locally-disabled, no-self-use,star-args, too-many-arguments, too-many-instance-attributes, super-init-not-called, abstract-method
 
+import cPickle
+import itertools
 import json
+import multiprocessing
 import os
 import re
 import struct
 import sys
+import traceback
+import urllib
 from copy import deepcopy
+from StringIO import StringIO
 
 
 class ConfigValidationException(Exception):
@@ -45,8 +51,15 @@ def assert_parse(value, msg):
         raise ConfigValidationException(msg)
 
 
+# C representations of strings, shared by all configs compiled by a process
+C_STR_REPRS = {}
+
+
 def c_str_repr(str_):
     """Returns representation of string in C (without quotes)"""
+    if str_ in C_STR_REPRS:
+        return C_STR_REPRS[str_]
+
     def byte_to_repr(char_):
         """Converts byte to C code string representation"""
         char_val = ord(char_)
@@ -58,7 +71,12 @@ def c_str_repr(str_):
         else:
             return '\\x%02x' % char_val
 
-    return '"%s"' % ''.join((byte_to_repr(x) for x in str_))
+    C_STR_REPRS[str_] = '"%s"' % ''.join((byte_to_repr(x) for x in str_))
+    return C_STR_REPRS[str_]
+
+
+# Must match CSRF_TOKEN_NAME in src/session.h
+CSRF_TOKEN_NAME = '_umbra_csrf_token'
 
 
 def dict_updated(dict_, entry):
@@ -172,6 +190,27 @@ class StructArrInst(VarInst):
         return '\n'.join(lines)
 
 
+class StructArrPool(StructArrInst):
+    """
+    Represents a cache line aligned C array of structs holding the elements of
+    several StructArrInsts back to back, in the order they were added
+    """
+    def __init__(self, name, struct_name):
+        VarInst.__init__(self, '', name, [])
+        self.struct_name = struct_name
+
+    def add(self, arr):
+        """Appends elements of arr, returning C pointer to the first one"""
+        ref = '&%s[%d]' % (self.name, len(self.value))
+        self.value = self.value + arr.value
+        return ref
+
+    def to_string_declaration(self):
+        """Returns C declaration source"""
+        return 'struct %s %s[%d] __attribute__((aligned(64)));\n' % (
+            self.struct_name, self.name, len(self.value))
+
+
 class StructInst(VarInst):
     """Represents instance of a C struct"""
 
@@ -225,10 +264,22 @@ INIT_FUNC_FORMAT = """void init_config_vars() {
 
 BODY_TOP = """/* Autogenerated C file, do not modify */
 
+#include <strings.h>
 #include "%s"
 #include "http_util.h"
 \n\n"""
 
+PAGE_ARG_CHECK_TYPEDEF = """/* Compiled page argument check function */
+struct event_data;
+typedef void (*page_arg_check_t)(struct event_data *ev_data, char *name,
+        size_t name_len, char *value, size_t value_len);
+"""
+
+COMPILED_CHECKS_INCLUDES = """#include "shim.h"
+#include "log.h"
+#include "whitelist_scan.h"
+\n"""
+
 class CodeHeader(object):
     """Holds information of code being generated"""
     def __init__(self):
@@ -239,6 +290,11 @@ class CodeHeader(object):
         self.var_defs = []
         self.params_arrays = []
         self.page_conf_arrays = []
+        self.page_check_compiler = None
+        self.header_classifier = None
+        self.profile = None
+        self.whitelist_pool = None
+        self.params_pool = None
 
     def write_config_header(self, header_file):
         """Write C header file"""
@@ -253,6 +309,12 @@ class CodeHeader(object):
             header_file.write(struct_def.get_prototype() + '\n')
         header_file.write('\n')
 
+        header_file.write('#include <stddef.h>\n\n')
+        if self.page_check_compiler is not None:
+            header_file.write(PAGE_ARG_CHECK_TYPEDEF + '\n')
+        if self.header_classifier is not None:
+            header_file.write(self.header_classifier.to_header_string() + '\n')
+
         header_file.write('/* Struct definitions */\n\n')
         for struct_def in self.struct_defs:
             header_file.write(struct_def.to_string() + '\n')
@@ -280,6 +342,8 @@ class CodeHeader(object):
     def write_config_body(self, output_header, body_file):
         """Write C source file"""
         body_file.write(BODY_TOP % output_header)
+        if self.page_check_compiler is not None:
+            body_file.write(COMPILED_CHECKS_INCLUDES)
 
         body_file.write('/* Variable definitions */\n\n')
         for var_def in self.var_defs:
@@ -287,6 +351,9 @@ class CodeHeader(object):
 
         body_file.write('/* Struct instances */\n\n')
 
+        if self.whitelist_pool is not None:
+            body_file.write(self.whitelist_pool.to_string() + '\n')
+
         body_file.write('/* Params instances */\n\n')
         for param_struct in self.params_structs:
             body_file.write(param_struct.to_string() + '\n')
@@ -295,6 +362,14 @@ class CodeHeader(object):
         for param_arr in self.params_arrays:
             body_file.write(param_arr.to_string_declaration() + '\n')
 
+        if self.page_check_compiler is not None:
+            body_file.write('/* Compiled page checks */\n\n')
+            for func in self.page_check_compiler.funcs:
+                body_file.write(func + '\n')
+
+        if self.header_classifier is not None:
+            body_file.write(self.header_classifier.to_body_string() + '\n')
+
         body_file.write('/* Page_conf instances */\n\n')
         for page_conf in self.page_conf_structs:
             body_file.write(page_conf.to_string() + '\n')
@@ -350,6 +425,50 @@ class CodeHeader(object):
         """Add a variable definition"""
         self.var_defs.append(var)
 
+    def set_header_classifier(self, classifier):
+        """Generate header name classifier with classifier"""
+        self.header_classifier = classifier
+
+    def enable_page_check_compiler(self, compiler):
+        """Generate specialized argument check functions with compiler"""
+        self.page_check_compiler = compiler
+        compiler.profile = self.profile
+
+    def set_profile(self, profile):
+        """
+        Lay out pages, params and whitelists hottest first according to
+        AccessProfile profile, pooling params arrays and whitelist tables
+        """
+        self.profile = profile
+        self.whitelist_pool = WhitelistTablePool()
+        self.params_pool = StructArrPool('params_pool', 'params')
+        self.add_params_array(self.params_pool)
+        if self.page_check_compiler is not None:
+            self.page_check_compiler.profile = profile
+
+    def pool_whitelist(self, options, weight):
+        """
+        Places whitelist of MultiOption options in the whitelist pool with
+        weight hits. Does nothing without a profile.
+        """
+        if self.whitelist_pool is None:
+            return
+        whitelist = options.get_name2conf()['whitelist']
+        whitelist.set_table_pool(self.whitelist_pool, weight)
+
+    def add_page_check(self, page_name, options):
+        """
+        Compiles argument checks for page options, adding a check_arg member
+        pointing to the generated function. Does nothing unless enabled.
+        """
+        if self.page_check_compiler is None:
+            return None
+        check_opt = CheckFuncOption('check_arg')
+        check_opt.set_value(
+            self.page_check_compiler.compile_page(page_name, options))
+        options.required_conf.add(check_opt)
+        return check_opt
+
 
 class Option(object):
     """Represents simple configuration option"""
@@ -428,7 +547,7 @@ class BoolOption(Option):
                    repr(self.value))
 
     def add_config(self, info):
-        if not self.value_has_been_set:
+        if not self.value_has_been_set and self.value is None:
             return
         if self.is_top_level:
             info.add_macro_def(self.name.upper(), self.get_cvalue())
@@ -483,23 +602,130 @@ class WhitelistOption(StringOption):
     """Represents option where certain characters are whitelisted"""
 
     num_bytes = 0x100 / 8
+    table_pool = None
+    table_key = None
+
+    # Allowed bytes and bitmaps of whitelist patterns, shared by all configs
+    # compiled by a process
+    allowed_bytes_memo = {}
+    bitmap_memo = {}
 
     def get_ctype(self):
         return 'const char *'
 
+    def get_allowed_bytes(self):
+        """
+        Returns sorted list of byte values allowed by the whitelist. The list
+        is shared and must not be modified.
+        """
+        memo = WhitelistOption.allowed_bytes_memo
+        if self.value not in memo:
+            memo[self.value] = [i for i in range(0x100)
+                                if re.match(self.value, chr(i))]
+        return memo[self.value]
+
+    def get_bitmap(self):
+        """
+        Returns whitelist as list of bitmap bytes, LSB first. The list is
+        shared and must not be modified.
+        """
+        memo = WhitelistOption.bitmap_memo
+        if self.value not in memo:
+            chars = [0] * WhitelistOption.num_bytes
+            for i in self.get_allowed_bytes():
+                chars[i / 8] |= (1 << (i % 8))
+            memo[self.value] = chars
+        return memo[self.value]
+
     def get_cvalue(self):
-        chars = []
-        byte = 0
-        for i in range(0x100):
-            byte_idx = i % 8
-            char = chr(i)
-            if re.match(self.value, char):
-                byte |= (1 << byte_idx)
-            if byte_idx == 7:
-                chars.append(byte)
-                byte = 0
+        return c_str_repr(struct.pack(WhitelistOption.num_bytes * 'B',
+                                      *self.get_bitmap()))
+
+    @staticmethod
+    def scan_table(allowed):
+        """
+        Returns nibble transposed scan table for allowed bytes, excluding '%'.
+        See src/whitelist_scan.h for the layout.
+        """
+        table = [0] * WhitelistOption.num_bytes
+        for i in allowed:
+            if i == ord('%'):
+                continue
+            table[((i >> 7) << 4) | (i & 0x0f)] |= 1 << ((i >> 4) & 0x7)
+        return table
+
+    def get_scan_cvalue(self):
+        """Returns C representation of scan table"""
+        table = WhitelistOption.scan_table(self.get_allowed_bytes())
+        return c_str_repr(struct.pack(WhitelistOption.num_bytes * 'B', *table))
+
+    def get_elements(self):
+        return [(self.get_ctype(), self.name),
+                (self.get_ctype(), self.name + '_scan')]
 
-        return c_str_repr(struct.pack(WhitelistOption.num_bytes * 'B', *chars))
+    def set_table_pool(self, pool, weight):
+        """Places bitmap and scan table in pool, weighted by weight hits"""
+        self.table_pool = pool
+        self.table_key = pool.add(self.get_allowed_bytes(), weight)
+
+    def get_elements_value(self):
+        if self.table_pool is not None:
+            return [(self.get_ctype(), self.name,
+                     self.table_pool.get_ref(self.table_key, 'whitelist')),
+                    (self.get_ctype(), self.name + '_scan',
+                     self.table_pool.get_ref(self.table_key, 'whitelist_scan'))]
+        return [(self.get_ctype(), self.name, self.get_cvalue()),
+                (self.get_ctype(), self.name + '_scan', self.get_scan_cvalue())]
+
+
+class WhitelistTablePool(object):
+    """
+    Pools whitelist bitmaps with their scan tables. Each bitmap shares a 64 byte
+    cache line with its scan table, and the most used whitelists come first.
+    """
+
+    name = 'whitelist_tables'
+
+    def __init__(self):
+        self.keys = []
+        self.weights = {}
+
+    def add(self, allowed, weight):
+        """Adds whitelist of allowed bytes, returning its key"""
+        key = tuple(allowed)
+        if key not in self.weights:
+            self.keys.append(key)
+            self.weights[key] = 0
+        self.weights[key] += weight
+        return key
+
+    def get_sorted_keys(self):
+        """Returns keys by decreasing weight, in insertion order for ties"""
+        return sorted(self.keys, key=lambda x: -self.weights[x])
+
+    def get_ref(self, key, member):
+        """Returns C expression for member of the table entry for key"""
+        return '%s[%d].%s' % (WhitelistTablePool.name,
+                              self.get_sorted_keys().index(key), member)
+
+    def to_string(self):
+        """Returns C source definition"""
+        lines = ['/* Whitelist bitmaps and scan tables, hottest first */',
+                 'static const struct whitelist_tables {',
+                 '    char whitelist[WHITELIST_PARAM_LEN];',
+                 '    char whitelist_scan[WHITELIST_PARAM_LEN];',
+                 '} __attribute__((aligned(64))) %s[%d] = {' % (
+                     WhitelistTablePool.name, len(self.keys))]
+        fmt = WhitelistOption.num_bytes * 'B'
+        for key in self.get_sorted_keys():
+            bitmap = [0] * WhitelistOption.num_bytes
+            for i in key:
+                bitmap[i / 8] |= (1 << (i % 8))
+            scan = WhitelistOption.scan_table(key)
+            lines.append('    {%s,' % c_str_repr(struct.pack(fmt, *bitmap)))
+            lines.append('     %s},' % c_str_repr(struct.pack(fmt, *scan)))
+        lines.append('};')
+        return '\n'.join(lines) + '\n'
 
 
 class StringArrOption(Option):
@@ -548,6 +774,431 @@ class HTTPReqsOption(StringArrOption):
         return 'int'
 
 
+class CheckFuncOption(Option):
+    """Represents pointer to a generated page argument check function"""
+
+    def validate(self):
+        pass
+
+    def add_config(self, info):
+        pass
+
+    def get_ctype(self):
+        return 'page_arg_check_t'
+
+    def get_cvalue(self):
+        return self.value
+
+
+def c_char_repr(char_val):
+    """Returns C character literal for byte value"""
+    char_ = chr(char_val)
+    if char_.isalnum() or char_ in '_-.,:;/+=!? ':
+        return "'%s'" % char_
+    return '0x%02x' % char_val
+
+
+def byte_ranges(allowed):
+    """Returns list of (low, high) inclusive ranges covering sorted bytes"""
+    ranges = []
+    for val in allowed:
+        if ranges and ranges[-1][1] == val - 1:
+            ranges[-1] = (ranges[-1][0], val)
+        else:
+            ranges.append((val, val))
+    return ranges
+
+
+class PageCheckCompiler(object):
+    """
+    Partially evaluates page and parameter config into straight-line C
+    argument check functions, one per page.
+    """
+
+    # Whitelists with more ranges than this are tested with a bitmap lookup
+    max_inline_ranges = 8
+
+    def __init__(self, enable_len_check, enable_whitelist_check,
+                 enable_csrf_protection):
+        self.enable_len_check = enable_len_check
+        self.enable_whitelist_check = enable_whitelist_check
+        self.enable_csrf_protection = enable_csrf_protection
+        self.funcs = []
+        self.value_check_names = {}
+        self.bitmap_names = {}
+        self.profile = None
+
+    def whitelist_expr(self, allowed, var='c'):
+        """Returns C expression testing whether byte var is allowed"""
+        ranges = byte_ranges(allowed)
+        if not ranges:
+            return 'false'
+        if ranges == [(0, 0xff)]:
+            return 'true'
+        if len(ranges) > PageCheckCompiler.max_inline_ranges:
+            return '(%s[%s >> 3] & (1 << (%s & 7)))' % (
+                self.get_bitmap_name(allowed), var, var)
+
+        parts = []
+        for low, high in ranges:
+            if low == high:
+                parts.append('%s == %s' % (var, c_char_repr(low)))
+            elif low == 0:
+                parts.append('%s <= %s' % (var, c_char_repr(high)))
+            elif high == 0xff:
+                parts.append('%s >= %s' % (var, c_char_repr(low)))
+            else:
+                parts.append('(%s >= %s && %s <= %s)' % (
+                    var, c_char_repr(low), var, c_char_repr(high)))
+        return ' || '.join(parts)
+
+    def get_bitmap_name(self, allowed):
+        """Returns name of static bitmap for allowed bytes, emitting it once"""
+        key = tuple(allowed)
+        if key not in self.bitmap_names:
+            name = 'whitelist_' + VarInst.get_next_inst_name()
+            bitmap = [0] * WhitelistOption.num_bytes
+            for i in allowed:
+                bitmap[i / 8] |= (1 << (i % 8))
+            self.funcs.append('static const unsigned char %s[%d] = {%s};\n' % (
+                name, WhitelistOption.num_bytes,
+                ', '.join(['0x%02x' % x for x in bitmap])))
+            self.bitmap_names[key] = name
+        return self.bitmap_names[key]
+
+    def get_scan_table_name(self, allowed):
+        """Returns name of static scan table for allowed bytes, emitting it once"""
+        key = ('scan', tuple(allowed))
+        if key not in self.bitmap_names:
+            name = 'whitelist_scan_' + VarInst.get_next_inst_name()
+            table = WhitelistOption.scan_table(allowed)
+            self.funcs.append('static const char %s[%d] = {%s};\n' % (
+                name, WhitelistOption.num_bytes,
+                ', '.join(['0x%02x' % x for x in table])))
+            self.bitmap_names[key] = name
+        return self.bitmap_names[key]
+
+    def get_value_check(self, max_len, whitelist):
+        """
+        Returns name of generated function checking a parameter value against
+        max_len and whitelist, or None if no value checks are enabled.
+        """
+        if not (self.enable_len_check or self.enable_whitelist_check):
+            return None
+        allowed = tuple(whitelist.get_allowed_bytes())
+        key = (max_len, allowed)
+        if key in self.value_check_names:
+            return self.value_check_names[key]
+
+        if self.enable_whitelist_check:
+            scan_allowed = allowed
+        else:
+            scan_allowed = range(0x100)
+        scan_name = self.get_scan_table_name(scan_allowed)
+
+        name = 'check_value_' + VarInst.get_next_inst_name()
+        lines = [
+            '/* Compiled value check: max_param_len=%d, whitelist=%s */' % (
+                max_len, c_str_repr(whitelist.value).replace('*/', '* /')),
+            'static void %s(struct event_data *ev_data, char *value,' % name,
+            '        size_t value_len) {',
+            '    char *data = value, *data_end = value + value_len;',
+            '    size_t decode_len = 0;',
+            '    unsigned char c;',
+            '',
+            '    while (data < data_end) {',
+            '        /* Skip run of allowed bytes that are not URL encoded */',
+            '        size_t run = whitelist_scan_run(%s, data, data_end - data);'
+            % scan_name,
+            '        data += run;',
+            '        decode_len += run;',
+            '        if (data >= data_end) {',
+            '            break;',
+            '        }',
+            '',
+            "        if (*data == '%') { /* URL encoded byte */",
+            '            if (data + 2 >= data_end',
+            '                    || url_decode_hex_pair(data + 1, &c) < 0) {',
+            '                log_warn("Invalid URL encoding found during length '
+            'check\\n");',
+            '                cancel_connection(ev_data, REASON_INVALID_HTTP);',
+            '                return;',
+            '            }',
+            '            data += 3;',
+            '        } else {',
+            '            c = *data++;',
+            '        }',
+        ]
+        if self.enable_whitelist_check:
+            lines += [
+                '        if (!(%s)) {' % self.whitelist_expr(allowed),
+                '            log_info("Character \'\\\\x%02hhx\' not allowed\\n", c);',
+                '            cancel_connection(ev_data, '
+                'REASON_PARAM_CHARACTER_NOT_ALLOWED);',
+                '            return;',
+                '        }',
+            ]
+        lines += [
+            '        decode_len++;',
+            '    }',
+        ]
+        if self.enable_len_check:
+            lines += [
+                '',
+                '    if (decode_len > %d) {' % max_len,
+                '        log_warn("Length of parameter value \\"%%.*s\\" %%zd '
+                'exceeds max %d\\n",' % max_len,
+                '                (int) value_len, value, decode_len);',
+                '        cancel_connection(ev_data, REASON_PARAM_LEN_EXCEEDED);',
+                '    }',
+            ]
+        else:
+            lines += ['    (void) decode_len;']
+        lines += ['}', '']
+
+        self.funcs.append('\n'.join(lines))
+        self.value_check_names[key] = name
+        return name
+
+    @staticmethod
+    def get_option_value(options, name):
+        """Returns value of named child option of MultiOption"""
+        return options.get_name2conf()[name].value
+
+    def compile_page(self, page_name, options):
+        """
+        Generates argument check function for page config options and returns
+        its name.
+        """
+        name2conf = options.get_name2conf()
+        restrict_params = name2conf['restrict_params'].value
+        receives_csrf = name2conf['receives_csrf_form_action'].value
+
+        # Collect (arg name, C statement) pairs; CSRF token is matched first
+        matches = []
+        if self.enable_csrf_protection and receives_csrf:
+            matches.append((CSRF_TOKEN_NAME,
+                            'check_csrf_token_arg(ev_data, value, value_len);'))
+        params = name2conf.get('params')
+        if params is not None:
+            param_names = sorted(params.suboptions.keys())
+            if self.profile is not None:
+                # Hot parameters are compared first within their case
+                param_names = self.profile.sort_params(page_name, param_names)
+            for param in param_names:
+                if param in [x[0] for x in matches]:
+                    continue
+                param_n2c = params.suboptions[param].get_name2conf()
+                value_check = self.get_value_check(
+                    param_n2c['max_param_len'].value,
+                    param_n2c['whitelist'])
+                if value_check is None:
+                    stmt = ';'
+                else:
+                    stmt = '%s(ev_data, value, value_len);' % value_check
+                matches.append((param, stmt))
+
+        name = 'check_arg_' + VarInst.get_next_inst_name()
+        lines = [
+            '/* Compiled argument checks for page %s */' % c_str_repr(page_name),
+            'static void %s(struct event_data *ev_data, char *name,' % name,
+            '        size_t name_len, char *value, size_t value_len) {',
+            "    if (memchr(name, '%', name_len) != NULL) {",
+            '        /* URL encoded names are matched by the interpreter */',
+            '        check_page_arg(ev_data, name, name_len, value, value_len);',
+            '        return;',
+            '    }',
+            '',
+        ]
+
+        by_len = {}
+        for arg, stmt in matches:
+            by_len.setdefault(len(arg), []).append((arg, stmt))
+
+        def match_lines(arg, stmt, indent):
+            """Returns lines matching a single argument name"""
+            pad = ' ' * indent
+            return [pad + 'if (memcmp(name, %s, %d) == 0) {' % (
+                c_str_repr(arg), len(arg)),
+                    pad + '    ' + stmt,
+                    pad + '    return;',
+                    pad + '}']
+
+        if by_len:
+            lines.append('    switch (name_len) {')
+            for arg_len in sorted(by_len.keys()):
+                group = by_len[arg_len]
+                lines.append('    case %d:' % arg_len)
+                if arg_len == 0 or len(group) == 1:
+                    for arg, stmt in group:
+                        lines += match_lines(arg, stmt, 8)
+                else:
+                    by_first = {}
+                    for arg, stmt in group:
+                        by_first.setdefault(ord(arg[0]), []).append((arg, stmt))
+                    lines.append('        switch (name[0]) {')
+                    for first in sorted(by_first.keys()):
+                        lines.append('        case %s:' % c_char_repr(first))
+                        for arg, stmt in by_first[first]:
+                            lines += match_lines(arg, stmt, 12)
+                        lines.append('            break;')
+                    lines.append('        }')
+                lines.append('        break;')
+            lines += ['    }', '']
+
+        if restrict_params:
+            lines += [
+                '    log_warn("Parameter sent when not allowed\\n");',
+                '    cancel_connection(ev_data, REASON_PARAM_NOT_ALLOWED);',
+            ]
+        else:
+            value_check = self.get_value_check(
+                name2conf['max_param_len'].value, name2conf['whitelist'])
+            if value_check is None:
+                lines.append('    (void) ev_data;')
+            else:
+                lines.append('    /* Page default parameter */')
+                lines.append('    %s(ev_data, value, value_len);' % value_check)
+        lines += ['}', '']
+
+        self.funcs.append('\n'.join(lines))
+        return name
+
+
+class HeaderClassifier(object):
+    """
+    Generates a case-insensitive perfect hash classifier over the header
+    names the shim inspects, with the header length limits folded in.
+    """
+
+    # (enum suffix, header name) pairs, in enum order
+    headers = [
+        ('COOKIE', 'Cookie'),
+        ('TRANSFER_ENCODING', 'Transfer-Encoding'),
+        ('TE', 'TE'),
+        ('TRAILERS', 'Trailers'),
+        ('CONTENT_ENCODING', 'Content-Encoding'),
+        ('CONTENT_LENGTH', 'Content-Length'),
+        ('AUTHORIZATION', 'Authorization'),
+    ]
+
+    # Largest hash multiplier tried before growing the table
+    max_multiplier = 64
+
+    def __init__(self, max_field_len=None, max_value_len=None):
+        """Length limits of None are not checked"""
+        self.max_field_len = max_field_len
+        self.max_value_len = max_value_len
+        self.table_size, self.mult_len, self.mult_first = self.find_hash()
+
+    @staticmethod
+    def key(name):
+        """Returns the (length, first byte, last byte) hash key of name"""
+        return len(name), ord(name[0]) | 0x20, ord(name[-1]) | 0x20
+
+    def hash(self, name, table_size=None, mult_len=None, mult_first=None):
+        """Python equivalent of the generated C hash"""
+        if table_size is None:
+            table_size = self.table_size
+            mult_len, mult_first = self.mult_len, self.mult_first
+        name_len, first, last = HeaderClassifier.key(name)
+        return (name_len * mult_len + first * mult_first + last) & (
+            table_size - 1)
+
+    def find_hash(self):
+        """Returns smallest (table_size, mult_len, mult_first) without collisions"""
+        names = [name for _, name in HeaderClassifier.headers]
+        table_size = 1
+        while table_size < len(names):
+            table_size *= 2
+        while True:
+            for mult_len in range(1, HeaderClassifier.max_multiplier):
+                for mult_first in range(1, HeaderClassifier.max_multiplier):
+                    slots = set(self.hash(name, table_size, mult_len, mult_first)
+                                for name in names)
+                    if len(slots) == len(names):
+                        return table_size, mult_len, mult_first
+            table_size *= 2
+
+    def to_header_string(self):
+        """Returns enum and prototype for the generated header"""
+        lines = ['/* Header classes returned by classify_header() */',
+                 'typedef enum {',
+                 '    HEADER_OTHER = 0,']
+        for suffix, _ in HeaderClassifier.headers:
+            lines.append('    HEADER_%s,' % suffix)
+        lines += ['    HEADER_FIELD_OVERSIZED,',
+                  '    HEADER_VALUE_OVERSIZED',
+                  '} header_class_t;',
+                  '',
+                  'header_class_t classify_header(const char *field, '
+                  'size_t field_len,',
+                  '        size_t value_len, bool is_request);',
+                  '']
+        return '\n'.join(lines)
+
+    def to_body_string(self):
+        """Returns C source of classify_header()"""
+        table = [None] * self.table_size
+        for suffix, name in HeaderClassifier.headers:
+            table[self.hash(name)] = (suffix, name)
+        lengths = [len(name) for _, name in HeaderClassifier.headers]
+
+        lines = ['/* Header classifier */', '',
+                 'static const struct {',
+                 '    const char *name;',
+                 '    size_t len;',
+                 '    header_class_t header_class;',
+                 '} header_class_table[%d] = {' % self.table_size]
+        for entry in table:
+            if entry is None:
+                lines.append('    {NULL, 0, HEADER_OTHER},')
+            else:
+                suffix, name = entry
+                lines.append('    {%s, %d, HEADER_%s},' % (
+                    c_str_repr(name), len(name), suffix))
+        lines += ['};', '',
+                  '/* Classifies header by name in one pass. Request headers '
+                  'longer than the',
+                  ' * configured limits are classified as oversized. */',
+                  'header_class_t classify_header(const char *field, '
+                  'size_t field_len,',
+                  '        size_t value_len, bool is_request) {']
+        if self.max_field_len is not None:
+            lines += ['    if (is_request && field_len > %d) {' %
+                      self.max_field_len,
+                      '        return HEADER_FIELD_OVERSIZED;',
+                      '    }']
+        if self.max_value_len is not None:
+            lines += ['    if (is_request && value_len > %d) {' %
+                      self.max_value_len,
+                      '        return HEADER_VALUE_OVERSIZED;',
+                      '    }']
+        if self.max_field_len is None and self.max_value_len is None:
+            lines.append('    (void) value_len;')
+            lines.append('    (void) is_request;')
+        lines += [
+            '    if (field_len < %d || field_len > %d) {' % (
+                min(lengths), max(lengths)),
+            '        return HEADER_OTHER;',
+            '    }',
+            '',
+            '    size_t h = (field_len * %d + (unsigned char) (field[0] | 0x20)'
+            % self.mult_len,
+            '            * %d + (unsigned char) (field[field_len - 1] | 0x20))'
+            % self.mult_first,
+            '            & %d;' % (self.table_size - 1),
+            '    if (header_class_table[h].len == field_len',
+            '            && strncasecmp(header_class_table[h].name, field,',
+            '                field_len) == 0) {',
+            '        return header_class_table[h].header_class;',
+            '    }',
+            '    return HEADER_OTHER;',
+            '}',
+            '']
+        return '\n'.join(lines)
+
+
 class MultiOption(Option):
     """Represents option that contains child options"""
 
@@ -582,7 +1233,8 @@ class MultiOption(Option):
             for name in self.name_visit_order:
                 yield n2c[name]
         else:
-            for opt in self.get_all_options():
+            # By name rather than in set order, so output is deterministic
+            for opt in sorted(self.get_all_options(), key=lambda x: x.name):
                 yield opt
 
     def get_required_options_sorted(self):
@@ -628,7 +1280,7 @@ class MultiOption(Option):
 
     def add_config(self, info):
         """Add config"""
-        for option in self.get_all_options():
+        for option in self.get_all_options_sorted():
             option.add_config(info)
 
     def get_name2conf(self):
@@ -679,14 +1331,18 @@ class DefaultPageConfOption(MultiOption):
         self.param_option.set_instance_name('NULL')
         self.required_conf.add(self.param_option)
 
+        info.add_page_check(default_page_conf_name, self)
+
         opts = list(self.get_all_options())
         Option.sort_struct_element_list(opts)
         page_conf_struct = StructDef('page_conf', opts)
         info.add_struct_def(page_conf_struct)
 
         # Call children
-        for option in self.get_all_options():
+        for option in self.get_all_options_sorted():
             option.add_config(info)
+        if info.profile is not None:
+            info.pool_whitelist(self, info.profile.get_default_page_weight())
 
         # Add default structure instance
         inst = StructInst(self, 'page_conf', inst_name=default_page_conf_name)
@@ -761,22 +1417,33 @@ class PageConfOption(NamedOptionSet):
         name_opt = StringOption('name')
         self.required_conf.add(name_opt)
         opts = list(self.get_all_options())
+        if info.page_check_compiler is not None:
+            opts.append(CheckFuncOption('check_arg'))
         Option.sort_struct_element_list(opts)
         page_conf_struct = StructDef('page_conf', opts)
         info.add_struct_def(page_conf_struct)
 
         # Call children
-        for option in self.get_all_options():
+        for option in self.get_all_options_sorted():
             option.add_config(info)
 
         # Add structure instances
         struct_insts = []
-        for (page, options) in self.suboptions.items():
-            for opt in options.get_all_options():
+        pages = self.suboptions.keys()
+        if info.profile is not None:
+            pages = info.profile.sort_pages(pages)
+        for page in pages:
+            options = self.suboptions[page]
+            options.get_name2conf()['params'].page = page
+            if info.profile is not None:
+                info.pool_whitelist(options,
+                                    info.profile.get_page_weight(page))
+            for opt in options.get_all_options_sorted():
                 opt.add_config(info)
             name_opt_copy = deepcopy(name_opt)
             name_opt_copy.set_value(page)
             options.required_conf.add(name_opt_copy)
+            info.add_page_check(page, options)
             inst = StructInst(options, 'page_conf')
             struct_insts.append(inst)
             info.add_page_conf_struct(inst)
@@ -792,6 +1459,10 @@ class PageConfOption(NamedOptionSet):
 
 class ParamsOption(NamedOptionSet):
     """Represents options for HTTP parameters"""
+
+    # Path of the page these are the parameters of
+    page = None
+
     def validate(self):
         """Validates HTTP parameter options"""
         for param, param_conf in self.suboptions.items():
@@ -812,12 +1483,19 @@ class ParamsOption(NamedOptionSet):
         info.add_struct_def(params_struct)
 
         # Call children
-        for option in self.get_all_options():
+        for option in self.get_all_options_sorted():
             option.add_config(info)
 
         # Add structure instances
         struct_insts = []
-        for (param, options) in self.suboptions.items():
+        params = self.suboptions.keys()
+        if info.profile is not None:
+            params = info.profile.sort_params(self.page, params)
+        for param in params:
+            options = self.suboptions[param]
+            if info.profile is not None:
+                info.pool_whitelist(options, info.profile.get_param_weight(
+                    self.page, param))
             name_opt_copy = deepcopy(name_opt)
             name_opt_copy.set_value(param)
             options.required_conf.add(name_opt_copy)
@@ -826,13 +1504,157 @@ class ParamsOption(NamedOptionSet):
             info.add_params_struct(inst)
 
         params_arr = StructArrInst(struct_insts, 'params')
-        info.add_params_array(params_arr)
-        self.set_instance_name(params_arr.name)
+        if info.params_pool is not None:
+            self.set_instance_name(info.params_pool.add(params_arr))
+        else:
+            info.add_params_array(params_arr)
+            self.set_instance_name(params_arr.name)
 
     def get_ctype(self):
         return 'struct params'
 
 
+class AccessProfile(object):
+    """
+    Hit counts of pages and of their parameters, used to lay out the generated
+    config hottest first.
+
+    Profiles are read either from a JSON counters file of the form
+    {"pages": {PATH: HITS}, "params": {PATH: {PARAM: HITS}}} or from an access
+    log in Common or Combined Log Format. Access logs only give counts for
+    query string parameters.
+    """
+
+    log_request_re = re.compile(r'"([A-Z]+) (\S+) HTTP/[0-9.]+"')
+
+    def __init__(self):
+        self.page_hits = {}
+        self.param_hits = {}
+        self.pages = set()
+        self.skipped_lines = 0
+
+    @staticmethod
+    def load(profile_filename):
+        """Returns profile read from counters file or access log"""
+        print 'Reading profile "%s"' % profile_filename
+        profile = AccessProfile()
+        with open(profile_filename, 'r') as profile_file:
+            data = profile_file.read()
+        if data.lstrip().startswith('{'):
+            profile.add_counters(json.loads(data))
+        else:
+            for line in data.splitlines():
+                profile.add_log_line(line)
+        return profile
+
+    def add_counters(self, counters):
+        """Adds hit counts from parsed JSON counters file"""
+        assert_parse(isinstance(counters, dict) and
+                     set(counters.keys()).issubset(['pages', 'params']),
+                     'Profile must only have "pages" and "params" objects')
+        for page, hits in counters.get('pages', {}).items():
+            assert_parse(is_page(page) and isinstance(hits, (int, long)) and hits >= 0,
+                         'Invalid hit count for page "%s"' % page)
+            self.page_hits[page] = self.page_hits.get(page, 0) + hits
+        for page, param_hits in counters.get('params', {}).items():
+            assert_parse(is_page(page) and isinstance(param_hits, dict),
+                         'Invalid param hit counts for page "%s"' % page)
+            page_param_hits = self.param_hits.setdefault(page, {})
+            for param, hits in param_hits.items():
+                assert_parse(isinstance(hits, (int, long)) and hits >= 0,
+                             'Invalid hit count for param "%s"' % param)
+                page_param_hits[param] = page_param_hits.get(param, 0) + hits
+
+    def add_log_line(self, line):
+        """Adds hits of the request in access log line"""
+        match = AccessProfile.log_request_re.search(line)
+        if match is None:
+            self.skipped_lines += 1
+            return
+        target = match.group(2)
+        page, _, query = target.partition('?')
+        self.page_hits[page] = self.page_hits.get(page, 0) + 1
+        page_param_hits = self.param_hits.setdefault(page, {})
+        for arg in query.split('&'):
+            param = urllib.unquote_plus(arg.partition('=')[0])
+            if param:
+                page_param_hits[param] = page_param_hits.get(param, 0) + 1
+
+    def set_pages(self, pages):
+        """Sets configured pages, other pages are served by the default page"""
+        self.pages = set(pages)
+
+    def get_page_weight(self, page):
+        """Returns hits of configured page"""
+        return self.page_hits.get(page, 0)
+
+    def get_default_page_weight(self):
+        """Returns hits of pages without their own config"""
+        return sum(hits for page, hits in self.page_hits.items()
+                   if page not in self.pages)
+
+    def get_param_weight(self, page, param):
+        """Returns hits of param of page"""
+        return self.param_hits.get(page, {}).get(param, 0)
+
+    def sort_pages(self, pages):
+        """Returns pages by decreasing hits, by name for ties"""
+        return sorted(pages, key=lambda x: (-self.get_page_weight(x), x))
+
+    def sort_params(self, page, params):
+        """Returns params of page by decreasing hits, by name for ties"""
+        return sorted(params,
+                      key=lambda x: (-self.get_param_weight(page, x), x))
+
+    def get_lookup_cost(self, pages, page_params):
+        """
+        Returns expected number of names compared per page lookup and per
+        parameter lookup, when pages and the lists in dict page_params are
+        scanned in order
+        """
+        page_pos = {page: i + 1 for i, page in enumerate(pages)}
+        page_cmps = page_lookups = 0
+        for page, hits in self.page_hits.items():
+            page_cmps += hits * page_pos.get(page, len(pages))
+            page_lookups += hits
+        param_cmps = param_lookups = 0
+        for page, param_hits in self.param_hits.items():
+            # The default page has no params to compare
+            params = page_params.get(page, [])
+            param_pos = {param: i + 1 for i, param in enumerate(params)}
+            for param, hits in param_hits.items():
+                param_cmps += hits * param_pos.get(param, len(params))
+                param_lookups += hits
+        return (page_cmps / float(max(page_lookups, 1)),
+                param_cmps / float(max(param_lookups, 1)))
+
+    def print_lookup_cost(self, page_config):
+        """
+        Prints expected lookup cost of the pages and params in PageConfOption
+        page_config, laid out with and without the profile
+        """
+        page_params = {page: conf.get_name2conf()['params'].suboptions.keys()
+                       for page, conf in page_config.suboptions.items()}
+        base_cost = self.get_lookup_cost(page_config.suboptions.keys(),
+                                         page_params)
+        hot_page_params = {page: self.sort_params(page, params)
+                           for page, params in page_params.items()}
+        cost = self.get_lookup_cost(
+            self.sort_pages(page_config.suboptions.keys()), hot_page_params)
+
+        total = sum(self.page_hits.values())
+        default_hits = self.get_default_page_weight()
+        print 'Profile has %d requests, %d to pages without config' % (
+            total, default_hits)
+        if self.skipped_lines:
+            print 'Skipped %d unrecognized access log lines' % (
+                self.skipped_lines)
+        print ('Expected page lookup cost: %.2f name comparisons '
+               '(%.2f without profile)' % (cost[0], base_cost[0]))
+        print ('Expected param lookup cost: %.2f name comparisons '
+               '(%.2f without profile)' % (cost[1], base_cost[1]))
+
+
 def get_toplevel_conf():
     """Returns toplevel config"""
     # Configuration specification
@@ -880,7 +1702,12 @@ def get_toplevel_conf():
 
     global_conf_optional = {
         PosIntOption('max_num_sessions', is_top_level=True, defaultValue=20),
-        PosIntOption('session_life_seconds', is_top_level=True, defaultValue=300)
+        PosIntOption('session_life_seconds', is_top_level=True, defaultValue=300),
+        PosIntOption('max_connections', is_top_level=True, defaultValue=500),
+        PosIntOption('max_pending_connections', is_top_level=True,
+                     defaultValue=128),
+        BoolOption('enable_compiled_page_checks', is_top_level=True,
+                   defaultValue=False)
     }
 
     default_page_conf = DefaultPageConfOption(
@@ -908,10 +1735,14 @@ def comments_removed_read(file_obj):
             ret_lines.append(line)
     return ''.join(ret_lines)
 
-def parse_config(config_filename):
-    """Parse config file and return populated toplevel config"""
+def parse_config(config_filename, toplevel_conf=None):
+    """
+    Parse config file and return populated toplevel config, populating
+    toplevel_conf if given an unpopulated one from get_toplevel_conf()
+    """
     print 'Parsing config file "%s"' % config_filename
-    toplevel_conf = get_toplevel_conf()
+    if toplevel_conf is None:
+        toplevel_conf = get_toplevel_conf()
     with open(config_filename, 'r') as config_file:
         conf_str = comments_removed_read(config_file)
         conf = json.loads(conf_str)
@@ -920,25 +1751,200 @@ def parse_config(config_filename):
     return toplevel_conf
 
 
-def write_header(toplevel_conf, output_header_filename, output_body_filename):
-    """Write populated toplevel config to output header and source files"""
+def get_global_config_value(toplevel_conf, name):
+    """Returns value of option in global_config"""
+    global_conf = toplevel_conf.get_name2conf()['global_config']
+    return global_conf.get_name2conf()[name].value
+
+
+def get_enabled_limit(toplevel_conf, enable_name, limit_name):
+    """Returns value of limit in global_config, or None if its check is disabled"""
+    if not get_global_config_value(toplevel_conf, enable_name):
+        return None
+    return get_global_config_value(toplevel_conf, limit_name)
+
+
+def write_header(toplevel_conf, output_header_filename, output_body_filename,
+                 profile=None):
+    """
+    Write populated toplevel config to output header and source files, laid
+    out hottest first if given AccessProfile profile
+    """
+    # Instance names only depend on the config, even when several configs are
+    # compiled by one process
+    VarInst.instCount = 0
     info = CodeHeader()
+    page_config = toplevel_conf.get_name2conf()['page_config']
+    if profile is not None:
+        profile.set_pages(page_config.suboptions.keys())
+        info.set_profile(profile)
+    if get_global_config_value(toplevel_conf, 'enable_compiled_page_checks'):
+        info.enable_page_check_compiler(PageCheckCompiler(
+            get_global_config_value(toplevel_conf, 'enable_param_len_check'),
+            get_global_config_value(toplevel_conf,
+                                    'enable_param_whitelist_check'),
+            get_global_config_value(toplevel_conf, 'enable_csrf_protection')))
+    info.set_header_classifier(HeaderClassifier(
+        get_enabled_limit(toplevel_conf, 'enable_header_field_len_check',
+                          'max_header_field_len'),
+        get_enabled_limit(toplevel_conf, 'enable_header_value_len_check',
+                          'max_header_value_len')))
     toplevel_conf.add_config(info)
     with open(output_header_filename, 'w') as output_header_file:
         info.write_config_header(output_header_file)
     with open(output_body_filename, 'w') as output_body_file:
-        info.write_config_body(output_header_filename, output_body_file)
+        info.write_config_body(os.path.relpath(
+            output_header_filename,
+            os.path.dirname(output_body_filename) or os.curdir),
+                               output_body_file)
+    if profile is not None:
+        profile.print_lookup_cost(page_config)
+
+
+class BatchTarget(object):
+    """Config file and output files of one target of a batch manifest"""
+
+    keys = ['config', 'header', 'body', 'profile']
+
+    def __init__(self, config, header, body, profile=None):
+        self.config = config
+        self.header = header
+        self.body = body
+        self.profile = profile
+
+    @staticmethod
+    def load_manifest(manifest_filename):
+        """
+        Returns list of BatchTargets in JSON manifest file, a list of objects
+        with "config", "header", "body" and optional "profile" file names
+        """
+        with open(manifest_filename, 'r') as manifest_file:
+            manifest = json.loads(comments_removed_read(manifest_file))
+        assert_parse(is_list_of(manifest, lambda x: isinstance(x, dict)),
+                     'Manifest must be a list of targets')
+        targets = []
+        for entry in manifest:
+            assert_parse(set(entry) <= set(BatchTarget.keys) and
+                         all(is_string(entry.get(x))
+                             for x in BatchTarget.keys[:3]) and
+                         is_string(entry.get('profile', '')),
+                         'Target %s must have "config", "header" and "body" '
+                         'and may have "profile" file names' % json.dumps(entry))
+            targets.append(BatchTarget(**entry))
+        outputs = [x.header for x in targets] + [x.body for x in targets]
+        assert_parse(len(set(outputs)) == len(outputs),
+                     'Manifest has targets with the same output files')
+        return targets
+
+
+# Pickled unpopulated toplevel config of batch processes, set by
+# init_batch_worker()
+BATCH_SCHEMA = None
+
+
+def init_batch_worker(schema):
+    """Initializes batch process with pickled unpopulated toplevel config"""
+    global BATCH_SCHEMA  # pylint: disable=global-statement
+    BATCH_SCHEMA = schema
+
+
+def compile_target(target):
+    """
+    Writes output files of BatchTarget target, removing its output header if
+    that fails. Returns pair of the printed output and the error traceback, or
+    None if it succeeded.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    error = None
+    try:
+        toplevel_conf = parse_config(target.config, cPickle.loads(BATCH_SCHEMA))
+        profile = None
+        if target.profile is not None:
+            profile = AccessProfile.load(target.profile)
+        write_header(toplevel_conf, target.header, target.body, profile)
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+        if os.path.exists(target.header):
+            os.remove(target.header)
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return output, error
+
+
+def compile_batch(targets, jobs=None):
+    """
+    Writes output files of BatchTargets targets in jobs processes, one per CPU
+    by default, building the config schema once. Prints the output and any
+    error of each target in order, and returns the number of failed targets.
+    """
+    schema = cPickle.dumps(get_toplevel_conf(), cPickle.HIGHEST_PROTOCOL)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(targets))
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_batch_worker, (schema,))
+        results = pool.imap(compile_target, targets)
+    else:
+        init_batch_worker(schema)
+        results = itertools.imap(compile_target, targets)
+
+    failures = 0
+    try:
+        for target, (output, error) in itertools.izip(targets, results):
+            print '[%s -> %s, %s]' % (target.config, target.header, target.body)
+            sys.stdout.write(output)
+            if error is not None:
+                failures += 1
+                sys.stdout.flush()
+                sys.stderr.write('Failed to compile "%s":\n%s' % (
+                    target.config, error))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return failures
+
+
+def print_usage():
+    """Prints command line usage"""
+    print ('Usage: %s [--profile PROFILE] CONFIG OUTPUT_HEADER OUPUT_C_FILE'
+           % sys.argv[0])
+    print '       %s [--jobs JOBS] --batch MANIFEST' % sys.argv[0]
 
 
 def main():
     """Main driver function"""
-    if len(sys.argv) != 4:
-        print 'Usage: %s CONFIG OUTPUT_HEADER OUPUT_C_FILE' % sys.argv[0]
+    args = sys.argv[1:]
+    jobs = None
+    if len(args) == 4 and args[0] == '--jobs' and args[1].isdigit():
+        jobs = max(int(args[1]), 1)
+        args = args[2:]
+    if len(args) == 2 and args[0] == '--batch':
+        targets = BatchTarget.load_manifest(args[1])
+        failures = compile_batch(targets, jobs)
+        if failures:
+            print '%d of %d targets failed' % (failures, len(targets))
+            sys.exit(1)
+        print '[done]'
+        return
+
+    profile_file = None
+    if len(args) == 5 and args[0] == '--profile':
+        profile_file = args[1]
+        args = args[2:]
+    if jobs is not None or len(args) != 3:
+        print_usage()
         sys.exit(1)
-    config_file, output_header, output_body = tuple(sys.argv[1:])
+    config_file, output_header, output_body = tuple(args)
     try:
         toplevel_conf = parse_config(config_file)
-        write_header(toplevel_conf, output_header, output_body)
+        profile = None
+        if profile_file is not None:
+            profile = AccessProfile.load(profile_file)
+        write_header(toplevel_conf, output_header, output_body, profile)
     except:
         if os.path.exists(output_header):
             os.remove(output_header)
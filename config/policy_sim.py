@@ -0,0 +1,548 @@
+#!/usr/bin/python
+
+
+"""
+Replays access logs against an Umbra configuration offline, reporting which
+requests the shim would block and why.
+"""
+
+# pylint: disable=too-few-public-methods, locally-disabled, too-many-instance-attributes, too-many-locals
+
+import itertools
+import multiprocessing
+import re
+import string
+import sys
+
+import numpy as np
+
+from parse_config import (CSRF_TOKEN_NAME, WhitelistOption,
+                          get_global_config_value, parse_config)
+
+
+# Subset of CANCEL_REASON_MAP in src/shim_struct.h that requests in an access
+# log can trigger, indexed by reason code
+REASON_NAMES = [
+    'REASON_NOT_CANCELLED',
+    'REASON_INTERNAL_ERROR',
+    'REASON_INVALID_HTTP',
+    'REASON_DIR_TRAVERSAL',
+    'REASON_PARAM_CHARACTER_NOT_ALLOWED',
+    'REASON_PARAM_LEN_EXCEEDED',
+    'REASON_PARAM_NOT_ALLOWED',
+    'REASON_NO_AUTH_HEADER',
+    'REASON_INVALID_CSRF_TOKEN',
+    'REASON_INVALID_CSRF_COOKIE',
+]
+(REASON_NOT_CANCELLED, REASON_INTERNAL_ERROR, REASON_INVALID_HTTP,
+ REASON_DIR_TRAVERSAL, REASON_PARAM_CHARACTER_NOT_ALLOWED,
+ REASON_PARAM_LEN_EXCEEDED, REASON_PARAM_NOT_ALLOWED, REASON_NO_AUTH_HEADER,
+ REASON_INVALID_CSRF_TOKEN,
+ REASON_INVALID_CSRF_COOKIE) = range(len(REASON_NAMES))
+
+# Methods in the order of HTTP_REQ_* in src/http_util.h
+HTTP_METHODS = ['DELETE', 'GET', 'HEAD', 'POST', 'PUT', 'CONNECT', 'OPTIONS',
+                'TRACE']
+HTTP_METHOD_BITS = {x: 1 << i for i, x in enumerate(HTTP_METHODS)}
+
+# Request lines of Common or Combined Log Format access logs
+LOG_LINE_RE = re.compile(r'^\S+ \S+ (\S+) \[[^\]]*\] "(\S+) (\S+)',
+                         re.MULTILINE)
+
+HEX_DIGITS = '0123456789abcdefABCDEF'
+
+# Bytes after ".." that the shim still treats as directory traversal, like
+# ends_dot_dot() in src/http_util.c
+DOT_DOT_ENDS = ';\0' + string.whitespace
+
+
+def url_encoded_eq(str_, url_data):
+    """
+    Returns (equal, is_valid) comparing str_ with URL encoded url_data, like
+    str_to_url_encoded_memeq() in src/http_util.c
+    """
+    i = j = 0
+    while i < len(str_) and j < len(url_data):
+        if str_[i] == url_data[j]:
+            i += 1
+            j += 1
+        elif url_data[j] == '%':
+            pair = url_data[j + 1:j + 3]
+            if (len(pair) < 2 or pair[0] not in HEX_DIGITS
+                    or pair[1] not in HEX_DIGITS):
+                return False, False
+            if chr(int(pair, 16)) != str_[i]:
+                return False, True
+            i += 1
+            j += 3
+        else:
+            return False, True
+    return i == len(str_) and j == len(url_data), True
+
+
+def check_path(path):
+    """
+    Returns reason the URL directory traversal check cancels path with, like
+    parse_request_target() in src/http_util.c
+    """
+    invalid_encoding = is_dir_traversal = False
+    segment_len = segment_dots = 0
+    i = 0
+    while i < len(path):
+        char_ = path[i]
+        if char_ == '%':
+            pair = path[i + 1:i + 3]
+            if (i + 2 < len(path) and pair[0] in HEX_DIGITS
+                    and pair[1] in HEX_DIGITS):
+                char_ = chr(int(pair, 16))
+                i += 2
+            else:
+                invalid_encoding = True
+        if char_ in '/\\':
+            if segment_len == 2 and segment_dots == 2:
+                is_dir_traversal = True
+            segment_len = segment_dots = 0
+        else:
+            if segment_len < 2:
+                segment_dots += char_ == '.'
+            elif (segment_len == 2 and segment_dots == 2
+                  and char_ in DOT_DOT_ENDS):
+                is_dir_traversal = True
+            segment_len += 1
+        i += 1
+    if segment_len == 2 and segment_dots == 2:
+        is_dir_traversal = True
+
+    if invalid_encoding:
+        return REASON_INVALID_HTTP
+    if is_dir_traversal:
+        return REASON_DIR_TRAVERSAL
+    return REASON_NOT_CANCELLED
+
+
+class PagePolicy(object):
+    """Checks of a single page config, in the order the shim applies them"""
+
+    def __init__(self, name, options, simulator):
+        name2conf = options.get_name2conf()
+        self.name = name
+        self.request_types = 0
+        for method in name2conf['request_types'].value:
+            self.request_types |= HTTP_METHOD_BITS[method]
+        self.restrict_params = name2conf['restrict_params'].value
+        self.requires_login = name2conf['requires_login'].value
+        self.has_csrf_form = name2conf['has_csrf_form'].value
+        self.receives_csrf_form_action = \
+            name2conf['receives_csrf_form_action'].value
+        self.default_param = (
+            name2conf['max_param_len'].value,
+            simulator.get_whitelist_id(name2conf['whitelist']))
+
+        # Matching does not depend on the order of the params array
+        self.params = []
+        params = name2conf.get('params')
+        if params is not None:
+            for param, param_conf in params.suboptions.items():
+                param_n2c = param_conf.get_name2conf()
+                self.params.append((
+                    param, param_n2c['max_param_len'].value,
+                    simulator.get_whitelist_id(param_n2c['whitelist'])))
+        self.name_matches = {}
+
+    def match_param(self, name):
+        """
+        Returns ((max_len, whitelist id) or None, reason) for URL encoded
+        argument name, like match_page_param() in src/shim.c
+        """
+        if name in self.name_matches:
+            return self.name_matches[name]
+        match = None
+        reason = REASON_NOT_CANCELLED
+        for param, max_len, whitelist_id in self.params:
+            equal, is_valid = url_encoded_eq(param, name)
+            if not is_valid and reason == REASON_NOT_CANCELLED:
+                reason = REASON_INVALID_HTTP
+            if equal:
+                match = (max_len, whitelist_id)
+                break
+        if match is None:
+            if self.restrict_params:
+                if reason == REASON_NOT_CANCELLED:
+                    reason = REASON_PARAM_NOT_ALLOWED
+            else:
+                match = self.default_param
+        self.name_matches[name] = (match, reason)
+        return match, reason
+
+    def ignores_missing_csrf_token(self, method, enable_request_type_check):
+        """
+        Returns whether a request without a CSRF token is let through as a self
+        referencing form, like on_message_complete_cb() in
+        src/http_callbacks.c
+        """
+        get_allowed = post_allowed = True
+        if enable_request_type_check:
+            get_allowed = bool(self.request_types & HTTP_METHOD_BITS['GET'])
+            post_allowed = bool(self.request_types & HTTP_METHOD_BITS['POST'])
+        return (self.has_csrf_form and self.receives_csrf_form_action
+                and get_allowed and post_allowed and method == 'GET')
+
+
+class SimulationResult(object):
+    """Request and block counts by page and by cancel reason"""
+
+    def __init__(self, page_names):
+        self.page_names = page_names
+        self.page_requests = np.zeros(len(page_names), np.int64)
+        self.blocks = np.zeros((len(page_names), len(REASON_NAMES)), np.int64)
+        self.skipped_lines = 0
+
+    def add(self, page_ids, reasons, counts):
+        """Adds counts of requests to page_ids cancelled with reasons"""
+        self.page_requests += np.bincount(page_ids, weights=counts,
+                                          minlength=len(self.page_names)
+                                         ).astype(np.int64)
+        flat = page_ids * len(REASON_NAMES) + reasons
+        self.blocks += np.bincount(
+            flat, weights=counts, minlength=self.blocks.size
+            ).astype(np.int64).reshape(self.blocks.shape)
+
+    def merge(self, other):
+        """Adds counts of SimulationResult other"""
+        self.page_requests += other.page_requests
+        self.blocks += other.blocks
+        self.skipped_lines += other.skipped_lines
+
+    def write_report(self, out):
+        """Writes per page and per cancel reason counts to file out"""
+        total = self.page_requests.sum()
+        blocked = total - self.blocks[:, REASON_NOT_CANCELLED].sum()
+        out.write('Simulated %d requests, %d blocked (%.2f%%)\n' % (
+            total, blocked, 100.0 * blocked / max(total, 1)))
+        if self.skipped_lines:
+            out.write('Skipped %d unrecognized access log lines\n' %
+                      self.skipped_lines)
+
+        out.write('\nBlocked by page:\n')
+        for i in np.argsort(-self.page_requests, kind='mergesort'):
+            if self.page_requests[i] == 0:
+                continue
+            page_blocked = (self.page_requests[i] -
+                            self.blocks[i, REASON_NOT_CANCELLED])
+            out.write('  %-40s %10d requests %10d blocked\n' % (
+                self.page_names[i], self.page_requests[i], page_blocked))
+            for reason in range(1, len(REASON_NAMES)):
+                if self.blocks[i, reason]:
+                    out.write('      %-38s %10d\n' % (
+                        REASON_NAMES[reason], self.blocks[i, reason]))
+
+        out.write('\nBlocked by cancel reason:\n')
+        reason_totals = self.blocks.sum(axis=0)
+        for reason in range(1, len(REASON_NAMES)):
+            if reason_totals[reason]:
+                out.write('  %-40s %10d\n' % (REASON_NAMES[reason],
+                                               reason_totals[reason]))
+
+
+class PolicySimulator(object):
+    """
+    Evaluates requests against a parsed config the way the shim checks the
+    request line. Identical requests are evaluated once, and the whitelist and
+    length checks of all argument values are done together with NumPy.
+
+    Access logs carry no headers, cookies or bodies, so header limits and
+    credentials are not checked. Requests with a logged user are taken as
+    authenticated, and POST requests are taken to carry a valid CSRF token in
+    their body. The shim only scans POST bodies, so other methods need the
+    token in the URL.
+    """
+
+    def __init__(self, toplevel_conf):
+        def enabled(name):
+            """Returns value of global_config option"""
+            return get_global_config_value(toplevel_conf, name)
+        self.enable_request_type_check = enabled('enable_request_type_check')
+        self.enable_dir_traversal_check = \
+            enabled('enable_url_directory_traversal_check')
+        self.enable_param_len_check = enabled('enable_param_len_check')
+        self.enable_param_whitelist_check = \
+            enabled('enable_param_whitelist_check')
+        self.enable_csrf_protection = enabled('enable_csrf_protection')
+        self.enable_authentication_check = \
+            enabled('enable_authentication_check')
+        self.enable_param_checks = (self.enable_param_len_check or
+                                    self.enable_param_whitelist_check or
+                                    self.enable_csrf_protection)
+
+        self.whitelist_ids = {}
+        self.bitmaps = []
+        name2conf = toplevel_conf.get_name2conf()
+        self.pages = [PagePolicy('default_page_conf',
+                                 name2conf['default_page_config'], self)]
+        self.page_ids = {}
+        for path, options in name2conf['page_config'].suboptions.items():
+            self.page_ids[path] = len(self.pages)
+            self.pages.append(PagePolicy(path, options, self))
+        # Allowed bytes of each whitelist, from its 256 bit bitmap
+        self.allowed = np.array(self.bitmaps, np.uint8).reshape(
+            len(self.bitmaps), WhitelistOption.num_bytes, 1)
+        self.allowed = np.unpackbits(self.allowed, axis=2)[:, :, ::-1].reshape(
+            len(self.bitmaps), 0x100).astype(bool)
+        self.path_reasons = {}
+
+    def get_whitelist_id(self, whitelist):
+        """Returns index of WhitelistOption whitelist in self.bitmaps"""
+        bitmap = tuple(whitelist.get_bitmap())
+        if bitmap not in self.whitelist_ids:
+            self.whitelist_ids[bitmap] = len(self.bitmaps)
+            self.bitmaps.append(bitmap)
+        return self.whitelist_ids[bitmap]
+
+    def check_path(self, path):
+        """Returns memoized directory traversal check reason of path"""
+        if path not in self.path_reasons:
+            self.path_reasons[path] = check_path(path)
+        return self.path_reasons[path]
+
+    def check_values(self, values, whitelist_ids, max_lens):
+        """
+        Returns reasons argument values are cancelled with, checking whitelist
+        and decoded length like url_encode_buf_len_whitelist() in src/shim.c
+        """
+        num_values = len(values)
+        reasons = np.zeros(num_values, np.int8)
+        lens = np.fromiter((len(x) for x in values), np.int64, num_values)
+        if lens.sum() == 0:
+            return reasons
+        data = np.frombuffer(''.join(values), np.uint8)
+        owner = np.repeat(np.arange(num_values), lens)
+        starts = np.cumsum(lens) - lens
+        pos = np.arange(len(data)) - starts[owner]
+        remaining = lens[owner] - pos
+
+        # '%' followed by at least two bytes and a hex digit starts an escape
+        digit = np.full(0x100, -1, np.int16)
+        for char_ in HEX_DIGITS:
+            digit[ord(char_)] = int(char_, 16)
+        digits = digit[data]
+        next1 = np.append(digits[1:], -1)
+        next2 = np.append(digits[2:], [-1, -1])
+        is_pct = data == ord('%')
+        can_decode = is_pct & (remaining > 2) & (next1 >= 0)
+
+        # A single digit escape swallows the byte after it, which may be '%'
+        live = is_pct
+        while True:
+            valid = live & can_decode
+            consumed = np.zeros(len(data), bool)
+            consumed[1:] |= valid[:-1]
+            consumed[2:] |= valid[:-2]
+            next_live = is_pct & ~consumed
+            if np.array_equal(next_live, live):
+                break
+            live = next_live
+
+        invalid = live & ~can_decode
+        decoded = np.where(next2 >= 0, next1 * 16 + next2, next1)
+        byte = np.where(valid, decoded, data).astype(np.uint8)
+        checked = ~consumed & ~invalid
+        error = np.where(invalid, REASON_INVALID_HTTP, REASON_NOT_CANCELLED)
+        if self.enable_param_whitelist_check:
+            not_allowed = checked & ~self.allowed[whitelist_ids[owner], byte]
+            error[not_allowed] = REASON_PARAM_CHARACTER_NOT_ALLOWED
+
+        # The first bad byte of each value decides its reason
+        error_idx = np.flatnonzero(error)
+        error_owner, first = np.unique(owner[error_idx], return_index=True)
+        reasons[error_owner] = error[error_idx[first]]
+
+        decoded_lens = lens - 2 * np.bincount(owner[valid],
+                                              minlength=num_values)
+        too_long = (reasons == REASON_NOT_CANCELLED) & (decoded_lens > max_lens)
+        reasons[too_long] = REASON_PARAM_LEN_EXCEEDED
+        return reasons
+
+    def simulate(self, requests):
+        """
+        Returns (page ids, cancel reasons) of requests, a list of (user,
+        method, target) tuples
+        """
+        num_requests = len(requests)
+        page_ids = np.zeros(num_requests, np.int64)
+        reasons = np.zeros(num_requests, np.int8)
+        auth_reasons = np.zeros(num_requests, np.int8)
+        csrf_reasons = np.zeros(num_requests, np.int8)
+
+        # (request, value, max_len, whitelist id, name reason) of arguments
+        # that are value checked or cancelled by name, in request order
+        args = []
+
+        for i, (user, method, target) in enumerate(requests):
+            path, has_query, query = target.partition('?')
+            page_id = self.page_ids.get(path, 0)
+            page = self.pages[page_id]
+            page_ids[i] = page_id
+
+            # check_request_type() cancels with REASON_INTERNAL_ERROR
+            reason = REASON_NOT_CANCELLED
+            if self.enable_request_type_check:
+                if not page.request_types & HTTP_METHOD_BITS.get(method, 0):
+                    reason = REASON_INTERNAL_ERROR
+            if (reason == REASON_NOT_CANCELLED and
+                    self.enable_dir_traversal_check):
+                reason = self.check_path(path)
+            reasons[i] = reason
+
+            found_csrf_token = False
+            if self.enable_param_checks and has_query:
+                for arg in query.split('&'):
+                    name, _, value = arg.partition('=')
+                    if (self.enable_csrf_protection and
+                            page.receives_csrf_form_action and
+                            name == CSRF_TOKEN_NAME):
+                        # URL arguments are checked before the session is
+                        # looked up, so there is no session to match
+                        found_csrf_token = True
+                        args.append((i, '', 0, 0, REASON_INVALID_CSRF_COOKIE))
+                        continue
+                    match, name_reason = page.match_param(name)
+                    if match is None or not (
+                            self.enable_param_len_check or
+                            self.enable_param_whitelist_check):
+                        if name_reason != REASON_NOT_CANCELLED:
+                            args.append((i, '', 0, 0, name_reason))
+                        continue
+                    args.append((i, value, match[0], match[1], name_reason))
+
+            if (self.enable_authentication_check and page.requires_login
+                    and user == '-'):
+                auth_reasons[i] = REASON_NO_AUTH_HEADER
+            if (self.enable_csrf_protection and page.receives_csrf_form_action
+                    and not found_csrf_token and method != 'POST'
+                    and not page.ignores_missing_csrf_token(
+                        method, self.enable_request_type_check)):
+                csrf_reasons[i] = REASON_INVALID_CSRF_TOKEN
+
+        if args:
+            arg_requests, values, max_lens, whitelist_ids, name_reasons = \
+                zip(*args)
+            value_reasons = self.check_values(
+                values, np.array(whitelist_ids, np.int64),
+                np.array(max_lens, np.int64))
+            name_reasons = np.array(name_reasons, np.int8)
+            arg_reasons = np.where(name_reasons != REASON_NOT_CANCELLED,
+                                   name_reasons, value_reasons)
+
+            # The first cancelled argument of each request decides its reason
+            arg_requests = np.array(arg_requests, np.int64)
+            cancelled = np.flatnonzero(arg_reasons)
+            request_ids, first = np.unique(arg_requests[cancelled],
+                                           return_index=True)
+            query_reasons = np.zeros(num_requests, np.int8)
+            query_reasons[request_ids] = arg_reasons[cancelled[first]]
+            reasons = np.where(reasons != REASON_NOT_CANCELLED, reasons,
+                               query_reasons)
+
+        reasons = np.where(reasons != REASON_NOT_CANCELLED, reasons,
+                           auth_reasons)
+        reasons = np.where(reasons != REASON_NOT_CANCELLED, reasons,
+                           csrf_reasons)
+        return page_ids, reasons
+
+    def simulate_log(self, data):
+        """Returns SimulationResult of access log lines in data"""
+        result = SimulationResult([x.name for x in self.pages])
+        requests = LOG_LINE_RE.findall(data)
+        num_lines = data.count('\n') + (not data.endswith('\n'))
+        result.skipped_lines = num_lines - len(requests)
+
+        # Identical request lines are only evaluated once
+        unique = list(set(requests))
+        index = dict(zip(unique, xrange(len(unique))))
+        counts = np.bincount(map(index.__getitem__, requests),
+                             minlength=len(unique))
+        page_ids, reasons = self.simulate(unique)
+        result.add(page_ids, reasons.astype(np.int64), counts)
+        return result
+
+    def run(self, log_files, jobs=1, chunk_size=1 << 24):
+        """
+        Returns SimulationResult of replaying access log files, reading about
+        chunk_size bytes of lines at a time and simulating chunks in jobs
+        processes
+        """
+        def read_chunks():
+            """Yields chunks of whole lines of log_files"""
+            for log_file in log_files:
+                while True:
+                    lines = log_file.readlines(chunk_size)
+                    if not lines:
+                        break
+                    yield ''.join(lines)
+
+        result = SimulationResult([x.name for x in self.pages])
+        chunks = read_chunks()
+        if jobs == 1:
+            for chunk in chunks:
+                result.merge(self.simulate_log(chunk))
+            return result
+
+        pool = multiprocessing.Pool(jobs, init_worker, (self,))
+        try:
+            while True:
+                # Bound the number of chunks held in memory
+                batch = list(itertools.islice(chunks, 2 * jobs))
+                if not batch:
+                    break
+                for chunk_result in pool.imap_unordered(simulate_log_worker,
+                                                        batch):
+                    result.merge(chunk_result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return result
+
+
+# Simulator of pool worker processes, set by init_worker()
+worker_simulator = None
+
+
+def init_worker(simulator):
+    """Initializes pool worker process with simulator"""
+    global worker_simulator  # pylint: disable=global-statement
+    worker_simulator = simulator
+
+
+def simulate_log_worker(data):
+    """Returns SimulationResult of access log lines in data in pool worker"""
+    return worker_simulator.simulate_log(data)
+
+
+def main():
+    """Main driver function"""
+    args = sys.argv[1:]
+    jobs = multiprocessing.cpu_count()
+    if len(args) >= 2 and args[0] == '--jobs' and args[1].isdigit():
+        jobs = max(int(args[1]), 1)
+        args = args[2:]
+    if len(args) < 2:
+        print ('Usage: %s [--jobs JOBS] CONFIG ACCESS_LOG [ACCESS_LOG...]'
+               % sys.argv[0])
+        sys.exit(1)
+    simulator = PolicySimulator(parse_config(args[0]))
+    log_files = []
+    try:
+        for log_filename in args[1:]:
+            log_files.append(open(log_filename, 'r'))
+        result = simulator.run(log_files, jobs)
+    finally:
+        for log_file in log_files:
+            log_file.close()
+    result.write_report(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
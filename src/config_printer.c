@@ -135,6 +135,8 @@ void print_configuration() {
     print_int_macro(MAX_HEADER_VALUE_LEN);
     print_int_macro(MAX_NUM_SESSIONS);
     print_int_macro(SESSION_LIFE_SECONDS);
+    print_int_macro(MAX_CONNECTIONS);
+    print_int_macro(MAX_PENDING_CONNECTIONS);
 
     printf("\n** Enable Config **\n");
     print_bool_macro(ENABLE_HEADER_FIELD_LEN_CHECK);
@@ -148,6 +150,7 @@ void print_configuration() {
     print_bool_macro(ENABLE_SESSION_TRACKING);
     print_bool_macro(ENABLE_HTTPS);
     print_bool_macro(ENABLE_AUTHENTICATION_CHECK);
+    print_bool_macro(ENABLE_COMPILED_PAGE_CHECKS);
 
     printf("\n** Global Page Defaults **\n");
     print_page_conf(&default_page_conf, 0);
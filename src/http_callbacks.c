@@ -15,6 +15,7 @@
  */
 
 #include "http_callbacks.h"
+#include "http_util.h"
 #include "shim.h"
 #include "config.h"
 #include "log.h"
@@ -56,6 +57,8 @@ int on_headers_complete_cb(http_parser *p) {
     log_trace("***HEADERS COMPLETE***\n");
 
     if (ev_data->type == CLIENT_LISTENER) {
+        /* URL is complete once the headers are */
+        parse_request_target(ev_data);
         do_client_header_complete_checks(ev_data);
     }
 
@@ -73,8 +76,9 @@ int on_message_complete_cb(http_parser *p) {
 
 #if ENABLE_PARAM_CHECKS
     /* Check POST parameters, use http_parser macro */
-    if (ev_data->type == CLIENT_LISTENER && p->method == HTTP_POST) {
-        check_buffer_params(ev_data->body, false, ev_data);
+    if (ev_data->type == CLIENT_LISTENER && p->method == HTTP_POST
+            && !is_conn_cancelled(ev_data)) {
+        finish_post_body_check(ev_data);
     }
 #endif
 
@@ -132,16 +136,6 @@ int on_header_field_cb(http_parser *p, const char *at, size_t length) {
     //log_trace("** Header field: %.*s\n", (int)length, at);
     struct event_data *ev_data = (struct event_data *) p->data;
 
-#if ENABLE_HEADER_FIELD_LEN_CHECK
-    if (ev_data->type == CLIENT_LISTENER && length > MAX_HEADER_FIELD_LEN) {
-        log_info("Blocked request because header field length %zd; "
-                "max is %ld\n",
-                length, (long) MAX_HEADER_FIELD_LEN);
-        cancel_connection(ev_data, REASON_OVERSIZED_HEADER_FIELD);
-        return -1;
-    }
-#endif
-
     update_http_header_pair(ev_data, true, at, length);
 
     if (is_conn_cancelled(ev_data)) {
@@ -156,16 +150,6 @@ int on_header_value_cb(http_parser *p, const char *at, size_t length) {
     //log_trace("** Header value: %.*s\n", (int)length, at);
     struct event_data *ev_data = (struct event_data *) p->data;
 
-#if ENABLE_HEADER_VALUE_LEN_CHECK
-    if (ev_data->type == CLIENT_LISTENER && length > MAX_HEADER_VALUE_LEN) {
-        log_info("Blocked request because header value length %zd; "
-                "max is %ld\n",
-                length, (long) MAX_HEADER_VALUE_LEN);
-        cancel_connection(ev_data, REASON_OVERSIZED_HEADER_VALUE);
-        return -1;
-    }
-#endif
-
     update_http_header_pair(ev_data, false, at, length);
 
     if (is_conn_cancelled(ev_data)) {
@@ -180,10 +164,12 @@ int on_body_cb(http_parser *p, const char *at, size_t length) {
     struct event_data *ev_data = (struct event_data *) p->data;
     if (ev_data->type == CLIENT_LISTENER && p->method == HTTP_POST) {
         /* Need to use http_parser HTTP_POST macro */
-        if (update_bytearray(ev_data->body, at, length, ev_data) < 0) {
+        log_trace("POST Body fragment: \"%.*s\"\n", (int) length, at);
+        check_post_body_fragment(ev_data, (char *) at, length,
+                http_body_is_final(p));
+        if (is_conn_cancelled(ev_data)) {
             return -1;
         }
-        log_trace("POST Body: \"%.*s\"\n", (int) ev_data->body->len, ev_data->body->data);
     }
 #endif
 
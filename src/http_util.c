@@ -14,42 +14,141 @@
  * limitations under the License.
  */
 
+#include <ctype.h>
 #include "shim.h"
 #include "http_util.h"
 #include "net_util.h"
+#include "session.h"
 #include "log.h"
 
 
 char *error_page_buf = NULL;
 size_t error_page_len;
 
+/* Complete error responses (headers and page), assembled by init_error_page()
+ * so that sending one is a single writev() */
+#define ERROR_RESPONSE_IOV_LEN 2
+static struct iovec forbidden_response_iov[ERROR_RESPONSE_IOV_LEN] = {
+    {HTTP_RESPONSE_FORBIDDEN, sizeof(HTTP_RESPONSE_FORBIDDEN) - 1},
+    {NULL, 0},
+};
+static struct iovec unauthorized_response_iov[ERROR_RESPONSE_IOV_LEN] = {
+    {HTTP_UNAUTHORIZED, sizeof(HTTP_UNAUTHORIZED) - 1},
+    {NULL, 0},
+};
+
 /* Sends a error page back on a socket given a client ev_data.
  * Returns 0 on success, -1 otherwise */
 int send_error_page(struct event_data *ev_data) {
     struct fd_ctx *fd_ctx = ev_data->listen_fd;
     cancel_reason_t reason = ev_data->cancel_reason;
 
-    char *headers = NULL;
-    size_t headers_len = 0;
+    struct iovec *response;
 
     /* Choose response */
     log_dbg("Reason: %s\n", REASON_NAME(reason));
     if (cancel_reason_requires_auth(reason)) {
-        headers = HTTP_UNAUTHORIZED;
-        headers_len = sizeof(HTTP_UNAUTHORIZED) - 1;
+        response = unauthorized_response_iov;
     } else {
-        headers = HTTP_RESPONSE_FORBIDDEN;
-        headers_len = sizeof(HTTP_RESPONSE_FORBIDDEN) - 1;
+        response = forbidden_response_iov;
     }
 
     /* Send response */
-    if (sendall(fd_ctx, headers, headers_len) < 0) {
-        return -1;
+    return sendall_iov(fd_ctx, response, ERROR_RESPONSE_IOV_LEN);
+}
+
+/* Points the error response templates at the loaded error page */
+static void init_error_responses() {
+    forbidden_response_iov[1].iov_base = error_page_buf;
+    forbidden_response_iov[1].iov_len = error_page_len;
+    unauthorized_response_iov[1].iov_base = error_page_buf;
+    unauthorized_response_iov[1].iov_len = error_page_len;
+}
+
+/* Returns whether byte c ends a ".." path segment as far as the server may be
+ * concerned. Servers commonly resolve "..;" (Tomcat path parameters), and may
+ * stop at a NUL or trim trailing whitespace, so "..;x", "..\0" and ".. " count
+ * as "..". */
+static bool ends_dot_dot(unsigned char c) {
+    return c == ';' || c == '\0' || isspace(c);
+}
+
+/* Tokenizes the complete request URL in a single pass, recording the path and
+ * query spans and the boundaries of each query argument in ev_data->target.
+ * Path segments are URL decoded while scanning; a segment that decodes to
+ * "..", or to ".." followed by a byte for which ends_dot_dot() holds, is
+ * flagged as directory traversal. Decoded slashes and backslashes separate
+ * segments, since the server may treat them as such. */
+void parse_request_target(struct event_data *ev_data) {
+    struct request_target *t = &ev_data->target;
+    char *url = ev_data->url->data;
+    size_t len = ev_data->url->len;
+    /* segment_dots counts dots among the first two bytes of the segment */
+    size_t i, segment_len = 0, segment_dots = 0;
+    unsigned char c;
+
+    memset(t, 0, sizeof(*t));
+
+    /* Path */
+    for (i = 0; i < len && url[i] != '?'; i++) {
+        c = url[i];
+        if (c == '%') { /* URL encoded byte */
+            if (i + 2 < len && url_decode_hex_pair(url + i + 1, &c) == 0) {
+                i += 2;
+            } else {
+                t->invalid_path_encoding = true;
+            }
+        }
+
+        if (c == '/' || c == '\\') {
+            if (segment_len == 2 && segment_dots == 2) {
+                t->is_dir_traversal = true;
+            }
+            segment_len = 0;
+            segment_dots = 0;
+        } else {
+            if (segment_len < 2) {
+                segment_dots += (c == '.');
+            } else if (segment_len == 2 && segment_dots == 2
+                    && ends_dot_dot(c)) {
+                t->is_dir_traversal = true;
+            }
+            segment_len++;
+        }
     }
-    if (sendall(fd_ctx, error_page_buf, error_page_len) < 0) {
-        return -1;
+    if (segment_len == 2 && segment_dots == 2) {
+        t->is_dir_traversal = true;
+    }
+    t->path_len = i;
+
+    if (i == len) {
+        log_trace("URL has no parameters\n");
+        return;
+    }
+
+    /* Query arguments, which are separated by '&' */
+    t->has_query = true;
+    t->query_offset = i + 1;
+
+    size_t arg_start = t->query_offset;
+    while (true) {
+        char *amp = memchr(url + arg_start, '&', len - arg_start);
+        size_t arg_end = amp ? (size_t) (amp - url) : len;
+
+        if (t->num_args == MAX_URL_ARGS) {
+            t->args_overflow = true;
+            t->unrecorded_args_offset = arg_start;
+            break;
+        }
+        t->args[t->num_args].offset = arg_start;
+        t->args[t->num_args].len = arg_end - arg_start;
+        t->num_args++;
+
+        if (amp == NULL) {
+            break;
+        }
+        arg_start = arg_end + 1;
     }
-    return 0;
 }
 
 /* Converts http_parser method to shim method. Returns 0 if not valid. */
@@ -73,6 +172,7 @@ int init_error_page(char *error_page_file) {
         }
         memcpy(error_page_buf, DEFAULT_ERROR_PAGE_STR, error_page_len);
 
+        init_error_responses();
         return 0;
     } else {
         FILE *f = fopen(error_page_file, "r");
@@ -114,6 +214,7 @@ int init_error_page(char *error_page_file) {
             perror("fclose");
             goto error;
         }
+        init_error_responses();
         return 0;
 error:
         if (f != NULL) {
@@ -125,39 +226,45 @@ error:
 }
 
 /* Returns whether NUL terminated string and URL encoded buffer are equal.
- * Sets is_valid to false if the string is not valid URL encoding. */
+ * Sets is_valid to false only if a malformed percent escape is reached. A well
+ * formed escape of a different byte is just a mismatch, so checking a name
+ * against several strings has the same outcome in any order. */
 bool str_to_url_encoded_memeq(const char *str, char *url_data,
         size_t url_data_len, bool *is_valid) {
-    int byte;
+    unsigned char byte;
     char *url_data_end = url_data + url_data_len;
     char *str_should_end = (char *) (str + url_data_len);
+
+    if (is_valid) {
+        *is_valid = true;
+    }
+
     while (*str && url_data < url_data_end) {
         if (*str == *url_data) {
             str++;
             url_data++;
             url_data_len--;
         } else if (*url_data == '%') { /* Percent encoded */
-            if (url_data_len >= 3 && sscanf(url_data + 1, "%02x", &byte) == 1
-                    && byte == *str) {
-                str++;
-                str_should_end -= 2;  // Account for miscalculating before
-                url_data += 3;
-                url_data_len -= 3;
-            } else {
+            if (url_data_len < 3
+                    || url_decode_hex_pair(url_data + 1, &byte) < 0) {
                 /* Invalid percent encoding */
                 if (is_valid) {
                     *is_valid = false;
                 }
                 return false;
             }
+            if (byte != (unsigned char) *str) {
+                return false;
+            }
+            str++;
+            str_should_end -= 2;  // Account for miscalculating before
+            url_data += 3;
+            url_data_len -= 3;
         } else {
             return false;
         }
     }
 
-    if (is_valid) {
-        *is_valid = true;
-    }
     return str == str_should_end && *str == '\0';
 }
 
@@ -294,18 +401,31 @@ int send_http_headers(struct event_data *ev_data) {
         header_len_estimate -= rc;
     }
 
-    /* Add last newline */
-    if (header_len_estimate < newline_len) {
-        goto error;
+    /* Headers are followed by the Set-Cookie header and the last newline */
+    struct iovec iov[1 + SET_COOKIE_IOV_LEN + 1];
+    int iovcnt = 0;
+
+    iov[iovcnt].iov_base = send_buf;
+    iov[iovcnt].iov_len = send_buf_len;
+    iovcnt++;
+
+#if ENABLE_SESSION_TRACKING
+    if (ev_data->type == SERVER_LISTENER) {
+        if (add_set_cookie_header(ev_data, &iov[iovcnt]) < 0) {
+            free(send_buf);
+            return -1;
+        }
+        iovcnt += SET_COOKIE_IOV_LEN;
     }
-    memcpy(p, ev_data->http_msg_newline, newline_len);
-    p += newline_len;
-    send_buf_len += newline_len;
-    header_len_estimate -= newline_len;
+#endif
+
+    iov[iovcnt].iov_base = ev_data->http_msg_newline;
+    iov[iovcnt].iov_len = newline_len;
+    iovcnt++;
 
     /* Send buffer */
     log_trace("Sending header buffer\n");
-    if (sendall(ev_data->send_fd, send_buf, send_buf_len) < 0) {
+    if (sendall_iov(ev_data->send_fd, iov, iovcnt) < 0) {
         goto error;
     }
 
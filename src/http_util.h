@@ -63,6 +63,17 @@
     "WWW-Authenticate: Basic realm=\"" BASIC_AUTH_REALM "\"" CRLF \
     CRLF
 
+/* Sent without reading the request when over MAX_CONNECTIONS */
+#define HTTP_SERVICE_UNAVAILABLE \
+    "HTTP/1.0 503 Service Unavailable" CRLF \
+    "Content-type: text/html" CRLF \
+    "Content-Length: 60" CRLF \
+    "Cache-Control: no-cache, no-store, must-revalidate" CRLF \
+    "Connection: close" CRLF \
+    "Retry-After: 1" CRLF \
+    CRLF \
+    "<html><body><h1>503 Service Unavailable</h1></body></html>" CRLF
+
 #define DEFAULT_ERROR_PAGE_STR \
     "<html>" \
     "<head>" \
@@ -78,6 +89,30 @@
 #define BASIC_AUTH_PREFIX "Basic "
 #define BASIC_AUTH_PREFIX_LEN (sizeof(BASIC_AUTH_PREFIX) - 1)
 
+/* Returns value of hex digit, or -1 if c is not a hex digit */
+static inline int hex_digit_value(char c) {
+    if ('0' <= c && c <= '9') {
+        return c - '0';
+    } else if ('a' <= c && c <= 'f') {
+        return c - 'a' + 10;
+    } else if ('A' <= c && c <= 'F') {
+        return c - 'A' + 10;
+    }
+    return -1;
+}
+
+/* Decodes the two hex digits at p (following a '%') into byte. Returns 0 on
+ * success, -1 if either character is not a hex digit. */
+static inline int url_decode_hex_pair(const char *p, unsigned char *byte) {
+    int high = hex_digit_value(p[0]);
+    int low = hex_digit_value(p[1]);
+    if (high < 0 || low < 0) {
+        return -1;
+    }
+    *byte = (unsigned char) ((high << 4) | low);
+    return 0;
+}
+
 /* Global variables */
 extern char *error_page_buf;
 extern size_t error_page_len;
@@ -86,6 +121,7 @@ struct event_data;
 struct fd_ctx;
 
 /* HTTP utility functions */
+void parse_request_target(struct event_data *ev_data);
 int send_error_page(struct event_data *ev_data);
 int http_parser_method_to_shim(enum http_method method);
 int init_error_page(char *error_page_file);
@@ -0,0 +1,322 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdarg.h>
+#include <stdatomic.h>
+#include <stdbool.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <signal.h>
+#include <pthread.h>
+#include "config.h"
+#include "log.h"
+
+#if ENABLE_HTTPS
+#include <openssl/err.h>
+#endif
+
+static const char *log_level_prefix[] = {
+    [LOG_LEVEL_TRACE] = "[trace] ",
+    [LOG_LEVEL_DBG] = "[ dbg ] ",
+    [LOG_LEVEL_INFO] = "[info ] ",
+    [LOG_LEVEL_WARN] = "[warn ] ",
+    [LOG_LEVEL_ERROR] = "[error] ",
+};
+
+/* Single producer, single consumer ring. The event loop fills slots at
+ * ring_tail and the writer drains them from ring_head. */
+static struct log_record ring[LOG_RING_SLOTS];
+static atomic_size_t ring_head;
+static atomic_size_t ring_tail;
+static atomic_uint ring_dropped;
+
+static bool log_async = false;
+static bool writer_started = false;
+static atomic_bool writer_stop;
+static pthread_t writer_thread;
+
+/* The writer sleeps on writer_wake while the ring is empty, with
+ * writer_waiting set so that publishing only signals a sleeping writer */
+static pthread_mutex_t writer_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t writer_wake = PTHREAD_COND_INITIALIZER;
+static atomic_bool writer_waiting;
+
+/* Returns coarse monotonic time in seconds */
+static time_t log_now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC_COARSE, &ts);
+    return ts.tv_sec;
+}
+
+/* Returns whether a record from call site may be logged now. On success, sets
+ * suppressed to the number of records from the site dropped since the last
+ * one logged. */
+static bool log_rate_allow(struct log_rate_site *site, uint32_t *suppressed) {
+    time_t now = log_now();
+
+    if (now - site->window_start >= LOG_RATE_INTERVAL_SEC) {
+        site->window_start = now;
+        site->count = 0;
+    }
+
+    if (site->count >= LOG_RATE_BURST) {
+        site->suppressed++;
+        return false;
+    }
+    site->count++;
+    *suppressed = site->suppressed;
+    site->suppressed = 0;
+    return true;
+}
+
+/* Returns next free ring slot, or NULL if the record is rate limited or the
+ * ring is full */
+static struct log_record *log_record_begin(struct log_rate_site *site,
+        log_level_t level) {
+    uint32_t suppressed = 0;
+    if (!log_rate_allow(site, &suppressed)) {
+        return NULL;
+    }
+
+    size_t tail = atomic_load_explicit(&ring_tail, memory_order_relaxed);
+    size_t head = atomic_load_explicit(&ring_head, memory_order_acquire);
+    if (tail - head >= LOG_RING_SLOTS) {
+        atomic_fetch_add(&ring_dropped, 1 + suppressed);
+        return NULL;
+    }
+
+    struct log_record *rec = &ring[tail & (LOG_RING_SLOTS - 1)];
+    rec->level = level;
+    rec->suppressed = suppressed;
+    rec->len = 0;
+    return rec;
+}
+
+/* Appends formatted text to record, truncating to LOG_MSG_MAX_LEN */
+static void log_record_vappend(struct log_record *rec, const char *fmt,
+        va_list ap) {
+    size_t avail = LOG_MSG_MAX_LEN - rec->len;
+    int n = vsnprintf(rec->msg + rec->len, avail, fmt, ap);
+    if (n < 0) {
+        return;
+    }
+    if (n >= avail) {
+        /* Mark truncated message */
+        rec->len = LOG_MSG_MAX_LEN - 1;
+        memcpy(rec->msg + rec->len - 4, "...\n", 4);
+    } else {
+        rec->len += n;
+    }
+}
+
+/* Makes record visible to the writer, waking it if it is asleep */
+static void log_record_publish() {
+    size_t tail = atomic_load_explicit(&ring_tail, memory_order_relaxed);
+    atomic_store_explicit(&ring_tail, tail + 1, memory_order_release);
+
+    /* Either the writer sees the new tail before sleeping, or we see it
+     * waiting; see log_writer_main() */
+    atomic_thread_fence(memory_order_seq_cst);
+    if (atomic_load_explicit(&writer_waiting, memory_order_relaxed)) {
+        pthread_mutex_lock(&writer_lock);
+        pthread_cond_signal(&writer_wake);
+        pthread_mutex_unlock(&writer_lock);
+    }
+}
+
+/* Writes record to out */
+static void log_record_write(FILE *out, const struct log_record *rec) {
+    fputs(log_level_prefix[rec->level], out);
+    if (rec->suppressed == 0) {
+        fwrite(rec->msg, 1, rec->len, out);
+        return;
+    }
+    size_t len = rec->len;
+    if (len > 0 && rec->msg[len - 1] == '\n') {
+        len--;
+    }
+    fprintf(out, "%.*s [%u similar messages suppressed]\n", (int) len,
+            rec->msg, rec->suppressed);
+}
+
+/* Logs message at level from call site. Queues it when the writer is running,
+ * and writes it directly otherwise. */
+void log_submit(struct log_rate_site *site, log_level_t level,
+        const char *fmt, ...) {
+    va_list ap;
+
+    if (!log_async) {
+        va_start(ap, fmt);
+        fputs(log_level_prefix[level], stdout);
+        vfprintf(stdout, fmt, ap);
+        va_end(ap);
+        fflush(stdout);
+        return;
+    }
+
+    struct log_record *rec = log_record_begin(site, level);
+    if (rec == NULL) {
+        return;
+    }
+    va_start(ap, fmt);
+    log_record_vappend(rec, fmt, ap);
+    va_end(ap);
+    log_record_publish();
+}
+
+#if ENABLE_HTTPS
+/* Appends printf style text to record */
+static void log_record_append(struct log_record *rec, const char *fmt, ...) {
+    va_list ap;
+    va_start(ap, fmt);
+    log_record_vappend(rec, fmt, ap);
+    va_end(ap);
+}
+#endif
+
+/* Logs error from call site followed by the OpenSSL error queue of the calling
+ * thread */
+void log_submit_ssl(struct log_rate_site *site, const char *fmt, ...) {
+    va_list ap;
+
+    if (!log_async) {
+        va_start(ap, fmt);
+        fputs(log_level_prefix[LOG_LEVEL_ERROR], stdout);
+        vfprintf(stdout, fmt, ap);
+        va_end(ap);
+#if ENABLE_HTTPS
+        ERR_print_errors_fp(stdout);
+#endif
+        fflush(stdout);
+        return;
+    }
+
+    struct log_record *rec = log_record_begin(site, LOG_LEVEL_ERROR);
+    if (rec == NULL) {
+#if ENABLE_HTTPS
+        ERR_clear_error();
+#endif
+        return;
+    }
+    va_start(ap, fmt);
+    log_record_vappend(rec, fmt, ap);
+    va_end(ap);
+
+#if ENABLE_HTTPS
+    /* The error queue is thread local, so format it here */
+    unsigned long err;
+    char err_buf[120];
+    while ((err = ERR_get_error()) != 0) {
+        ERR_error_string_n(err, err_buf, sizeof(err_buf));
+        log_record_append(rec, "%s\n", err_buf);
+    }
+#endif
+    log_record_publish();
+}
+
+/* Writes queued records to out. Must only be called from one thread at a
+ * time. Returns number of records written. */
+size_t log_drain(FILE *out) {
+    size_t head = atomic_load_explicit(&ring_head, memory_order_relaxed);
+    size_t tail = atomic_load_explicit(&ring_tail, memory_order_acquire);
+    size_t num = tail - head;
+
+    for (; head != tail; head++) {
+        log_record_write(out, &ring[head & (LOG_RING_SLOTS - 1)]);
+        atomic_store_explicit(&ring_head, head + 1, memory_order_release);
+    }
+
+    unsigned int dropped = atomic_exchange(&ring_dropped, 0);
+    if (dropped > 0) {
+        fprintf(out, "%sLog ring full; dropped %u messages\n",
+                log_level_prefix[LOG_LEVEL_WARN], dropped);
+    }
+
+    if (num > 0 || dropped > 0) {
+        fflush(out);
+    }
+    return num;
+}
+
+/* Returns whether the ring has records for the writer */
+static bool log_ring_pending() {
+    return atomic_load(&ring_tail) != atomic_load(&ring_head);
+}
+
+/* Background writer; drains the ring, sleeping while it is empty */
+static void *log_writer_main(void *arg) {
+    while (!atomic_load(&writer_stop)) {
+        log_drain(stdout);
+
+        pthread_mutex_lock(&writer_lock);
+        atomic_store(&writer_waiting, true);
+        /* Pairs with the fence in log_record_publish() */
+        while (!log_ring_pending() && !atomic_load(&writer_stop)) {
+            pthread_cond_wait(&writer_wake, &writer_lock);
+        }
+        atomic_store(&writer_waiting, false);
+        pthread_mutex_unlock(&writer_lock);
+    }
+    return NULL;
+}
+
+/* Starts queueing log records without starting the writer thread; records
+ * are written by log_drain() */
+void log_enable_async() {
+    log_async = true;
+}
+
+/* Starts background writer thread. Signals are blocked in the writer so they
+ * are delivered to the event loop. Returns 0 on success, -1 otherwise. */
+int log_start_writer() {
+    sigset_t all_signals, old_signals;
+    int rc;
+
+    if (writer_started) {
+        return 0;
+    }
+
+    atomic_store(&writer_stop, false);
+    sigfillset(&all_signals);
+    pthread_sigmask(SIG_BLOCK, &all_signals, &old_signals);
+    rc = pthread_create(&writer_thread, NULL, log_writer_main, NULL);
+    pthread_sigmask(SIG_SETMASK, &old_signals, NULL);
+    if (rc != 0) {
+        log_error("Could not start log writer thread\n");
+        return -1;
+    }
+
+    writer_started = true;
+    log_enable_async();
+    atexit(log_stop_writer);
+    return 0;
+}
+
+/* Stops writer thread, if started, and writes remaining records. Later
+ * records are written synchronously. */
+void log_stop_writer() {
+    if (writer_started) {
+        pthread_mutex_lock(&writer_lock);
+        atomic_store(&writer_stop, true);
+        pthread_cond_signal(&writer_wake);
+        pthread_mutex_unlock(&writer_lock);
+        pthread_join(writer_thread, NULL);
+        writer_started = false;
+    }
+    log_drain(stdout);
+    log_async = false;
+}
@@ -18,22 +18,72 @@
 #define SHIM_LOG_H
 
 #include <stdio.h>
+#include <stdint.h>
+#include <time.h>
 
-/* Logging macros */
+/* Log records are queued in a ring drained by a background writer thread
+ * (see log_start_writer()), so logging on the event loop does no I/O. Each
+ * call site is rate limited to LOG_RATE_BURST records per
+ * LOG_RATE_INTERVAL_SEC; suppressed records are counted and reported with the
+ * next record from the same call site. Before the writer is started, and in
+ * DEBUG builds, records are written synchronously and never suppressed. */
+
+#define LOG_RING_SLOTS 256 /* Must be a power of 2 */
+#define LOG_MSG_MAX_LEN 200
+#define LOG_RATE_BURST 10
+#define LOG_RATE_INTERVAL_SEC 1
+
+typedef enum {
+    LOG_LEVEL_TRACE = 0,
+    LOG_LEVEL_DBG,
+    LOG_LEVEL_INFO,
+    LOG_LEVEL_WARN,
+    LOG_LEVEL_ERROR
+} log_level_t;
+
+/* Rate limiting state of a call site; only touched by the logging thread */
+struct log_rate_site {
+    time_t window_start;
+    uint32_t count;
+    uint32_t suppressed;
+};
+
+/* Queued log record */
+struct log_record {
+    uint32_t suppressed;
+    uint16_t len;
+    uint8_t level;
+    char msg[LOG_MSG_MAX_LEN];
+};
+
+void log_submit(struct log_rate_site *site, log_level_t level,
+        const char *fmt, ...) __attribute__((format(printf, 3, 4)));
+void log_submit_ssl(struct log_rate_site *site, const char *fmt, ...)
+        __attribute__((format(printf, 2, 3)));
+size_t log_drain(FILE *out);
+void log_enable_async();
+int log_start_writer();
+void log_stop_writer();
+
+/* Logging macros. Each use is a call site with its own rate limit. */
+
+#define log_at_site(submit, args...) do { \
+        static struct log_rate_site log_site; \
+        submit(&log_site, args); \
+    } while (0)
 
 #ifdef DEBUG
-#define log_trace(args...) fprintf(stdout, "[trace] " args); fflush(stdout)
-#define log_dbg(args...) fprintf(stdout, "[ dbg ] " args); fflush(stdout)
+#define log_trace(args...) log_at_site(log_submit, LOG_LEVEL_TRACE, args)
+#define log_dbg(args...) log_at_site(log_submit, LOG_LEVEL_DBG, args)
 #define TRACE
 #else
 #define log_trace(msg, args...) ;
 #define log_dbg(msg, args...) ;
 #endif
 
-#define log_warn(args...) fprintf(stdout, "[warn ] " args); fflush(stdout)
-#define log_info(args...) fprintf(stdout, "[info ] " args); fflush(stdout)
-#define log_error(args...) fprintf(stdout, "[error] " args); fflush(stdout)
-#define log_ssl_error(args...) fprintf(stdout, "[error] " args); \
-    ERR_print_errors_fp(stdout); fflush(stdout)
+#define log_warn(args...) log_at_site(log_submit, LOG_LEVEL_WARN, args)
+#define log_info(args...) log_at_site(log_submit, LOG_LEVEL_INFO, args)
+#define log_error(args...) log_at_site(log_submit, LOG_LEVEL_ERROR, args)
+#define log_ssl_error(args...) log_at_site(log_submit_ssl, args)
 
 #endif
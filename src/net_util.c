@@ -15,6 +15,9 @@
  */
 
 #include <sys/socket.h>
+#include <sys/uio.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
 #include <netdb.h>
 #include <fcntl.h>
 #include <string.h>
@@ -140,6 +143,41 @@ int make_socket_non_blocking(int sfd) {
     return 0;
 }
 
+/* Disables Nagle's algorithm, so that the last segment of a response is not
+ * held back waiting for the peer's delayed ACK */
+int set_tcp_nodelay(int sfd) {
+    int yes = 1;
+
+    if (setsockopt(sfd, IPPROTO_TCP, TCP_NODELAY, &yes, sizeof(yes)) == -1) {
+        perror("setsockopt");
+        return -1;
+    }
+    return 0;
+}
+
+/* Sets TCP_CORK on socket. While corked, the kernel only sends full
+ * segments; uncorking sends whatever is queued. */
+int set_tcp_cork(int sfd, bool cork) {
+    int val = cork;
+
+    if (setsockopt(sfd, IPPROTO_TCP, TCP_CORK, &val, sizeof(val)) == -1) {
+        perror("setsockopt");
+        return -1;
+    }
+    return 0;
+}
+
+/* Returns true if fd_ctx holds decrypted data that has not been read yet, which
+ * epoll cannot report */
+bool fd_ctx_has_pending(struct fd_ctx *fd_ctx) {
+#if ENABLE_HTTPS
+    if (fd_ctx->is_tls) {
+        return SSL_pending(fd_ctx->ssl) > 0;
+    }
+#endif
+    return false;
+}
+
 /* Send entire buffer over socket, using multiple sends if necessary */
 int sendall(struct fd_ctx *fd_ctx, const void *buf, size_t len) {
     int sent_bytes;
@@ -201,6 +239,80 @@ int sendall(struct fd_ctx *fd_ctx, const void *buf, size_t len) {
     return 0;
 }
 
+/* Sends all of the iovcnt buffers in iov with as few writev() calls as
+ * possible. The iov array is not modified, so it may be a shared template.
+ * TLS has no scatter/gather write, so buffers that fit in
+ * SENDALL_IOV_TLS_BUF_LEN are copied together and sent as one record, and
+ * larger responses are written one buffer at a time.
+ * Returns 0 on success, -1 otherwise. */
+int sendall_iov(struct fd_ctx *fd_ctx, const struct iovec *iov, int iovcnt) {
+    ssize_t sent_bytes;
+
+    if (fd_ctx == NULL) {
+        log_error("Passed NULL fd_ctx in sendall_iov()\n");
+        return -1;
+    }
+
+#if ENABLE_HTTPS
+    if (fd_ctx->is_tls) {
+        char buf[SENDALL_IOV_TLS_BUF_LEN];
+        size_t len = 0;
+        int i;
+
+        for (i = 0; i < iovcnt; i++) {
+            len += iov[i].iov_len;
+        }
+        if (len <= sizeof(buf)) {
+            len = 0;
+            for (i = 0; i < iovcnt; i++) {
+                memcpy(buf + len, iov[i].iov_base, iov[i].iov_len);
+                len += iov[i].iov_len;
+            }
+            return sendall(fd_ctx, buf, len);
+        }
+
+        log_dbg("Response of %zd bytes sent one buffer at a time\n", len);
+        for (; iovcnt > 0; iov++, iovcnt--) {
+            if (sendall(fd_ctx, iov->iov_base, iov->iov_len) < 0) {
+                return -1;
+            }
+        }
+        return 0;
+    }
+#endif
+
+    /* Plain HTTP */
+    while (iovcnt > 0) {
+        sent_bytes = writev(fd_ctx->sock_fd, iov, iovcnt);
+        if (sent_bytes < 0) {
+            if (errno == EAGAIN) {
+                log_dbg("Got EAGAIN during sendall_iov; retrying\n");
+                continue;
+            }
+            perror("writev");
+            return -1;
+        }
+
+        /* Skip buffers that were completely sent */
+        while (iovcnt > 0 && (size_t) sent_bytes >= iov->iov_len) {
+            sent_bytes -= iov->iov_len;
+            iov++;
+            iovcnt--;
+        }
+
+        /* Finish partially sent buffer */
+        if (sent_bytes > 0) {
+            if (sendall(fd_ctx, (char *) iov->iov_base + sent_bytes,
+                        iov->iov_len - sent_bytes) < 0) {
+                return -1;
+            }
+            iov++;
+            iovcnt--;
+        }
+    }
+    return 0;
+}
+
 /* Reads from fd_ctx into bufffer of given length. Sets eagain if to whether
  * EAGAIN was returned by send (or equivalent for SSL).
  * Returns number of bytes read on successful read; returns int < 0 otherwise.
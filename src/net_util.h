@@ -17,15 +17,23 @@
 #ifndef NET_UTIL_H
 #define NET_UTIL_H
 
+#include <sys/uio.h>
 #include "shim_struct.h"
 
 struct fd_ctx;
 
+/* Largest response that sendall_iov() sends over TLS with one SSL_write() */
+#define SENDALL_IOV_TLS_BUF_LEN 4096
+
 /* Network functions */
 int make_socket_non_blocking(int sfd);
+int set_tcp_nodelay(int sfd);
+int set_tcp_cork(int sfd, bool cork);
+bool fd_ctx_has_pending(struct fd_ctx *fd_ctx);
 int create_and_bind(char *port);
 int create_and_connect(char *port);
 int sendall(struct fd_ctx *fd_ctx, const void *buf, size_t len);
+int sendall_iov(struct fd_ctx *fd_ctx, const struct iovec *iov, int iovcnt);
 int fd_ctx_read(struct fd_ctx *fd_ctx, char *buf, size_t len, bool *eagain);
 int close_fd_if_valid(int fd);
 
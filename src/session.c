@@ -358,80 +358,40 @@ int get_num_active_sessions() {
     return num_sessions;
 }
 
-/* Writes Set-Cookie header to buf. Returns the length of the cookie header
- * on success, -1 otherwise. */
-int populate_set_cookie_header_value(char *buf, size_t buf_len,
-        struct event_data *ev_data) {
+/* Set-Cookie header template, the session ID hole is filled in by
+ * add_set_cookie_header() */
+static char set_cookie_sessid[SHIM_SESSID_LEN];
+static const struct iovec set_cookie_iov_template[SET_COOKIE_IOV_LEN] = {
+    [SET_COOKIE_IOV_PREFIX] = {SET_COOKIE_HEADER_PREFIX,
+        sizeof(SET_COOKIE_HEADER_PREFIX) - 1},
+    [SET_COOKIE_IOV_SESSID] = {set_cookie_sessid, SHIM_SESSID_LEN},
+    [SET_COOKIE_IOV_SUFFIX] = {SET_COOKIE_HEADER_SUFFIX,
+        sizeof(SET_COOKIE_HEADER_SUFFIX) - 1},
+    [SET_COOKIE_IOV_SECURE] = {SECURE_COOKIE_SUFFIX, 0},
+    [SET_COOKIE_IOV_NEWLINE] = {NULL, 0},
+};
+
+/* Fills the SET_COOKIE_IOV_LEN entries of iov with the session Set-Cookie
+ * header line. Returns 0 on success, -1 otherwise. */
+int add_set_cookie_header(struct event_data *ev_data, struct iovec *iov) {
     struct session *sess = get_conn_session(ev_data->conn_info);
     if (sess == NULL) {
         log_error("Could not allocate new session\n");
         cancel_connection(ev_data, REASON_INTERNAL_ERROR);
         return -1;
     }
-    char *token = sess->session_id;
-    log_dbg("Sending SESSION_ID: %s\n", token);
+    log_dbg("Sending SESSION_ID: %s\n", sess->session_id);
 
-    char *secure_suffix = ev_data->send_fd->is_tls ? SECURE_COOKIE_SUFFIX : "";
-    int output_len = snprintf(buf, buf_len, SET_COOKIE_HEADER_VALUE_FORMAT,
-            token, secure_suffix);
-    if (output_len >= buf_len || output_len < 0) {
-        return -1;
-    }
-
-    return output_len;
-}
-
-/* Add session Set-Cookie header. Returns 0 on success, -1 otherwise. */
-int add_set_cookie_header(struct event_data *ev_data) {
-    bytearray_t *header_value = NULL;
-    bytearray_t *header_field = NULL;
-
-    char set_cookie_header_value[ESTIMATED_SET_COOKIE_HEADER_VALUE_LEN + 10];
-
-    int set_cookie_header_value_len = populate_set_cookie_header_value(
-            set_cookie_header_value, sizeof(set_cookie_header_value), ev_data);
-    if (set_cookie_header_value_len < 0) {
-        goto error;
-    }
-
-    /* Create header value */
-    header_value = bytearray_new();
-    if (header_value == NULL) {
-        goto error;
-    }
-
-    if (update_bytearray(header_value, set_cookie_header_value,
-            set_cookie_header_value_len, ev_data) < 0) {
-        goto error;
-    }
-
-    /* Create header field */
-    header_field = bytearray_new();
-    if (header_field == NULL) {
-        goto error;
-    }
-
-    if (update_bytearray(header_field, SET_COOKIE_HEADER_FIELD,
-            SET_COOKIE_HEADER_FIELD_STRLEN, ev_data) < 0) {
-        goto error;
-    }
+    memcpy(iov, set_cookie_iov_template, sizeof(set_cookie_iov_template));
+    memcpy(set_cookie_sessid, sess->session_id, SHIM_SESSID_LEN);
 
-    /* Add Set-Cookie field and value */
-    if (struct_array_add(ev_data->all_header_fields, header_field) < 0) {
-        goto error;
-    }
-    header_field = NULL;
-    if (struct_array_add(ev_data->all_header_values, header_value) < 0) {
-        goto error;
+    if (ev_data->send_fd->is_tls) {
+        iov[SET_COOKIE_IOV_SECURE].iov_len = sizeof(SECURE_COOKIE_SUFFIX) - 1;
     }
-    header_value = NULL;
+    iov[SET_COOKIE_IOV_NEWLINE].iov_base = ev_data->http_msg_newline;
+    iov[SET_COOKIE_IOV_NEWLINE].iov_len = strlen(ev_data->http_msg_newline);
 
     return 0;
-
-error:
-    bytearray_free(header_value);
-    cancel_connection(ev_data, REASON_INTERNAL_ERROR);
-    return -1;
 }
 
 /* Updates stored Content-Length. Returns -1 on failure */
@@ -17,6 +17,7 @@
 #ifndef SESSION_H
 #define SESSION_H
 
+#include <sys/uio.h>
 #include "shim.h"
 #include "http_util.h"
 #include "config.h"
@@ -29,61 +30,50 @@
 
 #define SET_COOKIE_HEADER_FIELD "Set-Cookie"
 #define SET_COOKIE_HEADER_FIELD_STRLEN (sizeof(SET_COOKIE_HEADER_FIELD) - 1)
-#define SET_COOKIE_HEADER_VALUE_FORMAT \
-        SHIM_SESSID_NAME "=%s; " \
-        "max-age=" XSTR(SESSION_LIFE_SECONDS) "; " \
-        "path=/%s"
-#define SECURE_COOKIE_SUFFIX "; secure"
 
-#define ESTIMATED_SET_COOKIE_HEADER_VALUE_LEN \
-    (sizeof(SET_COOKIE_HEADER_VALUE_FORMAT) + sizeof(SECURE_COOKIE_SUFFIX) \
-            + SHIM_SESSID_LEN)
+/* Set-Cookie header line is sent as the following pieces, with the session ID
+ * and the newline of the message filled in per response */
+#define SET_COOKIE_HEADER_PREFIX \
+        SET_COOKIE_HEADER_FIELD ": " SHIM_SESSID_NAME "="
+#define SET_COOKIE_HEADER_SUFFIX \
+        "; max-age=" XSTR(SESSION_LIFE_SECONDS) "; path=/"
+#define SECURE_COOKIE_SUFFIX "; secure"
+enum set_cookie_iov_idx {
+    SET_COOKIE_IOV_PREFIX,
+    SET_COOKIE_IOV_SESSID,
+    SET_COOKIE_IOV_SUFFIX,
+    SET_COOKIE_IOV_SECURE,
+    SET_COOKIE_IOV_NEWLINE,
+    SET_COOKIE_IOV_LEN
+};
 
 #define MAX_HTTP_RESPONSE_HEADERS_SIZE 8096
 
-#define COOKIE_HEADER "Cookie"
-#define COOKIE_HEADER_STRLEN (sizeof(COOKIE_HEADER) - 1)
-
-#define CONTENT_LENGTH_HEADER "Content-Length"
-#define CONTENT_LENGTH_HEADER_STRLEN \
-    (sizeof(CONTENT_LENGTH_HEADER) - 1)
-
-#define TRANSFER_ENCODING_HEADER "Transfer-Encoding"
-#define TRANSFER_ENCODING_HEADER_STRLEN \
-    (sizeof(TRANSFER_ENCODING_HEADER) - 1)
-
-#define TE_HEADER "TE"
-#define TE_HEADER_STRLEN (sizeof(TE_HEADER) - 1)
-
 #define CHUNKED "chunked"
 #define CHUNKED_STRLEN (sizeof(CHUNKED) - 1)
 
-#define TRAILERS "Trailers"
-#define TRAILERS_STRLEN (sizeof(TRAILERS) - 1)
-
-#define CONTENT_ENCODING_HEADER "Content-Encoding"
-#define CONTENT_ENCODING_HEADER_STRLEN \
-    (sizeof(CONTENT_ENCODING_HEADER) - 1)
-
 
 
 #define CSRF_TOKEN_NAME "_umbra_csrf_token"
 #define CSRF_TOKEN_NAME_LEN (sizeof(CSRF_TOKEN_NAME) - 1)
 
-#define INSERT_HIDDEN_TOKEN_JS_FORMAT \
+/* The session ID is inserted between the prefix and suffix */
+#define INSERT_HIDDEN_TOKEN_JS_PREFIX \
     "\n<script>" \
     "var input = document.createElement(\"input\");" \
     "input.setAttribute(\"type\", \"hidden\");" \
     "input.setAttribute(\"name\", \"" CSRF_TOKEN_NAME "\");" \
-    "input.setAttribute(\"value\", \"%s\");" \
+    "input.setAttribute(\"value\", \""
+#define INSERT_HIDDEN_TOKEN_JS_SUFFIX \
+    "\");" \
     "var forms = document.getElementsByTagName('form');" \
     "for (var i = 0, length = forms.length; i < length; i ++) {" \
     "  forms[i].appendChild(input);" \
     "}" \
     "</script>\n"
 #define INSERT_HIDDEN_TOKEN_JS_STRLEN \
-    (sizeof(INSERT_HIDDEN_TOKEN_JS_FORMAT) + SHIM_SESSID_LEN - 3)
-    /* Minus 1 for NUL byte, Minus 2 for the "%s" which is replace */
+    (sizeof(INSERT_HIDDEN_TOKEN_JS_PREFIX) - 1 + SHIM_SESSID_LEN \
+            + sizeof(INSERT_HIDDEN_TOKEN_JS_SUFFIX) - 1)
 
 struct session {
     char session_id[SHIM_SESSID_LEN + 1];
@@ -114,7 +104,7 @@ struct session *search_session(char *sess_id);
 void expire_sessions();
 bool is_session_expired(struct session *s);
 int get_num_active_sessions();
-int add_set_cookie_header(struct event_data *ev_data);
+int add_set_cookie_header(struct event_data *ev_data, struct iovec *iov);
 int update_original_content_length(struct event_data *ev_data);
 int64_t get_original_content_length(struct event_data *ev_data);
 int set_new_content_length(struct event_data *ev_data);
@@ -14,6 +14,8 @@
  * limitations under the License.
  */
 
+#define _GNU_SOURCE /* accept4() */
+
 #include <inttypes.h>
 #include <getopt.h>
 #include <errno.h>
@@ -30,6 +32,7 @@
 #include "net_util.h"
 #include "shim_struct.h"
 #include "config_printer.h"
+#include "whitelist_scan.h"
 #include "log.h"
 
 char *shim_http_port_str = NULL, *server_http_port_str = NULL;
@@ -71,20 +74,15 @@ http_parser_settings server_parser_settings = {
 };
 
 /*
- * Attempts to find matching page conf. If it cannot find one, it returns a
- * pointer to the default page conf structure.
+ * Attempts to find matching page conf for URL path (which does not include the
+ * query). If it cannot find one, it returns a pointer to the default page conf
+ * structure.
  */
 struct page_conf *url_find_matching_page(char *url, size_t len) {
     // @Todo(Travis) Implement trie search
 
     int i;
 
-    /* Account for possible URL parameters */
-    char *amp_loc = memchr(url, '?', len);
-    if (amp_loc) {
-        len = amp_loc - url;
-    }
-
     for (i = 0; i < PAGES_CONF_LEN; i++) {
         if (len == strlen(pages_conf[i].name)
                 && memcmp(url, pages_conf[i].name, len) == 0) {
@@ -112,7 +110,6 @@ int check_header_pair(struct event_data *ev_data) {
     char *value = ev_data->header_value->data;
     size_t field_len = ev_data->header_field->len;
     size_t value_len = ev_data->header_value->len;
-    (void) value_len;
 
     /* NUL terminate header field and value */
     if (bytearray_append(ev_data->header_field, "\0", 1) < 0) {
@@ -127,37 +124,49 @@ int check_header_pair(struct event_data *ev_data) {
     log_trace("Header: \"%s\": \"%s\"\n", ev_data->header_field->data,
             ev_data->header_value->data);
 
+    header_class_t header_class = classify_header(field, field_len, value_len,
+            ev_data->type == CLIENT_LISTENER);
 
-    if (ev_data->type == CLIENT_LISTENER) {
-        /* Request only Headers */
+    switch (header_class) {
+    case HEADER_FIELD_OVERSIZED:
+        log_info("Blocked request because header field length %zd; "
+                "max is %ld\n", field_len, (long) MAX_HEADER_FIELD_LEN);
+        cancel_connection(ev_data, REASON_OVERSIZED_HEADER_FIELD);
+        return -1;
+
+    case HEADER_VALUE_OVERSIZED:
+        log_info("Blocked request because header value length %zd; "
+                "max is %ld\n", value_len, (long) MAX_HEADER_VALUE_LEN);
+        cancel_connection(ev_data, REASON_OVERSIZED_HEADER_VALUE);
+        return -1;
 
 #if ENABLE_SESSION_TRACKING
-        /* Handle Cookie header */
-        if (field_len == COOKIE_HEADER_STRLEN
-                && strcasecmp(COOKIE_HEADER, field) == 0) {
+    case HEADER_COOKIE:
+        /* Request only header */
+        if (ev_data->type == CLIENT_LISTENER) {
             log_trace("Found Cookie header\n");
             /* Set pointer to cookie value */
             ev_data->cookie_header_value_ref = ev_data->header_value;
         }
+        break;
 #endif
 
-    } else {
-        /* Response only Headers */
-    }
-
-
-    /* Request or Response headers */
+#if ENABLE_AUTHENTICATION_CHECK
+    case HEADER_AUTHORIZATION:
+        /* Request only header */
+        if (ev_data->type == CLIENT_LISTENER) {
+            ev_data->auth_header_value_ref = ev_data->header_value;
+        }
+        break;
+#endif
 
     /* With session tracking, we inject a JS snippet, so we need to understand
      * how the body is sent. Otherwise, we do not care how the body is encoded.
      * The exception is chunked transfer encoding with trailers, which may
      * include additional headers.
      */
-    if ((field_len == TRANSFER_ENCODING_HEADER_STRLEN
-            && strcasecmp(TRANSFER_ENCODING_HEADER, field) == 0)
-            || (field_len == TE_HEADER_STRLEN
-                    && strcasecmp(TE_HEADER, field) == 0)) {
-
+    case HEADER_TRANSFER_ENCODING:
+    case HEADER_TE:
         if (value_len == CHUNKED_STRLEN && strcasecmp(CHUNKED, value) == 0) {
             /* Only chunked encoding is allowed */
 #if ENABLE_SESSION_TRACKING
@@ -175,21 +184,19 @@ int check_header_pair(struct event_data *ev_data) {
             log_warn("Transfer-Encoding \"%s\" is not supported\n", value);
             goto error;
         }
+        break;
 
-    } else if (field_len == TRAILERS_STRLEN
-            && strcasecmp(TRAILERS, field) == 0) {
+    case HEADER_TRAILERS:
         log_warn("Trailers not supported for chunked encoding\n");
         goto error;
-    }
+
 #if ENABLE_SESSION_TRACKING
-    else if (field_len == CONTENT_ENCODING_HEADER_STRLEN
-            && strcasecmp(CONTENT_ENCODING_HEADER, field) == 0) {
+    case HEADER_CONTENT_ENCODING:
         /* Warn against Content-Encoding */
         log_warn("Content-Encoding \"%s\" is not supported\n", value);
         goto error;
 
-    } else if (field_len == CONTENT_LENGTH_HEADER_STRLEN
-            && strcasecmp(CONTENT_LENGTH_HEADER, field) == 0) {
+    case HEADER_CONTENT_LENGTH:
         /* Handle Content-Length */
         log_dbg("Content-Length specified\n");
         ev_data->content_length_specified = true;
@@ -206,9 +213,13 @@ int check_header_pair(struct event_data *ev_data) {
             goto error;
 
         }
-    }
+        break;
 #endif
 
+    default:
+        break;
+    }
+
     /* Add header field and value to list of all header pairs */
     rc = struct_array_add(ev_data->all_header_fields,
             ev_data->header_field);
@@ -259,8 +270,29 @@ void update_http_header_pair(struct event_data *ev_data, bool is_header_field,
 
     if (is_header_field) {
         ba = ev_data->header_field;
+#if ENABLE_HEADER_FIELD_LEN_CHECK
+        /* Reject before buffering; classify_header() checks the final length */
+        if (ev_data->type == CLIENT_LISTENER
+                && ba->len + length > MAX_HEADER_FIELD_LEN) {
+            log_info("Blocked request because header field length %zd; "
+                    "max is %ld\n", ba->len + length,
+                    (long) MAX_HEADER_FIELD_LEN);
+            cancel_connection(ev_data, REASON_OVERSIZED_HEADER_FIELD);
+            return;
+        }
+#endif
     } else {
         ba = ev_data->header_value;
+#if ENABLE_HEADER_VALUE_LEN_CHECK
+        if (ev_data->type == CLIENT_LISTENER
+                && ba->len + length > MAX_HEADER_VALUE_LEN) {
+            log_info("Blocked request because header value length %zd; "
+                    "max is %ld\n", ba->len + length,
+                    (long) MAX_HEADER_VALUE_LEN);
+            cancel_connection(ev_data, REASON_OVERSIZED_HEADER_VALUE);
+            return;
+        }
+#endif
     }
 
     update_bytearray(ba, at, length, ev_data);
@@ -268,101 +300,205 @@ void update_http_header_pair(struct event_data *ev_data, bool is_header_field,
 }
 
 
-/* Handle a new incoming connection */
-int handle_new_connection(int efd, struct epoll_event *ev, int sfd,
-        bool is_tls) {
-    int s;
-    struct epoll_event client_event = {0}, server_event = {0};
-    struct connection_info *conn_info;
-    char *server_port_str = is_tls ? server_tls_port_str : server_http_port_str;
+#ifdef TRACE
+/* Logs address of accepted connection */
+static void log_trace_peer(int infd, struct sockaddr *in_addr,
+        socklen_t in_len) {
+    char hbuf[NI_MAXHOST], sbuf[NI_MAXSERV];
 
-    while (1) {
-        struct sockaddr in_addr;
-        socklen_t in_len;
-        int infd = 0, outfd = 0;
-        char hbuf[NI_MAXHOST], sbuf[NI_MAXSERV];
+    if (getnameinfo(in_addr, in_len, hbuf, sizeof(hbuf), sbuf, sizeof(sbuf),
+            NI_NUMERICHOST | NI_NUMERICSERV) != 0) {
+        log_trace("Accepted connection on descriptor %d\n", infd);
+        return;
+    }
+    log_trace("Accepted connection on descriptor %d (host=%s, port=%s)\n",
+            infd, hbuf, sbuf);
+}
+#endif
 
-        in_len = sizeof(in_addr);
-        infd = accept(sfd, &in_addr, &in_len);
-        if (infd == -1) {
-            if ((errno == EAGAIN) || (errno == EWOULDBLOCK)) {
-                /* We have processed all incoming
-                 connections. */
-                break;
-            } else {
-                perror("accept");
-                break;
-            }
-        }
+/* Sheds connection accepted over MAX_CONNECTIONS without allocating a
+ * connection_info. HTTP clients get a canned 503; TLS clients are closed,
+ * since answering would require a handshake. */
+void reject_connection(int infd, bool is_tls) {
+    static const char response[] = HTTP_SERVICE_UNAVAILABLE;
+    char discard[1024];
 
-        s = getnameinfo(&in_addr, in_len, hbuf, sizeof(hbuf), sbuf,
-                sizeof(sbuf),
-                NI_NUMERICHOST | NI_NUMERICSERV);
-        if (s < 0) {
-            perror("getnameinfo");
-            goto error;
+    log_info("Rejected connection; %d connections open, max is %d\n",
+            num_conn_infos, MAX_CONNECTIONS);
+
+    if (!is_tls) {
+        /* Consume request bytes that already arrived, so that closing the
+         * socket does not reset the connection before the 503 is read */
+        while (recv(infd, discard, sizeof(discard), MSG_DONTWAIT) > 0) {
+        }
+        /* Best effort; the socket buffer of a new connection is empty */
+        if (send(infd, response, sizeof(response) - 1,
+                MSG_DONTWAIT | MSG_NOSIGNAL) < 0) {
+            log_dbg("Could not send 503 response\n");
         }
+    }
+    close(infd);
+}
 
-        log_trace("Accepted connection on descriptor %d (host=%s, port=%s)\n",
-                infd, hbuf, sbuf);
+/* Connects accepted client socket infd to the server and adds both to the
+ * epoll set. Returns 0 on success, -1 otherwise; infd is closed on failure. */
+int add_new_connection(int efd, int infd, bool is_tls) {
+    int s, outfd = -1;
+    struct epoll_event client_event = {0}, server_event = {0};
+    struct connection_info *conn_info;
+    char *server_port_str = is_tls ? server_tls_port_str : server_http_port_str;
 
-        /* Make the incoming socket non-blocking and add it to the
-         list of fds to monitor. */
-        s = make_socket_non_blocking(infd);
-        if (s < 0) {
-            log_error("Could not make new socket non-blocking\n");
-            goto error;
-        }
+    /* Create proxy socket to server */
+    outfd = create_and_connect(server_port_str);
+    if (outfd < 0) {
+        goto error;
+    }
 
-        /* Create proxy socket to server */
-        outfd = create_and_connect(server_port_str);
-        if (outfd < 0) {
-            goto error;
-        }
+    s = make_socket_non_blocking(outfd);
+    if (s < 0) {
+        log_error("Could not make forward socket non-blocking\n");
+        goto error;
+    }
 
-        s = make_socket_non_blocking(outfd);
-        if (s < 0) {
-            log_error("Could not make forward socket non-blocking\n");
-            goto error;
-        }
+    /* Writes are coalesced with TCP_CORK, so Nagle only delays responses */
+    if (set_tcp_nodelay(infd) < 0 || set_tcp_nodelay(outfd) < 0) {
+        goto error;
+    }
 
-        /* Allocate data */
-        conn_info = init_conn_info(infd, outfd, is_tls, is_tls);
-        if (conn_info == NULL) {
-            log_error("init_conn_info() failed\n");
-            goto error;
-        }
-        infd = 0;
-        outfd = 0;
+    /* Allocate data */
+    conn_info = init_conn_info(infd, outfd, is_tls, is_tls);
+    if (conn_info == NULL) {
+        log_error("init_conn_info() failed\n");
+        goto error;
+    }
 
+    client_event.data.ptr = conn_info->client_ev_data;
+    client_event.events = EPOLLIN | EPOLLET;
 
-        client_event.data.ptr = conn_info->client_ev_data;
-        client_event.events = EPOLLIN | EPOLLET;
+    server_event.data.ptr = conn_info->server_ev_data;
+    server_event.events = EPOLLIN | EPOLLET;
 
-        server_event.data.ptr = conn_info->server_ev_data;
-        server_event.events = EPOLLIN | EPOLLET;
+    s = epoll_ctl(efd, EPOLL_CTL_ADD,
+            conn_info->client_ev_data->listen_fd->sock_fd, &client_event);
+    if (s == -1) {
+        perror("epoll_ctl");
+        free_connection_info(conn_info);
+        return -1;
+    }
 
-        s = epoll_ctl(efd, EPOLL_CTL_ADD,
-                conn_info->client_ev_data->listen_fd->sock_fd, &client_event);
-        if (s == -1) {
-            perror("epoll_ctl");
-            goto error;
-        }
+    s = epoll_ctl(efd, EPOLL_CTL_ADD,
+            conn_info->server_ev_data->listen_fd->sock_fd, &server_event);
+    if (s == -1) {
+        perror("epoll_ctl");
+        /* Closing the client socket removes it from the epoll set */
+        free_connection_info(conn_info);
+        return -1;
+    }
 
-        s = epoll_ctl(efd, EPOLL_CTL_ADD,
-                conn_info->server_ev_data->listen_fd->sock_fd, &server_event);
-        if (s == -1) {
-            perror("epoll_ctl");
-            goto error;
-        }
+    return 0;
 
 error:
     close_fd_if_valid(infd);
     close_fd_if_valid(outfd);
     return -1;
+}
+
+/* Descriptor held in reserve, given up to shed a pending connection when out
+ * of file descriptors */
+static int spare_fd = -1;
+
+/* Opens spare_fd unless it is already open. Returns 0 on success, -1 with
+ * errno set otherwise. */
+int open_spare_fd() {
+    if (spare_fd < 0) {
+        spare_fd = open("/dev/null", O_RDONLY | O_CLOEXEC);
+    }
+    return spare_fd < 0 ? -1 : 0;
+}
+
+/* Sheds a pending connection on sfd when accept4() fails with EMFILE or
+ * ENFILE, by closing spare_fd to accept it, and then reopens spare_fd.
+ * Returns 0 if a connection was shed, -1 with errno set by accept4()
+ * otherwise. */
+int shed_connection_with_spare_fd(int sfd, bool is_tls) {
+    int infd, accept_errno;
+
+    if (spare_fd < 0 && open_spare_fd() < 0) {
+        errno = EMFILE;
+        return -1;
     }
+    close(spare_fd);
+    spare_fd = -1;
 
-    return 0;
+    infd = accept4(sfd, NULL, NULL, SOCK_NONBLOCK | SOCK_CLOEXEC);
+    accept_errno = errno;
+    if (infd >= 0) {
+        reject_connection(infd, is_tls);
+    }
+
+    open_spare_fd();
+    errno = accept_errno;
+    return infd >= 0 ? 0 : -1;
+}
+
+/* Accepts all pending connections on listening socket sfd. Connections over
+ * MAX_CONNECTIONS, or that arrive while out of file descriptors, are shed
+ * with reject_connection(). Returns 0 once the backlog is drained, -1 on an
+ * unexpected accept error. */
+int handle_new_connection(int efd, struct epoll_event *ev, int sfd,
+        bool is_tls) {
+    while (1) {
+        int infd;
+#ifdef TRACE
+        struct sockaddr_storage in_addr;
+        socklen_t in_len = sizeof(in_addr);
+
+        infd = accept4(sfd, (struct sockaddr *) &in_addr, &in_len,
+                SOCK_NONBLOCK | SOCK_CLOEXEC);
+#else
+        infd = accept4(sfd, NULL, NULL, SOCK_NONBLOCK | SOCK_CLOEXEC);
+#endif
+        if (infd == -1) {
+            switch (errno) {
+            case EAGAIN:
+#if EAGAIN != EWOULDBLOCK
+            case EWOULDBLOCK:
+#endif
+                /* We have processed all incoming connections */
+                return 0;
+            case EINTR:
+            case ECONNABORTED:
+                continue;
+            case EMFILE:
+            case ENFILE:
+                log_warn("Out of file descriptors; lower max_connections\n");
+                if (shed_connection_with_spare_fd(sfd, is_tls) == 0) {
+                    continue;
+                }
+                if (errno == EAGAIN || errno == EWOULDBLOCK) {
+                    return 0;
+                }
+                /* No descriptor to spare; the listener is edge triggered,
+                 * so queue another event to retry the pending
+                 * connections */
+                return rearm_read_event(efd, ev);
+            default:
+                perror("accept4");
+                return -1;
+            }
+        }
+
+#ifdef TRACE
+        log_trace_peer(infd, (struct sockaddr *) &in_addr, in_len);
+#endif
+
+        if (num_conn_infos >= MAX_CONNECTIONS) {
+            reject_connection(infd, is_tls);
+            continue;
+        }
+
+        add_new_connection(efd, infd, is_tls);
+    }
 }
 
 /* Check HTTP request types */
@@ -437,13 +573,26 @@ int check_char_whitelist(const char *whitelist, const char c,
 }
 
 /* Calculates the number of bytes are in the URL decoded data and checks
- * whether each byte is allowed by the whitelist. */
+ * whether each byte is allowed by the whitelist. Runs of allowed bytes are
+ * skipped in bulk with whitelist_scan, which stops at '%' and at bytes that
+ * are not allowed. */
 size_t url_encode_buf_len_whitelist(char *data, size_t len,
-        struct event_data *ev_data, const char *whitelist) {
+        struct event_data *ev_data, const char *whitelist,
+        const char *whitelist_scan) {
     size_t ret_len = len;
     char *data_end = data + len;
     char byte;
     while (data < data_end) {
+#if ENABLE_PARAM_WHITELIST_CHECK
+        data += whitelist_scan_run(whitelist_scan, data, data_end - data);
+#else
+        char *percent = memchr(data, '%', data_end - data);
+        data = percent ? percent : data_end;
+#endif
+        if (data >= data_end) {
+            break;
+        }
+
         if (*data == '%') { /* URL encoded byte */
             if (data + 2 < data_end && sscanf(data + 1, "%02hhx", &byte) == 1) {
                 data += 3;
@@ -483,7 +632,7 @@ bool whitelist_char_allowed(const char *whitelist, const char x) {
 void check_arg_len_whitelist(struct params *param, char *value,
         size_t value_len, struct event_data *ev_data) {
     size_t url_decode_len = url_encode_buf_len_whitelist(value, value_len,
-            ev_data, param->whitelist);
+            ev_data, param->whitelist, param->whitelist_scan);
     log_dbg("  decode_len=%zd\n", url_decode_len);
     if (url_decode_len > param->max_param_len) {
         log_warn("Length of parameter value \"%.*s\" %zd exceeds max %d\n",
@@ -492,6 +641,31 @@ void check_arg_len_whitelist(struct params *param, char *value,
     }
 }
 
+#if ENABLE_CSRF_PROTECTION
+/* Check value of CSRF token argument against the session id */
+void check_csrf_token_arg(struct event_data *ev_data, char *value,
+        size_t value_len) {
+    /* Check that valid session cookie was sent */
+    if (!ev_data->conn_info->session) {
+        log_warn("Request did not have a valid session cookie, which "
+                "is required on pages that receive CSRF form action\n");
+        cancel_connection(ev_data, REASON_INVALID_CSRF_COOKIE);
+        return;
+    }
+
+    /* Check that CSRF token matches SESSION_ID */
+    if (SHIM_SESSID_LEN != value_len
+            || memcmp(value, ev_data->conn_info->session->session_id,
+            SHIM_SESSID_LEN) != 0) {
+        log_warn("Invalid CSRF token found\n");
+        cancel_connection(ev_data, REASON_INVALID_CSRF_TOKEN);
+    } else {
+        log_trace("Correct CSRF token found\n");
+        ev_data->found_csrf_correct_token = true;
+    }
+}
+#endif
+
 /* Perform argument specific checks */
 void check_single_arg(struct event_data *ev_data, char *arg, size_t len) {
     log_dbg("arg=\"%.*s\", len=%zd\n", (int) len, arg, len);
@@ -509,36 +683,31 @@ void check_single_arg(struct event_data *ev_data, char *arg, size_t len) {
     log_dbg("  name=\"%.*s\" len=%zd, value=\"%.*s\" len=%zd\n", (int) name_len,
             name, name_len, (int) value_len, value, value_len);
 
-    struct page_conf *page_match = ev_data->conn_info->page_match;
+#if ENABLE_COMPILED_PAGE_CHECKS
+    /* Run checks generated for the matched page by parse_config.py */
+    ev_data->conn_info->page_match->check_arg(ev_data, name, name_len, value,
+            value_len);
+#else
+    check_page_arg(ev_data, name, name_len, value, value_len);
+#endif
+}
 
 #if ENABLE_CSRF_PROTECTION
-    /* Check if argument is CSRF token */
-    if (page_match->receives_csrf_form_action
+/* Returns whether name is the CSRF token argument of the matched page */
+bool is_csrf_token_arg(struct event_data *ev_data, const char *name,
+        size_t name_len) {
+    return ev_data->conn_info->page_match->receives_csrf_form_action
             && name_len == CSRF_TOKEN_NAME_LEN
-            && memcmp(name, CSRF_TOKEN_NAME, CSRF_TOKEN_NAME_LEN) == 0) {
-
-        /* Check that valid session cookie was sent */
-        if (!ev_data->conn_info->session) {
-            log_warn("Request did not have a valid session cookie, which "
-                    "is required on pages that receive CSRF form action\n");
-            cancel_connection(ev_data, REASON_INVALID_CSRF_COOKIE);
-            return;
-        }
-
-        /* Check that CSRF token matches SESSION_ID */
-        if (SHIM_SESSID_LEN != value_len
-                || memcmp(value, ev_data->conn_info->session->session_id,
-                SHIM_SESSID_LEN) != 0) {
-            log_warn("Invalid CSRF token found\n");
-            cancel_connection(ev_data, REASON_INVALID_CSRF_TOKEN);
-        } else {
-            log_trace("Correct CSRF token found\n");
-            ev_data->found_csrf_correct_token = true;
-        }
-        return;
-    }
+            && memcmp(name, CSRF_TOKEN_NAME, CSRF_TOKEN_NAME_LEN) == 0;
+}
 #endif
 
+/* Returns the param config of the matched page that applies to the (URL
+ * encoded) argument name, or NULL if the connection was cancelled */
+struct params *match_page_param(struct event_data *ev_data, char *name,
+        size_t name_len) {
+    struct page_conf *page_match = ev_data->conn_info->page_match;
+
     struct params *param = find_matching_param(name, name_len,
             page_match->params, page_match->params_len, ev_data);
 
@@ -546,38 +715,63 @@ void check_single_arg(struct event_data *ev_data, char *arg, size_t len) {
         if (page_match->restrict_params) {
             log_warn("Parameter sent when not allowed\n");
             cancel_connection(ev_data, REASON_PARAM_NOT_ALLOWED);
-            return;
+            return NULL;
         } else {
             param = &ev_data->conn_info->default_params;
         }
     }
     log_trace("Using param \"%s\"\n", param->name ? param->name : "default");
+    return param;
+}
+
+/* Check argument name and value by interpreting the matched page config */
+void check_page_arg(struct event_data *ev_data, char *name, size_t name_len,
+        char *value, size_t value_len) {
+#if ENABLE_CSRF_PROTECTION
+    /* Check if argument is CSRF token */
+    if (is_csrf_token_arg(ev_data, name, name_len)) {
+        check_csrf_token_arg(ev_data, value, value_len);
+        return;
+    }
+#endif
+
+    struct params *param = match_page_param(ev_data, name, name_len);
+    if (param == NULL) {
+        return;
+    }
 
 #if ENABLE_PARAM_LEN_CHECK || ENABLE_PARAM_WHITELIST_CHECK
     check_arg_len_whitelist(param, value, value_len, ev_data);
 #endif
 }
 
-/* Check parameters passed in the URL */
-void check_buffer_params(bytearray_t *buf, bool is_url_param,
-        struct event_data *ev_data) {
-    log_trace("Checking %s parameters\n", is_url_param ? "URL" : "POST");
-    char *query;
-    size_t query_len;
-
-    if (is_url_param) {
-        char *quest = memchr(buf->data, '?', buf->len);
-        if (quest == NULL) {
-            log_trace("URL has no parameters\n");
-            return;
-        }
-        query = quest + 1;
-        query_len = buf->len - (query - buf->data);
-    } else {
-        query = buf->data;
-        query_len = buf->len;
+/* Check parameters passed in the URL, using the argument boundaries found by
+ * parse_request_target() */
+void check_url_params(struct event_data *ev_data) {
+    log_trace("Checking URL parameters\n");
+    struct request_target *t = &ev_data->target;
+    char *url = ev_data->url->data;
+    int i;
+
+    if (!t->has_query) {
+        log_trace("URL has no parameters\n");
+        return;
     }
 
+    for (i = 0; i < t->num_args; i++) {
+        check_single_arg(ev_data, url + t->args[i].offset, t->args[i].len);
+    }
+
+    if (t->args_overflow) {
+        /* Split arguments that did not fit in the array */
+        check_query_args(url + t->unrecorded_args_offset,
+                ev_data->url->len - t->unrecorded_args_offset, ev_data);
+    }
+}
+
+/* Check each "&" separated argument of a query */
+void check_query_args(char *query, size_t query_len,
+        struct event_data *ev_data) {
     if (query_len <= 0) {
         log_trace("Empty query\n");
     }
@@ -602,43 +796,258 @@ void check_buffer_params(bytearray_t *buf, bool is_url_param,
     }
 }
 
-/* Cancels connection if url contains ".." */
-#if ENABLE_URL_DIRECTORY_TRAVERSAL_CHECK
-void check_url_dir_traversal(struct event_data *ev_data) {
-    log_trace("Checking URL for directory traversal attack\n");
-    char *data = ev_data->url->data;
-    int num_dots = 0;
-    char byte;
-    char *data_end;
-
-    /* Do not look at URL parameters */
-    char *quest = memchr(data, '?', ev_data->url->len);
-    data_end = (quest ? quest : data + ev_data->url->len);
+/* Longest parameter name of any page, or CSRF token name, set by
+ * init_page_conf(). A URL encoded name longer than 3 times this cannot match
+ * any parameter. */
+static size_t max_param_name_len = 0;
 
+/* Checks the value bytes of a POST argument that spans body fragments against
+ * the length and whitelist of form_scan.param as they arrive */
+void check_form_value_fragment(struct event_data *ev_data, const char *data,
+        size_t len) {
+#if ENABLE_PARAM_LEN_CHECK || ENABLE_PARAM_WHITELIST_CHECK
+    struct form_scan *scan = &ev_data->form_scan;
+    struct params *param = scan->param;
+    const char *data_end = data + len;
+    unsigned char byte;
+    size_t run;
 
     while (data < data_end) {
-        if (*data == '%') { /* URL encoded byte */
-            if (data + 2 < data_end && sscanf(data + 1, "%02hhx", &byte) == 1) {
-                if (byte == '.') {
-                    num_dots++;
-                }
-                data += 3;
-            } else {
+        if (scan->escape_len > 0) {
+            /* Continue URL encoded byte */
+            scan->escape[scan->escape_len - 1] = *data++;
+            if (++scan->escape_len < 3) {
+                continue;
+            }
+            scan->escape_len = 0;
+            if (url_decode_hex_pair(scan->escape, &byte) < 0) {
                 log_warn("Invalid URL encoding found during length check\n");
                 cancel_connection(ev_data, REASON_INVALID_HTTP);
+                return;
             }
+            scan->value_len++;
+#if ENABLE_PARAM_WHITELIST_CHECK
+            if (check_char_whitelist(param->whitelist, byte, ev_data) < 0) {
+                return;
+            }
+#endif
+            continue;
+        }
+
+#if ENABLE_PARAM_WHITELIST_CHECK
+        run = whitelist_scan_run(param->whitelist_scan, data, data_end - data);
+#else
+        const char *percent = memchr(data, '%', data_end - data);
+        run = (percent ? percent : data_end) - data;
+#endif
+        scan->value_len += run;
+        data += run;
+        if (data >= data_end) {
+            break;
+        }
+
+        if (*data == '%') {
+            scan->escape_len = 1;
         } else {
-            if (*data == '.') {
-                num_dots++;
+#if ENABLE_PARAM_WHITELIST_CHECK
+            if (check_char_whitelist(param->whitelist, *data, ev_data) < 0) {
+                return;
             }
-            data++;
+#endif
+            scan->value_len++;
         }
+        data++;
+    }
 
-        if (num_dots >= 2) {
-            log_warn("Possible URL directory traversal blocked\n");
-            cancel_connection(ev_data, REASON_DIR_TRAVERSAL);
+    if (scan->value_len > param->max_param_len) {
+        log_warn("Length of parameter value %zd exceeds max %d\n",
+                scan->value_len, param->max_param_len);
+        cancel_connection(ev_data, REASON_PARAM_LEN_EXCEEDED);
+    }
+#endif
+}
+
+/* Starts checking the value of a POST argument that spans body fragments,
+ * once the whole name has been seen */
+void start_form_value(struct event_data *ev_data) {
+    struct form_scan *scan = &ev_data->form_scan;
+    bytearray_t *name = ev_data->partial_arg;
+
+    if (scan->name_overflow) {
+        /* Name is too long to match a parameter */
+        if (ev_data->conn_info->page_match->restrict_params) {
+            log_warn("Parameter sent when not allowed\n");
+            cancel_connection(ev_data, REASON_PARAM_NOT_ALLOWED);
             return;
         }
+        scan->param = &ev_data->conn_info->default_params;
+        scan->state = FORM_SCAN_VALUE;
+        return;
+    }
+
+#if ENABLE_CSRF_PROTECTION
+    if (is_csrf_token_arg(ev_data, name->data, name->len)) {
+        /* Token is kept until complete, then compared */
+        bytearray_clear(name);
+        scan->state = FORM_SCAN_CSRF_TOKEN;
+        return;
+    }
+#endif
+
+    scan->param = match_page_param(ev_data, name->data, name->len);
+    bytearray_clear(name);
+    scan->state = FORM_SCAN_VALUE;
+}
+
+/* Finishes checking the POST argument that spans body fragments */
+void finish_form_arg(struct event_data *ev_data) {
+    struct form_scan *scan = &ev_data->form_scan;
+    bytearray_t *partial = ev_data->partial_arg;
+
+    switch (scan->state) {
+    case FORM_SCAN_NAME:
+        /* Argument without a value */
+        if (scan->name_overflow) {
+            start_form_value(ev_data);
+        } else {
+            check_single_arg(ev_data, partial->data, partial->len);
+        }
+        break;
+    case FORM_SCAN_VALUE:
+        if (scan->escape_len > 0) {
+            log_warn("Invalid URL encoding found during length check\n");
+            cancel_connection(ev_data, REASON_INVALID_HTTP);
+        }
+        break;
+#if ENABLE_CSRF_PROTECTION
+    case FORM_SCAN_CSRF_TOKEN:
+        check_csrf_token_arg(ev_data, partial->data, partial->len);
+        break;
+#endif
+    default:
+        break;
+    }
+
+    bytearray_clear(ev_data->partial_arg);
+    memset(scan, 0, sizeof(*scan));
+}
+
+/* Consumes bytes of a POST argument that spans body fragments, up to and
+ * including the '&' that ends it. Returns the number of bytes consumed. */
+size_t scan_form_partial_arg(struct event_data *ev_data, char *data,
+        size_t len) {
+    struct form_scan *scan = &ev_data->form_scan;
+    bytearray_t *partial = ev_data->partial_arg;
+    size_t n;
+    char *amp;
+
+    if (scan->state == FORM_SCAN_NAME) {
+        /* Name ends at '=' or, if there is no value, at '&' */
+        for (n = 0; n < len && data[n] != '=' && data[n] != '&'; n++) {
+        }
+
+        if (!scan->name_overflow) {
+            if (partial->len + n > 3 * max_param_name_len) {
+                scan->name_overflow = true;
+                bytearray_clear(partial);
+            } else if (update_bytearray(partial, data, n, ev_data) < 0) {
+                return len;
+            }
+        }
+
+        if (n == len) {
+            return len;
+        }
+        if (data[n] == '&') {
+            finish_form_arg(ev_data);
+            return n + 1;
+        }
+        start_form_value(ev_data);
+        return n + 1;
+    }
+
+    amp = memchr(data, '&', len);
+    n = amp ? (size_t) (amp - data) : len;
+
+    if (scan->state == FORM_SCAN_VALUE) {
+        check_form_value_fragment(ev_data, data, n);
+#if ENABLE_CSRF_PROTECTION
+    } else if (scan->state == FORM_SCAN_CSRF_TOKEN) {
+        if (partial->len + n > SHIM_SESSID_LEN) {
+            /* Too long to be a valid token */
+            log_warn("Invalid CSRF token found\n");
+            cancel_connection(ev_data, REASON_INVALID_CSRF_TOKEN);
+            return len;
+        }
+        if (update_bytearray(partial, data, n, ev_data) < 0) {
+            return len;
+        }
+#endif
+    }
+
+    if (amp == NULL) {
+        return len;
+    }
+    finish_form_arg(ev_data);
+    return n + 1;
+}
+
+/* Checks a fragment of an application/x-www-form-urlencoded POST body as it
+ * streams in. Arguments that lie completely within the fragment are checked
+ * in place; only an argument that continues into the next fragment is
+ * carried over in ev_data->form_scan. is_final indicates that the fragment
+ * ends the body. */
+void check_post_body_fragment(struct event_data *ev_data, char *data,
+        size_t len, bool is_final) {
+    struct form_scan *scan = &ev_data->form_scan;
+    char *data_end = data + len;
+    char *amp;
+
+    while (data < data_end && !is_conn_cancelled(ev_data)) {
+        if (scan->state != FORM_SCAN_ARG_START) {
+            data += scan_form_partial_arg(ev_data, data, data_end - data);
+            continue;
+        }
+
+        amp = memchr(data, '&', data_end - data);
+        if (amp != NULL) {
+            check_single_arg(ev_data, data, amp - data);
+            data = amp + 1;
+        } else if (is_final) {
+            check_single_arg(ev_data, data, data_end - data);
+            scan->state = FORM_SCAN_DONE;
+            data = data_end;
+        } else {
+            scan->state = FORM_SCAN_NAME;
+        }
+    }
+}
+
+/* Finishes checking a POST body once the message is complete */
+void finish_post_body_check(struct event_data *ev_data) {
+    if (ev_data->form_scan.state == FORM_SCAN_ARG_START) {
+        /* Empty body or empty last argument */
+        check_single_arg(ev_data, "", 0);
+    } else {
+        finish_form_arg(ev_data);
+    }
+}
+
+/* Cancels connection if a url path segment is "..", as found by
+ * parse_request_target() */
+#if ENABLE_URL_DIRECTORY_TRAVERSAL_CHECK
+void check_url_dir_traversal(struct event_data *ev_data) {
+    log_trace("Checking URL for directory traversal attack\n");
+
+    if (ev_data->target.invalid_path_encoding) {
+        log_warn("Invalid URL encoding found in path\n");
+        cancel_connection(ev_data, REASON_INVALID_HTTP);
+        return;
+    }
+
+    if (ev_data->target.is_dir_traversal) {
+        log_warn("Possible URL directory traversal blocked\n");
+        cancel_connection(ev_data, REASON_DIR_TRAVERSAL);
     }
 }
 #endif
@@ -668,7 +1077,7 @@ int fill_rand_bytes(char *buf, size_t len) {
 void do_client_header_complete_checks(struct event_data *ev_data) {
     ev_data->conn_info->page_match = url_find_matching_page(
             (char *) ev_data->url->data,
-            ev_data->url->len);
+            ev_data->target.path_len);
     log_trace("page_match=\"%s\"\n", ev_data->conn_info->page_match->name);
 
     copy_default_params(ev_data->conn_info->page_match,
@@ -684,7 +1093,7 @@ void do_client_header_complete_checks(struct event_data *ev_data) {
 
 #if ENABLE_PARAM_CHECKS
     /* Check URL parameters */
-    check_buffer_params(ev_data->url, true, ev_data);
+    check_url_params(ev_data);
 #endif
 
 #if ENABLE_SESSION_TRACKING
@@ -717,12 +1126,6 @@ ssize_t read_file_to_buf(char *buf, size_t len, const char *filename) {
 
 #if ENABLE_AUTHENTICATION_CHECK
 
-/* Returns true when Authorization header is found */
-bool is_basic_auth_found(bytearray_t *ba) {
-    const char auth_header_field[] = "Authorization";
-    return strncmp(auth_header_field, ba->data, ba->len) == 0;
-}
-
 /* Prints length and hex encoded string to stdout */
 void print_dbg_str_hex(char *s, size_t len) {
     printf("len=%zd, \"", len);
@@ -743,17 +1146,15 @@ void check_page_auth(struct event_data *ev_data) {
 
     /* Check HTTP Basic Auth headers */
     log_trace("Page requires login, checking Basic Auth...\n");
-    int auth_header_idx = struct_array_find_element_idx_lambda(
-            ev_data->all_header_fields, is_basic_auth_found);
+    bytearray_t *auth_value_ref = ev_data->auth_header_value_ref;
 
-    if (auth_header_idx == -1) {
+    if (auth_value_ref == NULL) {
         /* Could not find Authorization header */
         cancel_connection(ev_data, REASON_NO_AUTH_HEADER);
         return;
     }
 
     /* NUL terminate header value */
-    bytearray_t *auth_value_ref = ev_data->all_header_values->data[auth_header_idx];
     if (bytearray_nul_terminate(auth_value_ref) < 0) {
         cancel_connection(ev_data, REASON_INTERNAL_ERROR);
     }
@@ -846,12 +1247,47 @@ int flush_server_event(struct event_data *server_ev_data) {
     return 0;
 }
 
+/* Adapts read size of ev_data to observed transfer sizes. Grows when a read
+ * fills the buffer, and shrinks when a batch of reads ending in EAGAIN used
+ * little of it. */
+void adapt_read_size(struct event_data *ev_data, size_t count,
+        size_t batch_len, bool eagain) {
+    if (eagain) {
+        if (batch_len < ev_data->read_size / 4
+                && ev_data->read_size > READ_BUF_MIN_SIZE) {
+            ev_data->read_size /= 2;
+        }
+    } else if (count == ev_data->read_size
+            && ev_data->read_size < READ_BUF_MAX_SIZE) {
+        ev_data->read_size *= 2;
+    }
+}
+
+/* Queues a new edge triggered event for socket that still has data after
+ * using up its read budget. Returns 0 on success, -1 otherwise. */
+int rearm_read_event(int efd, struct epoll_event *ev) {
+    struct event_data *ev_data = (struct event_data *) ev->data.ptr;
+    struct epoll_event rearm_event = {0};
+
+    rearm_event.data.ptr = ev_data;
+    rearm_event.events = EPOLLIN | EPOLLET;
+    if (epoll_ctl(efd, EPOLL_CTL_MOD, ev_data->listen_fd->sock_fd,
+            &rearm_event) == -1) {
+        perror("epoll_ctl");
+        return -1;
+    }
+    return 0;
+}
+
 /* Handles incoming client and server requests.
  * Returns boolean indicated if connection is done */
 int handle_client_server_event(struct epoll_event *ev) {
     int done = 0;
     ssize_t count;
-    char buf[READ_BUF_SIZE];
+    /* Data is forwarded before returning, so connections share the buffer */
+    static char buf[READ_BUF_MAX_SIZE];
+    size_t batch_len = 0;
+    bool corked = false;
 
     struct event_data *ev_data = (struct event_data *) ev->data.ptr;
     ev_data->got_eagain = false; // Reset on each handle call
@@ -890,13 +1326,25 @@ int handle_client_server_event(struct epoll_event *ev) {
     }
 
     /* Read into buffer */
+    ev_data->read_budget_exhausted = false;
     while (!done) {
         bool eagain = false;
-        count = fd_ctx_read(ev_data->listen_fd, buf, READ_BUF_SIZE, &eagain);
+
+        if (batch_len >= READ_BUDGET_BYTES
+                && !fd_ctx_has_pending(ev_data->listen_fd)) {
+            /* Let other connections run; handle_event() re-arms the socket */
+            log_dbg("Read budget exhausted\n");
+            ev_data->read_budget_exhausted = true;
+            break;
+        }
+
+        count = fd_ctx_read(ev_data->listen_fd, buf, ev_data->read_size,
+                &eagain);
         if (count < 0) {
             if (eagain) {
                 /* We have read all data for now */
                 log_dbg("Got EAGAIN on read\n");
+                adapt_read_size(ev_data, 0, batch_len, true);
                 ev_data->got_eagain = true;
                 done = 1;
                 break;
@@ -910,8 +1358,13 @@ int handle_client_server_event(struct epoll_event *ev) {
         } else if (count == 0) {
             /* End of file. The remote has closed the connection. */
             done = 1;
+        } else if (!corked) {
+            /* Coalesce everything forwarded for this batch into full
+             * segments; sent when uncorked below */
+            corked = set_tcp_cork(ev_data->send_fd->sock_fd, true) == 0;
         }
-
+        adapt_read_size(ev_data, count, batch_len, false);
+        batch_len += count;
 
         /* Do not have all headers cached yet */
         if (!ev_data->headers_have_been_sent) {
@@ -1014,6 +1467,10 @@ int handle_client_server_event(struct epoll_event *ev) {
     }
 #endif
 
+    if (corked) {
+        set_tcp_cork(ev_data->send_fd->sock_fd, false);
+    }
+
 check_cancelled:
     if (type == CLIENT_LISTENER && is_conn_cancelled(ev_data)) {
         if (send_error_page(ev_data) != 0) {
@@ -1225,11 +1682,44 @@ error:
 #endif
 
 #if ENABLE_CSRF_PROTECTION
+/* CSRF JS snippet template, framed as a chunk for chunked responses. The
+ * session ID hole is filled in by check_send_csrf_js_snippet(). */
+enum js_snippet_iov_idx {
+    JS_SNIPPET_IOV_CHUNK_HEADER,
+    JS_SNIPPET_IOV_PREFIX,
+    JS_SNIPPET_IOV_SESSID,
+    JS_SNIPPET_IOV_SUFFIX,
+    JS_SNIPPET_IOV_CHUNK_TRAILER,
+    JS_SNIPPET_IOV_LEN
+};
+static char js_snippet_chunk_header[20];
+static char js_snippet_sessid[SHIM_SESSID_LEN];
+static struct iovec js_snippet_iov[JS_SNIPPET_IOV_LEN] = {
+    [JS_SNIPPET_IOV_CHUNK_HEADER] = {js_snippet_chunk_header, 0},
+    [JS_SNIPPET_IOV_PREFIX] = {INSERT_HIDDEN_TOKEN_JS_PREFIX,
+        sizeof(INSERT_HIDDEN_TOKEN_JS_PREFIX) - 1},
+    [JS_SNIPPET_IOV_SESSID] = {js_snippet_sessid, SHIM_SESSID_LEN},
+    [JS_SNIPPET_IOV_SUFFIX] = {INSERT_HIDDEN_TOKEN_JS_SUFFIX,
+        sizeof(INSERT_HIDDEN_TOKEN_JS_SUFFIX) - 1},
+    [JS_SNIPPET_IOV_CHUNK_TRAILER] = {CRLF, sizeof(CRLF) - 1},
+};
+
+/* Writes the chunk size line of the JS snippet, which has a fixed length.
+ * Returns 0 on success, -1 otherwise. */
+int init_js_snippet_template() {
+    int header_len = snprintf(js_snippet_chunk_header,
+            sizeof(js_snippet_chunk_header), "%zx" CRLF,
+            INSERT_HIDDEN_TOKEN_JS_STRLEN);
+    if (header_len >= sizeof(js_snippet_chunk_header) || header_len < 0) {
+        log_error("chunked header buffer too small\n");
+        return -1;
+    }
+    js_snippet_iov[JS_SNIPPET_IOV_CHUNK_HEADER].iov_len = header_len;
+    return 0;
+}
+
 /* Sends CSRF JS snippet if page is configured for it */
 int check_send_csrf_js_snippet(struct event_data *ev_data) {
-    int done = 0;
-    bytearray_t *send_array = NULL;
-
     log_dbg("Checking if page has CSRF protection\n");
     if (ev_data->type == SERVER_LISTENER && !is_conn_cancelled(ev_data)
             && ev_data->conn_info->page_match
@@ -1237,56 +1727,25 @@ int check_send_csrf_js_snippet(struct event_data *ev_data) {
             && !ev_data->sent_js_snippet
             && (ev_data->msg_complete || ev_data->chunked_encoding_specified)) {
         log_trace("Page has CSRF protected form; sending JS snippet\n");
-        int s;
-        char js_snippet[INSERT_HIDDEN_TOKEN_JS_STRLEN + 10];
-        char header_buf[20];
 
         if (is_session_entry_clear(ev_data->conn_info->session)) {
             log_warn("Tried to send JS snippet, but session expired\n");
             goto error;
         }
 
-        int snippet_len = snprintf(js_snippet, sizeof(js_snippet),
-                INSERT_HIDDEN_TOKEN_JS_FORMAT,
-                ev_data->conn_info->session->session_id);
-        if (snippet_len >= sizeof(js_snippet) || snippet_len < 0) {
-            perror("snprintf");
-            goto error;
-        }
+        memcpy(js_snippet_sessid, ev_data->conn_info->session->session_id,
+                SHIM_SESSID_LEN);
 
-        if ((send_array = bytearray_new()) == NULL) {
-            goto error;
-        }
-
-        /* Send header if chunked encoding */
-        if (ev_data->chunked_encoding_specified) {
-            /* Write hex length to buffer with CRLF */
-            int header_buf_len = snprintf(header_buf, sizeof(header_buf),
-                    "%x\r\n", snippet_len);
-            if (header_buf_len >= sizeof(header_buf) || header_buf_len < 0) {
-                log_error("chunked header buffer too small\n");
-                goto error;
-            }
-
-            /* Add buffer to send array */
-            if (bytearray_append(send_array, header_buf, header_buf_len) < 0) {
-                goto error;
-            }
-        }
-
-        /* Add JS snippet */
-        if (bytearray_append(send_array, js_snippet, snippet_len) < 0) {
-            goto error;
-        }
-
-        /* Add trailing CRLF */
+        /* Only send chunk header and trailing CRLF if chunked encoding */
+        int s;
         if (ev_data->chunked_encoding_specified) {
-            if (bytearray_append(send_array, CRLF, strlen(CRLF)) < 0) {
-                goto error;
-            }
+            s = sendall_iov(ev_data->send_fd, js_snippet_iov,
+                    JS_SNIPPET_IOV_LEN);
+        } else {
+            s = sendall_iov(ev_data->send_fd,
+                    &js_snippet_iov[JS_SNIPPET_IOV_PREFIX],
+                    JS_SNIPPET_IOV_CHUNK_TRAILER - JS_SNIPPET_IOV_PREFIX);
         }
-
-        s = sendall(ev_data->send_fd, send_array->data, send_array->len);
         if (s < 0) {
             goto error;
         }
@@ -1296,11 +1755,9 @@ int check_send_csrf_js_snippet(struct event_data *ev_data) {
         log_dbg("Not sending JS snippet\n");
     }
 
-    bytearray_free(send_array);
-    return done;
+    return 0;
 
 error:
-    bytearray_free(send_array);
     cancel_connection(ev_data, REASON_INTERNAL_ERROR);
     return 1;
 }
@@ -1362,12 +1819,6 @@ int do_http_parse_send(char *headers_buf, size_t header_buf_len, char *body_buf,
     if (send_headers) {
 
 #if ENABLE_SESSION_TRACKING
-        /* Add Set-Cookie header */
-        if (ev_data->type == SERVER_LISTENER
-                && add_set_cookie_header(ev_data) < 0) {
-            return 1;
-        }
-
         /* Remove SHIM_SESSID cookie from Cookie header */
         if (ev_data->type == CLIENT_LISTENER
                 && ev_data->cookie_header_value_ref != NULL
@@ -1381,7 +1832,10 @@ int do_http_parse_send(char *headers_buf, size_t header_buf_len, char *body_buf,
         }
 #endif
 
-        send_http_headers(ev_data);
+        /* Also adds Set-Cookie header to responses */
+        if (send_http_headers(ev_data) < 0) {
+            return 1;
+        }
     }
 
     /* Send rest of buf */
@@ -1416,10 +1870,7 @@ void handle_event(int efd, struct epoll_event *ev, int sfd_http, int sfd_tls) {
 
         bool is_tls = (sfd_tls == listen_sock);
         int sfd = ev_data->listen_fd->sock_fd;
-        if (handle_new_connection(efd, ev, sfd, is_tls) < 0) {
-            free_connection_info(ev_data->conn_info);
-            ev->data.ptr = NULL;
-        }
+        handle_new_connection(efd, ev, sfd, is_tls);
         return;
     } else if (ev->data.ptr != NULL) {
         /* We have data on the fd waiting to be read. Read and
@@ -1439,6 +1890,10 @@ void handle_event(int efd, struct epoll_event *ev, int sfd_http, int sfd_tls) {
         if (is_conn_cancelled(ev_data) || (done && !ev_data->got_eagain)) {
             free_connection_info(ev_data->conn_info);
             ev->data.ptr = NULL;
+        } else if (ev_data->read_budget_exhausted
+                && rearm_read_event(efd, ev) < 0) {
+            free_connection_info(ev_data->conn_info);
+            ev->data.ptr = NULL;
         }
     } else {
         log_error("Unhandled epoll event\n");
@@ -1454,6 +1909,15 @@ void sigint_handler(int dummy) {
 /* Initialize structures for walking pages */
 int init_page_conf() {
     // @Todo(Travis) Create trie to index pages
+    int i, j;
+
+    max_param_name_len = CSRF_TOKEN_NAME_LEN;
+    for (i = 0; i < PAGES_CONF_LEN; i++) {
+        for (j = 0; j < pages_conf[i].params_len; j++) {
+            max_param_name_len = MAX(max_param_name_len,
+                    strlen(pages_conf[i].params[j].name));
+        }
+    }
     return 0;
 }
 
@@ -1561,12 +2025,23 @@ int init_structures(char *error_page_file) {
         return -1;
     }
 
+    if (open_spare_fd() < 0) {
+        perror("open");
+        return -1;
+    }
+
     init_config_vars();
 
     if (init_page_conf() < 0) {
         return -1;
     }
 
+#if ENABLE_CSRF_PROTECTION
+    if (init_js_snippet_template() < 0) {
+        return -1;
+    }
+#endif
+
 #if ENABLE_SESSION_TRACKING
     memset(current_sessions, 0, sizeof(current_sessions));
 #endif
@@ -1724,7 +2199,7 @@ int set_up_socket_listener(char *port_str) {
         return -1;
     }
 
-    s = listen(sfd, SOMAXCONN);
+    s = listen(sfd, MAX_PENDING_CONNECTIONS);
     if (s == -1) {
         perror("listen");
         return -1;
@@ -1852,6 +2327,11 @@ int main(int argc, char *argv[]) {
         goto finish;
     }
 
+#ifndef DEBUG
+    /* Move log output off the event loop; on failure, log synchronously */
+    log_start_writer();
+#endif
+
     /* The event loop */
     while (!sigint_received) {
         int n, i;
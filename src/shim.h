@@ -44,7 +44,6 @@
 #define DEFAULT_SERVER_HOST "localhost"
 #define MAXEVENTS 256
 #define MAX_CHUNK_SIZE_LEN 8
-#define READ_BUF_SIZE 4096
 #define MAX_CREDS_BUF_LEN 1024
 #define MAX_HTTP_ARG_LEN (1024 * 1024 * 1024)
 
@@ -53,6 +52,7 @@
 #endif
 
 #define MIN(a,b) ((a) < (b) ? (a) : (b))
+#define MAX(a,b) ((a) > (b) ? (a) : (b))
 
 
 /* Stringification macros */
@@ -146,16 +146,41 @@ void free_ssl();
 
 /* Event handlers */
 void handle_event(int efd, struct epoll_event *ev, int sfd, int sfd_tls);
+void adapt_read_size(struct event_data *ev_data, size_t count,
+        size_t batch_len, bool eagain);
+int rearm_read_event(int efd, struct epoll_event *ev);
 int handle_client_server_event(struct epoll_event *ev);
+void reject_connection(int infd, bool is_tls);
+int add_new_connection(int efd, int infd, bool is_tls);
+int open_spare_fd();
+int shed_connection_with_spare_fd(int sfd, bool is_tls);
 int handle_new_connection(int efd, struct epoll_event *ev, int sfd, bool is_tls);
 void sigint_handler(int dummy);
 
 /* Feature checks */
 void do_client_header_complete_checks(struct event_data *ev_data);
 void check_request_type(struct event_data *ev_data);
-void check_buffer_params(bytearray_t *buf, bool is_url_param,
+void check_url_params(struct event_data *ev_data);
+void check_query_args(char *query, size_t query_len,
         struct event_data *ev_data);
+void check_form_value_fragment(struct event_data *ev_data, const char *data,
+        size_t len);
+void start_form_value(struct event_data *ev_data);
+void finish_form_arg(struct event_data *ev_data);
+size_t scan_form_partial_arg(struct event_data *ev_data, char *data,
+        size_t len);
+void check_post_body_fragment(struct event_data *ev_data, char *data,
+        size_t len, bool is_final);
+void finish_post_body_check(struct event_data *ev_data);
 void check_single_arg(struct event_data *ev_data, char *arg, size_t len);
+void check_page_arg(struct event_data *ev_data, char *name, size_t name_len,
+        char *value, size_t value_len);
+void check_csrf_token_arg(struct event_data *ev_data, char *value,
+        size_t value_len);
+bool is_csrf_token_arg(struct event_data *ev_data, const char *name,
+        size_t name_len);
+struct params *match_page_param(struct event_data *ev_data, char *name,
+        size_t name_len);
 void check_arg_len_whitelist(struct params *param, char *value,
         size_t value_len, struct event_data *ev_data);
 void check_url_dir_traversal(struct event_data *ev_data);
@@ -168,7 +193,8 @@ struct params *find_matching_param(char *name, size_t name_len,
         struct params *params, unsigned int params_len,
         struct event_data *ev_data);
 size_t url_encode_buf_len_whitelist(char *data, size_t len,
-        struct event_data *ev_data, const char *whitelist);
+        struct event_data *ev_data, const char *whitelist,
+        const char *whitelist_scan);
 bool whitelist_char_allowed(const char *whitelist, const char x);
 int check_char_whitelist(const char *whitelist, const char c,
         struct event_data *ev_data);
@@ -182,13 +208,11 @@ void parse_argument_name_value(char *arg, size_t arg_len, char **name,
         size_t *name_len, char **value, size_t *value_len);
 void update_http_header_pair(struct event_data *ev_data, bool is_header_field,
         const char *at, size_t length);
-int populate_set_cookie_header_value(char *buf, size_t buf_len,
-        struct event_data *ev_data);
 int handle_chunked_parse_send(char *buf, size_t buf_len,
         http_parser_settings *parser_settings, struct event_data *ev_data);
+int init_js_snippet_template();
 int check_send_csrf_js_snippet(struct event_data *ev_data);
 int flush_server_event(struct event_data *server_ev_data);
-bool is_basic_auth_found(bytearray_t *ba);
 
 /* Util functions */
 int fill_rand_bytes(char *buf, size_t len);
@@ -19,9 +19,8 @@
 #include "net_util.h"
 #include "shim_struct.h"
 
-#ifdef TRACE
+/* Number of allocated connection_info structs; bounded by MAX_CONNECTIONS */
 int num_conn_infos = 0;
-#endif
 
 /* Array of cancel reason names */
 #define CANCEL_REASON_NAME(name, description) #name,
@@ -44,7 +43,7 @@ struct connection_info *init_conn_info(int infd, int outfd, bool in_is_tls,
     struct event_data *client_ev_data = NULL, *server_ev_data = NULL;
     struct connection_info *conn_info = NULL;
     struct fd_ctx *in_fd_ctx = NULL, *out_fd_ctx = NULL;
-    log_trace("init_conn_info() (%d total)\n", ++num_conn_infos);
+    log_trace("init_conn_info() (%d total)\n", num_conn_infos + 1);
 
     conn_info = calloc(1, sizeof(struct connection_info));
     if (conn_info == NULL) {
@@ -77,12 +76,10 @@ struct connection_info *init_conn_info(int infd, int outfd, bool in_is_tls,
     conn_info->server_ev_data = server_ev_data;
     conn_info->page_match = NULL;
 
+    num_conn_infos++;
     return conn_info;
 
 fail:
-#ifdef TRACE
-    num_conn_infos--;
-#endif
     free_fd_ctx(in_fd_ctx);
     free_fd_ctx(out_fd_ctx);
     free(client_ev_data);
@@ -191,6 +188,7 @@ struct event_data *init_event_data(event_t type, struct fd_ctx *listen_fd,
 
     ev_data->listen_fd = listen_fd;
     ev_data->send_fd = send_fd;
+    ev_data->read_size = READ_BUF_MIN_SIZE;
 
     ev_data->conn_info = conn_info;
     ev_data->http_msg_newline = NULL;
@@ -200,7 +198,7 @@ struct event_data *init_event_data(event_t type, struct fd_ctx *listen_fd,
         goto error;
     }
 
-    if ((ev_data->body = bytearray_new()) == NULL) {
+    if ((ev_data->partial_arg = bytearray_new()) == NULL) {
         log_warn("Allocating new bytearray failed\n");
         goto error;
     }
@@ -210,6 +208,10 @@ struct event_data *init_event_data(event_t type, struct fd_ctx *listen_fd,
         goto error;
     }
 
+#if ENABLE_AUTHENTICATION_CHECK
+    ev_data->auth_header_value_ref = NULL;
+#endif
+
 #if ENABLE_SESSION_TRACKING
     ev_data->cookie_header_value_ref = NULL;
     ev_data->content_length_header_value_ref = NULL;
@@ -258,7 +260,7 @@ struct event_data *init_event_data(event_t type, struct fd_ctx *listen_fd,
 
 error:
     bytearray_free(ev_data->url);
-    bytearray_free(ev_data->body);
+    bytearray_free(ev_data->partial_arg);
 
     bytearray_free(ev_data->headers_cache);
 
@@ -295,9 +297,15 @@ void reset_event_data(struct event_data *ev) {
 #endif
 
     bytearray_clear(ev->url);
-    bytearray_clear(ev->body);
+    memset(&ev->target, 0, sizeof(ev->target));
+    memset(&ev->form_scan, 0, sizeof(ev->form_scan));
+    bytearray_clear(ev->partial_arg);
     bytearray_clear(ev->headers_cache);
 
+#if ENABLE_AUTHENTICATION_CHECK
+    ev->auth_header_value_ref = NULL;
+#endif
+
 #if ENABLE_SESSION_TRACKING
     ev->cookie_header_value_ref = NULL;
     ev->content_length_header_value_ref = NULL;
@@ -363,7 +371,7 @@ void free_event_data(struct event_data *ev) {
     }
 
     bytearray_free(ev->url);
-    bytearray_free(ev->body);
+    bytearray_free(ev->partial_arg);
     bytearray_free(ev->headers_cache);
 
 #if ENABLE_SESSION_TRACKING
@@ -384,7 +392,8 @@ void free_event_data(struct event_data *ev) {
 /* Free memory and close sockets associated with connection structure */
 void free_connection_info(struct connection_info *ci) {
     if (ci != NULL) {
-        log_trace("Freeing conn info %p (%d total)\n", ci, --num_conn_infos);
+        num_conn_infos--;
+        log_trace("Freeing conn info %p (%d total)\n", ci, num_conn_infos);
         if (ci->client_ev_data) {
             /* Free fd_ctx's here because both event_data's reference both and
              * we want to avoid a double free.
@@ -406,6 +415,7 @@ void free_connection_info(struct connection_info *ci) {
 void copy_default_params(struct page_conf *page_conf, struct params *params) {
     params->max_param_len = page_conf->max_param_len;
     params->whitelist = page_conf->whitelist;
+    params->whitelist_scan = page_conf->whitelist_scan;
 }
 
 /* Set connection to cancelled state */
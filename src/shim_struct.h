@@ -18,6 +18,7 @@
 #define SHIM_STRUCT_H
 
 #include <stdbool.h>
+#include "config.h"
 
 #if ENABLE_HTTPS
 #include <openssl/bio.h>
@@ -81,10 +82,74 @@ typedef enum {
     CHUNK_SZ, CHUNK_SZ_LF, CHUNK_BODY, CHUNK_BODY_CR, CHUNK_BODY_LF
 } chunk_state_t;
 
+/* Maximum number of URL query arguments whose boundaries are recorded by
+ * parse_request_target(). Any further arguments are split when checked. */
+#define MAX_URL_ARGS 16
+
+/* Per connection read size adapts between these bounds */
+#define READ_BUF_MIN_SIZE 4096
+#define READ_BUF_MAX_SIZE (256 * 1024)
+/* Bytes read from one socket per event before yielding to other sockets */
+#define READ_BUDGET_BYTES (1024 * 1024)
+
 /* Structures */
 
 struct connection_info;
 
+/* Location of a URL query argument, as offsets into the URL bytearray */
+struct url_arg {
+    uint32_t offset;
+    uint32_t len;
+};
+
+/* Position of the POST body scanner within the current argument */
+typedef enum {
+    FORM_SCAN_ARG_START = 0,
+    FORM_SCAN_NAME,
+    FORM_SCAN_VALUE,
+    FORM_SCAN_CSRF_TOKEN,
+    FORM_SCAN_DONE
+} form_scan_state_t;
+
+/* State of an application/x-www-form-urlencoded POST argument that spans body
+ * fragments. The name (or CSRF token) seen so far is kept in
+ * event_data.partial_arg; values are checked as they arrive. */
+struct form_scan {
+    /* Parameter whose length and whitelist apply to the value */
+    struct params *param;
+
+    /* URL decoded length of the value so far */
+    size_t value_len;
+
+    /* Hex digits of an unfinished "%XX" escape, escape_len counts the '%' */
+    char escape[2];
+    unsigned int escape_len : 2;
+
+    form_scan_state_t state : 8;
+
+    /* Name is longer than any parameter name, so it was not kept */
+    bool name_overflow : 1;
+};
+
+/* Result of tokenizing the request target (URL) of a request */
+struct request_target {
+    /* Path is the first path_len bytes of the URL */
+    size_t path_len;
+
+    /* Query follows '?' at query_offset - 1 */
+    size_t query_offset;
+    struct url_arg args[MAX_URL_ARGS];
+    unsigned int num_args;
+
+    /* Offset of first argument not recorded in args */
+    size_t unrecorded_args_offset;
+
+    bool has_query : 1;
+    bool args_overflow : 1;
+    bool is_dir_traversal : 1;
+    bool invalid_path_encoding : 1;
+};
+
 struct fd_ctx {
     int sock_fd;
     bool is_tls;
@@ -100,7 +165,9 @@ struct event_data {
     http_parser parser;
     struct connection_info *conn_info;
     bytearray_t *url;
-    bytearray_t *body;
+    struct request_target target;
+    struct form_scan form_scan;
+    bytearray_t *partial_arg;
     char *http_msg_newline;
     bytearray_t *headers_cache;
 
@@ -117,6 +184,11 @@ struct event_data {
     int64_t content_original_length;
 #endif
 
+#if ENABLE_AUTHENTICATION_CHECK
+    /* Do not free; reference to member of all_header_values */
+    bytearray_t *auth_header_value_ref;
+#endif
+
     /* Current header field/value */
     bytearray_t *header_field;
     bytearray_t *header_value;
@@ -126,6 +198,9 @@ struct event_data {
     struct_array_t *all_header_fields;
     struct_array_t *all_header_values;
 
+    /* Adaptive read size; see adapt_read_size() */
+    uint32_t read_size;
+
     cancel_reason_t cancel_reason : 8;
 
     event_t type : 8;
@@ -141,6 +216,7 @@ struct event_data {
     bool msg_complete : 1;
     bool just_visited_header_field : 1;
     bool got_eagain : 1;
+    bool read_budget_exhausted : 1;
     bool sent_js_snippet : 1;
     bool headers_have_been_sent : 1;
 
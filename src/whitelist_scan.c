@@ -0,0 +1,169 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdint.h>
+#include "whitelist_scan.h"
+
+/* Without -mssse3, x86 builds still compile the SSSE3 scanner for that target
+ * alone and pick it at runtime when the CPU supports it */
+#if !defined(__SSSE3__) && (defined(__x86_64__) || defined(__i386__)) \
+        && defined(__GNUC__)
+#define WHITELIST_SCAN_DISPATCH 1
+#define SSSE3_TARGET __attribute__((target("ssse3")))
+#else
+#define SSSE3_TARGET
+#endif
+
+#if defined(__SSSE3__) || defined(WHITELIST_SCAN_DISPATCH)
+#include <tmmintrin.h>
+#elif defined(__ARM_NEON) && defined(__aarch64__)
+#include <arm_neon.h>
+#endif
+
+/* Returns whether byte is allowed by the scan table (see whitelist_scan.h) */
+int whitelist_scan_byte_allowed(const char *scan_table, const char x) {
+    unsigned char c = (unsigned char) x;
+    unsigned char row = scan_table[((c >> 7) << 4) | (c & 0x0f)];
+    return (row >> ((c >> 4) & 0x7)) & 1;
+}
+
+/* Scans bytes one at a time starting at data[i]. Returns length of prefix of
+ * allowed bytes. */
+static size_t scan_run_scalar(const char *scan_table, const char *data,
+        size_t i, size_t len) {
+    /* Check blocks of 8 bytes with a single branch */
+    while (len - i >= 8) {
+        const char *p = data + i;
+        int all_allowed = whitelist_scan_byte_allowed(scan_table, p[0])
+                & whitelist_scan_byte_allowed(scan_table, p[1])
+                & whitelist_scan_byte_allowed(scan_table, p[2])
+                & whitelist_scan_byte_allowed(scan_table, p[3])
+                & whitelist_scan_byte_allowed(scan_table, p[4])
+                & whitelist_scan_byte_allowed(scan_table, p[5])
+                & whitelist_scan_byte_allowed(scan_table, p[6])
+                & whitelist_scan_byte_allowed(scan_table, p[7]);
+        if (!all_allowed) {
+            break;
+        }
+        i += 8;
+    }
+
+    while (i < len && whitelist_scan_byte_allowed(scan_table, data[i])) {
+        i++;
+    }
+    return i;
+}
+
+#if defined(__SSSE3__) || defined(WHITELIST_SCAN_DISPATCH)
+/* Returns length of prefix of allowed bytes, classifying 16 bytes per step */
+static SSSE3_TARGET size_t scan_run_ssse3(const char *scan_table,
+        const char *data, size_t len) {
+    size_t i = 0;
+    const __m128i table_lo = _mm_loadu_si128((const __m128i *) scan_table);
+    const __m128i table_hi = _mm_loadu_si128(
+            (const __m128i *) (scan_table + 16));
+    const __m128i bits = _mm_setr_epi8(1, 2, 4, 8, 16, 32, 64, -128,
+            1, 2, 4, 8, 16, 32, 64, -128);
+    const __m128i nibble_mask = _mm_set1_epi8(0x0f);
+    const __m128i seven = _mm_set1_epi8(7);
+
+    while (len - i >= 16) {
+        __m128i x = _mm_loadu_si128((const __m128i *) (data + i));
+        __m128i lo = _mm_and_si128(x, nibble_mask);
+        __m128i hi = _mm_and_si128(_mm_srli_epi16(x, 4), nibble_mask);
+
+        /* Select row from table by low nibble and high bit */
+        __m128i use_hi = _mm_cmpgt_epi8(hi, seven);
+        __m128i row = _mm_or_si128(
+                _mm_andnot_si128(use_hi, _mm_shuffle_epi8(table_lo, lo)),
+                _mm_and_si128(use_hi, _mm_shuffle_epi8(table_hi, lo)));
+
+        /* Test bit for the remaining bits of high nibble */
+        __m128i bit = _mm_shuffle_epi8(bits, hi);
+        __m128i allowed = _mm_cmpeq_epi8(_mm_and_si128(row, bit), bit);
+        unsigned int mask = _mm_movemask_epi8(allowed);
+        if (mask != 0xffff) {
+            return i + __builtin_ctz(~mask);
+        }
+        i += 16;
+    }
+
+    return scan_run_scalar(scan_table, data, i, len);
+}
+#endif
+
+#if defined(__SSSE3__)
+/* Returns length of prefix of allowed bytes */
+size_t whitelist_scan_run(const char *scan_table, const char *data,
+        size_t len) {
+    return scan_run_ssse3(scan_table, data, len);
+}
+
+#elif defined(WHITELIST_SCAN_DISPATCH)
+/* Whether the CPU supports SSSE3, or -1 if not checked yet */
+static int have_ssse3 = -1;
+
+/* Returns length of prefix of allowed bytes */
+size_t whitelist_scan_run(const char *scan_table, const char *data,
+        size_t len) {
+    if (have_ssse3 < 0) {
+        __builtin_cpu_init();
+        have_ssse3 = __builtin_cpu_supports("ssse3") ? 1 : 0;
+    }
+    if (have_ssse3) {
+        return scan_run_ssse3(scan_table, data, len);
+    }
+    return scan_run_scalar(scan_table, data, 0, len);
+}
+
+#elif defined(__ARM_NEON) && defined(__aarch64__)
+/* Returns length of prefix of allowed bytes, classifying 16 bytes per step */
+size_t whitelist_scan_run(const char *scan_table, const char *data,
+        size_t len) {
+    static const uint8_t bit_values[16] = {1, 2, 4, 8, 16, 32, 64, 128,
+            1, 2, 4, 8, 16, 32, 64, 128};
+    size_t i = 0;
+    const uint8x16_t table_lo = vld1q_u8((const uint8_t *) scan_table);
+    const uint8x16_t table_hi = vld1q_u8((const uint8_t *) scan_table + 16);
+    const uint8x16_t bits = vld1q_u8(bit_values);
+    const uint8x16_t nibble_mask = vdupq_n_u8(0x0f);
+    const uint8x16_t seven = vdupq_n_u8(7);
+
+    while (len - i >= 16) {
+        uint8x16_t x = vld1q_u8((const uint8_t *) data + i);
+        uint8x16_t lo = vandq_u8(x, nibble_mask);
+        uint8x16_t hi = vshrq_n_u8(x, 4);
+
+        uint8x16_t row = vbslq_u8(vcgtq_u8(hi, seven),
+                vqtbl1q_u8(table_hi, lo), vqtbl1q_u8(table_lo, lo));
+        uint8x16_t allowed = vtstq_u8(row, vqtbl1q_u8(bits, hi));
+        if (vminvq_u8(allowed) != 0xff) {
+            /* Let scalar scan find the first disallowed byte */
+            break;
+        }
+        i += 16;
+    }
+
+    return scan_run_scalar(scan_table, data, i, len);
+}
+
+#else
+/* Returns length of prefix of allowed bytes */
+size_t whitelist_scan_run(const char *scan_table, const char *data,
+        size_t len) {
+    return scan_run_scalar(scan_table, data, 0, len);
+}
+#endif
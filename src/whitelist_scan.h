@@ -0,0 +1,36 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#ifndef WHITELIST_SCAN_H
+#define WHITELIST_SCAN_H
+
+#include <stddef.h>
+
+/* Length of whitelist scan table generated by parse_config.py.
+ *
+ * The scan table is the 256-bit whitelist bitmap transposed by nibble, with
+ * '%' always cleared so that scanning stops at URL encoded bytes:
+ *      table[lo] bit h         is set if byte (h << 4 | lo) is allowed
+ *      table[16 + lo] bit h    is set if byte ((h + 8) << 4 | lo) is allowed
+ * This layout lets SSSE3/NEON classify 16 bytes with three table lookups.
+ */
+#define WHITELIST_SCAN_LEN 32
+
+size_t whitelist_scan_run(const char *scan_table, const char *data,
+        size_t len);
+int whitelist_scan_byte_allowed(const char *scan_table, const char x);
+
+#endif
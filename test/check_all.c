@@ -24,6 +24,12 @@ int main(int argc, char **argv) {
 
     SRunner *sr;
     sr = srunner_create(session_suite());
+    srunner_add_suite(sr, whitelist_scan_suite());
+    srunner_add_suite(sr, header_classifier_suite());
+    srunner_add_suite(sr, log_suite());
+    srunner_add_suite(sr, http_util_suite());
+    srunner_add_suite(sr, form_scan_suite());
+    srunner_add_suite(sr, net_util_suite());
     //srunner_add_suite(sr, next_suite());
 
 
@@ -27,5 +27,11 @@
 /* Defines prototype for suite functions */
 
 Suite *session_suite();
+Suite *whitelist_scan_suite();
+Suite *header_classifier_suite();
+Suite *log_suite();
+Suite *http_util_suite();
+Suite *form_scan_suite();
+Suite *net_util_suite();
 
 #endif
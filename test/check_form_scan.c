@@ -0,0 +1,238 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <check.h>
+#include "check_all.h"
+#include "../src/session.h"
+#include "../src/whitelist_scan.h"
+
+#define BODY_MAX_LEN 256
+
+static char whitelist[WHITELIST_PARAM_LEN];
+static char scan_table[WHITELIST_SCAN_LEN];
+
+static struct params test_params[2] = {
+    {.name = "user", .whitelist = whitelist, .whitelist_scan = scan_table,
+        .max_param_len = 8},
+    {.name = "note", .whitelist = whitelist, .whitelist_scan = scan_table,
+        .max_param_len = 8},
+};
+
+static struct page_conf test_page = {
+    .name = "/form",
+    .whitelist = whitelist,
+    .whitelist_scan = scan_table,
+    .max_param_len = 8,
+    .receives_csrf_form_action = 1,
+    .restrict_params = 1,
+    .params = test_params,
+    .params_len = 2,
+};
+
+static struct connection_info conn_info;
+
+#if ENABLE_CSRF_PROTECTION
+static struct session test_session;
+#endif
+
+/* Allows letters and digits, with scan table built like parse_config.py */
+static void setup_page() {
+    int c;
+
+    memset(whitelist, 0, sizeof(whitelist));
+    memset(scan_table, 0, sizeof(scan_table));
+    for (c = 0; c < 0x100; c++) {
+        if (('a' <= c && c <= 'z') || ('A' <= c && c <= 'Z')
+                || ('0' <= c && c <= '9')) {
+            whitelist[c / 8] |= 1 << (c % 8);
+            scan_table[((c >> 7) << 4) | (c & 0x0f)] |= 1 << ((c >> 4) & 0x7);
+        }
+    }
+
+    memset(&conn_info, 0, sizeof(conn_info));
+    conn_info.page_match = &test_page;
+    copy_default_params(&test_page, &conn_info.default_params);
+#if ENABLE_CSRF_PROTECTION
+    memset(test_session.session_id, 'a', SHIM_SESSID_LEN);
+    test_session.session_id[SHIM_SESSID_LEN] = '\0';
+    conn_info.session = &test_session;
+#endif
+    ck_assert_int_eq(init_page_conf(), 0);
+}
+
+static void teardown_page() {
+}
+
+/* Checks body split into fragments at the given offsets, the way on_body_cb()
+ * and on_message_complete_cb() do, and returns the cancel reason */
+static cancel_reason_t check_body_split(const char *body, const size_t *splits,
+        size_t num_splits) {
+    struct event_data *ev_data;
+    char buf[BODY_MAX_LEN];
+    size_t len = strlen(body), start = 0, end, i;
+    cancel_reason_t reason;
+
+    ev_data = init_event_data(CLIENT_LISTENER, NULL, NULL, HTTP_REQUEST,
+            &conn_info);
+    ck_assert(ev_data != NULL);
+    ck_assert(len <= BODY_MAX_LEN);
+    memcpy(buf, body, len);
+
+    for (i = 0; i <= num_splits && !is_conn_cancelled(ev_data); i++) {
+        end = i < num_splits ? splits[i] : len;
+        if (end > start) {
+            check_post_body_fragment(ev_data, buf + start, end - start,
+                    end == len);
+        }
+        start = end;
+    }
+    if (!is_conn_cancelled(ev_data)) {
+        finish_post_body_check(ev_data);
+    }
+
+    reason = is_conn_cancelled(ev_data) ? ev_data->cancel_reason
+            : REASON_NOT_CANCELLED;
+    free_event_data(ev_data);
+    return reason;
+}
+
+/* Asserts that body gives reason whole, split at every byte offset, split at
+ * every pair of offsets and one byte at a time */
+static void assert_body_reason(const char *body, cancel_reason_t reason) {
+    size_t len = strlen(body), splits[BODY_MAX_LEN], i, j;
+
+    ck_assert_msg(check_body_split(body, NULL, 0) == reason,
+            "\"%s\" whole", body);
+
+    for (i = 0; i <= len; i++) {
+        splits[0] = i;
+        ck_assert_msg(check_body_split(body, splits, 1) == reason,
+                "\"%s\" split at %zd", body, i);
+        for (j = i; j <= len; j++) {
+            splits[1] = j;
+            ck_assert_msg(check_body_split(body, splits, 2) == reason,
+                    "\"%s\" split at %zd and %zd", body, i, j);
+        }
+    }
+
+    for (i = 0; i < len; i++) {
+        splits[i] = i + 1;
+    }
+    ck_assert_msg(check_body_split(body, splits, len) == reason,
+            "\"%s\" one byte at a time", body);
+}
+
+START_TEST(test_form_valid) {
+    assert_body_reason("user=alice", REASON_NOT_CANCELLED);
+    assert_body_reason("user=alice&note=hi", REASON_NOT_CANCELLED);
+    assert_body_reason("user=abcdefgh&note=abcdefgh", REASON_NOT_CANCELLED);
+    assert_body_reason("%75s%65r=ab%43d&note=%41%42", REASON_NOT_CANCELLED);
+    assert_body_reason("user&note=&user=x", REASON_NOT_CANCELLED);
+}
+END_TEST
+
+START_TEST(test_form_invalid_escape) {
+    assert_body_reason("user=ab%4", REASON_INVALID_HTTP);
+    assert_body_reason("user=ab%4&note=x", REASON_INVALID_HTTP);
+    assert_body_reason("user=ab%zzc", REASON_INVALID_HTTP);
+    assert_body_reason("us%zzr=a", REASON_INVALID_HTTP);
+}
+END_TEST
+
+#if ENABLE_PARAM_WHITELIST_CHECK
+START_TEST(test_form_whitelist) {
+    assert_body_reason("user=ali*ce", REASON_PARAM_CHARACTER_NOT_ALLOWED);
+    assert_body_reason("user=ali%2ace", REASON_PARAM_CHARACTER_NOT_ALLOWED);
+    assert_body_reason("note=a&user=a%20", REASON_PARAM_CHARACTER_NOT_ALLOWED);
+}
+END_TEST
+#endif
+
+#if ENABLE_PARAM_LEN_CHECK
+START_TEST(test_form_len) {
+    assert_body_reason("user=abcdefghi", REASON_PARAM_LEN_EXCEEDED);
+    assert_body_reason("user=abcdefg%41%42", REASON_PARAM_LEN_EXCEEDED);
+    assert_body_reason("note=a&user=abcdefghi&note=b",
+            REASON_PARAM_LEN_EXCEEDED);
+}
+END_TEST
+#endif
+
+START_TEST(test_form_param_not_allowed) {
+    char body[BODY_MAX_LEN];
+
+    assert_body_reason("other=1", REASON_PARAM_NOT_ALLOWED);
+    assert_body_reason("user=a&users=b", REASON_PARAM_NOT_ALLOWED);
+    assert_body_reason("user=a&other", REASON_PARAM_NOT_ALLOWED);
+
+    /* Name too long to match any parameter, even URL encoded */
+    memset(body, 'x', 200);
+    strcpy(body + 200, "=1");
+    assert_body_reason(body, REASON_PARAM_NOT_ALLOWED);
+}
+END_TEST
+
+#if ENABLE_CSRF_PROTECTION
+START_TEST(test_form_csrf_token) {
+    char body[BODY_MAX_LEN];
+    size_t len;
+
+    len = sprintf(body, "user=a&%s=", CSRF_TOKEN_NAME);
+    memset(body + len, 'a', SHIM_SESSID_LEN);
+    strcpy(body + len + SHIM_SESSID_LEN, "&note=b");
+    assert_body_reason(body, REASON_NOT_CANCELLED);
+
+    /* Wrong token */
+    body[len + 3] = 'b';
+    assert_body_reason(body, REASON_INVALID_CSRF_TOKEN);
+
+    /* Token too short or too long */
+    body[len + 3] = 'a';
+    strcpy(body + len + SHIM_SESSID_LEN - 1, "&note=b");
+    assert_body_reason(body, REASON_INVALID_CSRF_TOKEN);
+    memset(body + len, 'a', SHIM_SESSID_LEN + 1);
+    strcpy(body + len + SHIM_SESSID_LEN + 1, "&note=b");
+    assert_body_reason(body, REASON_INVALID_CSRF_TOKEN);
+    body[len + SHIM_SESSID_LEN + 1] = '\0';
+    assert_body_reason(body, REASON_INVALID_CSRF_TOKEN);
+}
+END_TEST
+#endif
+
+Suite *form_scan_suite() {
+    Suite *s = suite_create("Form scanner");
+
+    TCase *tc_split = tcase_create("Fragment splits");
+    tcase_add_checked_fixture(tc_split, setup_page, teardown_page);
+    tcase_add_test(tc_split, test_form_valid);
+    tcase_add_test(tc_split, test_form_invalid_escape);
+#if ENABLE_PARAM_WHITELIST_CHECK
+    tcase_add_test(tc_split, test_form_whitelist);
+#endif
+#if ENABLE_PARAM_LEN_CHECK
+    tcase_add_test(tc_split, test_form_len);
+#endif
+    tcase_add_test(tc_split, test_form_param_not_allowed);
+#if ENABLE_CSRF_PROTECTION
+    tcase_add_test(tc_split, test_form_csrf_token);
+#endif
+
+    suite_add_tcase(s, tc_split);
+
+    return s;
+}
@@ -0,0 +1,176 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <check.h>
+#include "check_all.h"
+
+#define CLASSIFY(name, value_len, is_request) \
+    classify_header(name, strlen(name), value_len, is_request)
+
+START_TEST(test_classify_known_headers) {
+    ck_assert_int_eq(CLASSIFY("Cookie", 0, true), HEADER_COOKIE);
+    ck_assert_int_eq(CLASSIFY("Transfer-Encoding", 0, true),
+            HEADER_TRANSFER_ENCODING);
+    ck_assert_int_eq(CLASSIFY("TE", 0, true), HEADER_TE);
+    ck_assert_int_eq(CLASSIFY("Trailers", 0, true), HEADER_TRAILERS);
+    ck_assert_int_eq(CLASSIFY("Content-Encoding", 0, true),
+            HEADER_CONTENT_ENCODING);
+    ck_assert_int_eq(CLASSIFY("Content-Length", 0, true),
+            HEADER_CONTENT_LENGTH);
+    ck_assert_int_eq(CLASSIFY("Authorization", 0, true),
+            HEADER_AUTHORIZATION);
+}
+END_TEST
+
+START_TEST(test_classify_ignores_case) {
+    ck_assert_int_eq(CLASSIFY("cookie", 0, true), HEADER_COOKIE);
+    ck_assert_int_eq(CLASSIFY("te", 0, false), HEADER_TE);
+    ck_assert_int_eq(CLASSIFY("CONTENT-LENGTH", 0, false),
+            HEADER_CONTENT_LENGTH);
+    ck_assert_int_eq(CLASSIFY("aUTHORIZATION", 0, true),
+            HEADER_AUTHORIZATION);
+}
+END_TEST
+
+START_TEST(test_classify_other_headers) {
+    ck_assert_int_eq(CLASSIFY("Host", 0, true), HEADER_OTHER);
+    ck_assert_int_eq(CLASSIFY("T", 0, true), HEADER_OTHER);
+    ck_assert_int_eq(CLASSIFY("Cookies", 0, true), HEADER_OTHER);
+    ck_assert_int_eq(CLASSIFY("Authorizatio", 0, true), HEADER_OTHER);
+    ck_assert_int_eq(CLASSIFY("Content-Lengtx", 0, true), HEADER_OTHER);
+    ck_assert_int_eq(CLASSIFY("Trailer", 0, true), HEADER_OTHER);
+    ck_assert_int_eq(CLASSIFY("Content_Length", 0, true), HEADER_OTHER);
+}
+END_TEST
+
+START_TEST(test_classify_length_limits) {
+    char field[MAX_HEADER_FIELD_LEN + 2];
+    memset(field, 'a', sizeof(field) - 1);
+    field[sizeof(field) - 1] = '\0';
+
+#if ENABLE_HEADER_FIELD_LEN_CHECK
+    ck_assert_int_eq(CLASSIFY(field, 0, true), HEADER_FIELD_OVERSIZED);
+#endif
+    ck_assert_int_eq(CLASSIFY(field, 0, false), HEADER_OTHER);
+    field[MAX_HEADER_FIELD_LEN] = '\0';
+    ck_assert_int_eq(CLASSIFY(field, 0, true), HEADER_OTHER);
+
+#if ENABLE_HEADER_VALUE_LEN_CHECK
+    ck_assert_int_eq(CLASSIFY("Cookie", MAX_HEADER_VALUE_LEN + 1, true),
+            HEADER_VALUE_OVERSIZED);
+#endif
+    ck_assert_int_eq(CLASSIFY("Cookie", MAX_HEADER_VALUE_LEN, true),
+            HEADER_COOKIE);
+    ck_assert_int_eq(CLASSIFY("Cookie", MAX_HEADER_VALUE_LEN + 1, false),
+            HEADER_COOKIE);
+}
+END_TEST
+
+#if ENABLE_HEADER_FIELD_LEN_CHECK || ENABLE_HEADER_VALUE_LEN_CHECK
+/* Feeds header field or value of len bytes in fragments of frag_len bytes, like
+ * on_header_field_cb() and on_header_value_cb(). Returns the cancel reason. */
+static cancel_reason_t feed_header_fragments(event_t type, bool is_field,
+        size_t len, size_t frag_len) {
+    char data[MAX_HEADER_FIELD_LEN + MAX_HEADER_VALUE_LEN + 2];
+    struct event_data *ev_data;
+    cancel_reason_t reason;
+    size_t sent, n;
+
+    ev_data = init_event_data(type, NULL, NULL,
+            type == CLIENT_LISTENER ? HTTP_REQUEST : HTTP_RESPONSE, NULL);
+    ck_assert(ev_data != NULL);
+    ck_assert(len <= sizeof(data));
+    memset(data, 'a', len);
+
+    if (!is_field) {
+        update_http_header_pair(ev_data, true, "X", 1);
+    }
+    for (sent = 0; sent < len && !is_conn_cancelled(ev_data); sent += n) {
+        n = len - sent < frag_len ? len - sent : frag_len;
+        update_http_header_pair(ev_data, is_field, data + sent, n);
+    }
+
+    /* Nothing past the limit is buffered */
+    if (type == CLIENT_LISTENER) {
+        ck_assert(ev_data->header_field->len <= MAX_HEADER_FIELD_LEN);
+        ck_assert(ev_data->header_value->len <= MAX_HEADER_VALUE_LEN);
+    }
+
+    reason = is_conn_cancelled(ev_data) ? ev_data->cancel_reason
+            : REASON_NOT_CANCELLED;
+    free_event_data(ev_data);
+    return reason;
+}
+#endif
+
+#if ENABLE_HEADER_FIELD_LEN_CHECK
+START_TEST(test_header_field_fragments) {
+    size_t frag_len;
+
+    for (frag_len = 1; frag_len <= MAX_HEADER_FIELD_LEN + 1; frag_len++) {
+        ck_assert_int_eq(feed_header_fragments(CLIENT_LISTENER, true,
+                MAX_HEADER_FIELD_LEN, frag_len), REASON_NOT_CANCELLED);
+        ck_assert_int_eq(feed_header_fragments(CLIENT_LISTENER, true,
+                MAX_HEADER_FIELD_LEN + 1, frag_len),
+                REASON_OVERSIZED_HEADER_FIELD);
+    }
+    ck_assert_int_eq(feed_header_fragments(SERVER_LISTENER, true,
+            MAX_HEADER_FIELD_LEN + 1, 1), REASON_NOT_CANCELLED);
+}
+END_TEST
+#endif
+
+#if ENABLE_HEADER_VALUE_LEN_CHECK
+START_TEST(test_header_value_fragments) {
+    size_t frag_len;
+
+    for (frag_len = 1; frag_len <= MAX_HEADER_VALUE_LEN + 1; frag_len++) {
+        ck_assert_int_eq(feed_header_fragments(CLIENT_LISTENER, false,
+                MAX_HEADER_VALUE_LEN, frag_len), REASON_NOT_CANCELLED);
+        ck_assert_int_eq(feed_header_fragments(CLIENT_LISTENER, false,
+                MAX_HEADER_VALUE_LEN + 1, frag_len),
+                REASON_OVERSIZED_HEADER_VALUE);
+    }
+    ck_assert_int_eq(feed_header_fragments(SERVER_LISTENER, false,
+            MAX_HEADER_VALUE_LEN + 1, 1), REASON_NOT_CANCELLED);
+}
+END_TEST
+#endif
+
+Suite *header_classifier_suite() {
+    Suite *s = suite_create("Header classifier");
+
+    TCase *tc_classify = tcase_create("Classify header");
+    tcase_add_test(tc_classify, test_classify_known_headers);
+    tcase_add_test(tc_classify, test_classify_ignores_case);
+    tcase_add_test(tc_classify, test_classify_other_headers);
+    tcase_add_test(tc_classify, test_classify_length_limits);
+
+    TCase *tc_fragments = tcase_create("Header fragments");
+#if ENABLE_HEADER_FIELD_LEN_CHECK
+    tcase_add_test(tc_fragments, test_header_field_fragments);
+#endif
+#if ENABLE_HEADER_VALUE_LEN_CHECK
+    tcase_add_test(tc_fragments, test_header_value_fragments);
+#endif
+
+    suite_add_tcase(s, tc_classify);
+    suite_add_tcase(s, tc_fragments);
+
+    return s;
+}
@@ -0,0 +1,252 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <check.h>
+#include "check_all.h"
+
+static struct event_data *ev_data = NULL;
+
+static void setup_ev_data() {
+    ev_data = init_event_data(CLIENT_LISTENER, NULL, NULL, HTTP_REQUEST, NULL);
+    ck_assert(ev_data != NULL);
+}
+
+static void teardown_ev_data() {
+    free_event_data(ev_data);
+    ev_data = NULL;
+}
+
+/* Compares str with URL encoded url_data, returning equality and validity */
+static bool memeq(const char *str, const char *url_data, bool *is_valid) {
+    char buf[128];
+    size_t len = strlen(url_data);
+    memcpy(buf, url_data, len);
+    return str_to_url_encoded_memeq(str, buf, len, is_valid);
+}
+
+START_TEST(test_url_encoded_memeq) {
+    bool is_valid;
+
+    ck_assert(memeq("user", "user", &is_valid));
+    ck_assert(is_valid);
+    ck_assert(memeq("user", "%75s%45r", &is_valid) == false);
+    ck_assert(is_valid);
+    ck_assert(memeq("user", "%75s%65r", &is_valid));
+    ck_assert(is_valid);
+    ck_assert(memeq("user", "use", &is_valid) == false);
+    ck_assert(is_valid);
+    ck_assert(memeq("use", "user", &is_valid) == false);
+    ck_assert(is_valid);
+
+    /* Well formed escape of a different byte is only a mismatch */
+    ck_assert(memeq("ab", "%6c%6f", &is_valid) == false);
+    ck_assert(is_valid);
+    ck_assert(memeq("user", "us%00", &is_valid) == false);
+    ck_assert(is_valid);
+
+    /* Malformed escapes */
+    ck_assert(memeq("user", "us%zz", &is_valid) == false);
+    ck_assert(is_valid == false);
+    ck_assert(memeq("user", "us%6", &is_valid) == false);
+    ck_assert(is_valid == false);
+    ck_assert(memeq("user", "us%6g", &is_valid) == false);
+    ck_assert(is_valid == false);
+    ck_assert(memeq("user", "%", &is_valid) == false);
+    ck_assert(is_valid == false);
+}
+END_TEST
+
+START_TEST(test_find_matching_param_order) {
+    struct params params[2] = {
+        {.name = "ab"},
+        {.name = "longname_xyz"},
+    };
+    struct params reversed[2] = {params[1], params[0]};
+    char name[] = "%6c%6f%6e%67%6e%61%6d%65%5f%78%79%7a";
+    char prefix[] = "%6c%6f%6e%67";
+    struct params *match;
+
+    /* Same outcome whichever parameter is compared first */
+    match = find_matching_param(name, strlen(name), params, 2, ev_data);
+    ck_assert(match == &params[1]);
+    ck_assert(!is_conn_cancelled(ev_data));
+    match = find_matching_param(name, strlen(name), reversed, 2, ev_data);
+    ck_assert(match == &reversed[0]);
+    ck_assert(!is_conn_cancelled(ev_data));
+
+    match = find_matching_param(prefix, strlen(prefix), params, 2, ev_data);
+    ck_assert(match == NULL);
+    ck_assert(!is_conn_cancelled(ev_data));
+    match = find_matching_param(prefix, strlen(prefix), reversed, 2, ev_data);
+    ck_assert(match == NULL);
+    ck_assert(!is_conn_cancelled(ev_data));
+}
+END_TEST
+
+START_TEST(test_find_matching_param_invalid) {
+    struct params params[2] = {
+        {.name = "ab"},
+        {.name = "longname_xyz"},
+    };
+    char name[] = "lo%zzname_xyz";
+
+    ck_assert(find_matching_param(name, strlen(name), params, 2, ev_data)
+            == NULL);
+    ck_assert(is_conn_cancelled(ev_data));
+    ck_assert_int_eq(ev_data->cancel_reason, REASON_INVALID_HTTP);
+}
+END_TEST
+
+/* Tokenizes url of given length into ev_data->target */
+static struct request_target *parse_url_len(const char *url, size_t len) {
+    bytearray_clear(ev_data->url);
+    ck_assert_int_eq(bytearray_append(ev_data->url, url, len), 0);
+    parse_request_target(ev_data);
+    return &ev_data->target;
+}
+
+static struct request_target *parse_url(const char *url) {
+    return parse_url_len(url, strlen(url));
+}
+
+START_TEST(test_target_dir_traversal) {
+    const char *blocked[] = {
+        "/..", "/../etc/passwd", "/a/../b", "/a/..", "/%2e%2e/x", "/.%2E/x",
+        "/..;/x", "/..;jsessionid=1/x", "/..%3b/x", "/..%00/x", "/.. /x",
+        "/..%20/x", "/..%09", "/a%2f..%2fb", "/a%5c..%5cb", "/a\\..\\b",
+        "/x/..?a=b",
+    };
+    const char *allowed[] = {
+        "/", "/a/b", "/.", "/./x", "/...", "/.../x", "/..a/x", "/a..", "/a../x",
+        "/a.b./c", "/x?a=../..", "/x?..;",
+    };
+    int i;
+
+    for (i = 0; i < sizeof(blocked) / sizeof(*blocked); i++) {
+        ck_assert_msg(parse_url(blocked[i])->is_dir_traversal,
+                "%s not blocked", blocked[i]);
+        ck_assert(!ev_data->target.invalid_path_encoding);
+    }
+    for (i = 0; i < sizeof(allowed) / sizeof(*allowed); i++) {
+        ck_assert_msg(!parse_url(allowed[i])->is_dir_traversal,
+                "%s blocked", allowed[i]);
+        ck_assert(!ev_data->target.invalid_path_encoding);
+    }
+
+    /* Literal NUL after ".." */
+    ck_assert(parse_url_len("/..\0/x", 6)->is_dir_traversal);
+}
+END_TEST
+
+START_TEST(test_target_invalid_encoding) {
+    const char *invalid[] = {
+        "/%", "/a%", "/a%2", "/a%zz", "/a%2g/b", "/a%g2", "/%%41",
+        "/a%2?x=1",
+    };
+    int i;
+
+    for (i = 0; i < sizeof(invalid) / sizeof(*invalid); i++) {
+        ck_assert_msg(parse_url(invalid[i])->invalid_path_encoding,
+                "%s not invalid", invalid[i]);
+    }
+
+    /* Escapes in the query are left to the argument checks */
+    ck_assert(!parse_url("/a?b=%zz")->invalid_path_encoding);
+    ck_assert(!parse_url("/a%41%7e")->invalid_path_encoding);
+}
+END_TEST
+
+START_TEST(test_target_query_args) {
+    struct request_target *t;
+    const char *url = "/p%3fq?a=1&&b=%26&c";
+
+    t = parse_url("/path");
+    ck_assert(!t->has_query);
+    ck_assert_int_eq(t->path_len, 5);
+    ck_assert_int_eq(t->num_args, 0);
+
+    /* Only a literal '?' starts the query, and only '&' separates args */
+    t = parse_url(url);
+    ck_assert(t->has_query);
+    ck_assert_int_eq(t->path_len, 6);
+    ck_assert_int_eq(t->query_offset, 7);
+    ck_assert_int_eq(t->num_args, 4);
+    ck_assert_int_eq(t->args[0].offset, 7);
+    ck_assert_int_eq(t->args[0].len, 3);
+    ck_assert_int_eq(t->args[1].offset, 11);
+    ck_assert_int_eq(t->args[1].len, 0);
+    ck_assert_int_eq(t->args[2].offset, 12);
+    ck_assert_int_eq(t->args[2].len, 5);
+    ck_assert_int_eq(t->args[3].offset, 18);
+    ck_assert_int_eq(t->args[3].len, 1);
+    ck_assert(!t->args_overflow);
+
+    t = parse_url("/?");
+    ck_assert(t->has_query);
+    ck_assert_int_eq(t->num_args, 1);
+    ck_assert_int_eq(t->args[0].len, 0);
+}
+END_TEST
+
+START_TEST(test_target_args_overflow) {
+    char url[8 + 4 * (MAX_URL_ARGS + 2)];
+    struct request_target *t;
+    size_t len;
+    int i;
+
+    /* Exactly MAX_URL_ARGS arguments fit */
+    len = sprintf(url, "/x?");
+    for (i = 0; i < MAX_URL_ARGS; i++) {
+        len += sprintf(url + len, "%sa=%d", i ? "&" : "", i % 10);
+    }
+    t = parse_url(url);
+    ck_assert_int_eq(t->num_args, MAX_URL_ARGS);
+    ck_assert(!t->args_overflow);
+
+    /* The rest of the query is left unrecorded */
+    strcpy(url + len, "&b=1&c=2");
+    t = parse_url(url);
+    ck_assert_int_eq(t->num_args, MAX_URL_ARGS);
+    ck_assert(t->args_overflow);
+    ck_assert_int_eq(t->unrecorded_args_offset, len + 1);
+    ck_assert_int_eq(t->args[MAX_URL_ARGS - 1].offset
+            + t->args[MAX_URL_ARGS - 1].len, len);
+}
+END_TEST
+
+Suite *http_util_suite() {
+    Suite *s = suite_create("HTTP utilities");
+
+    TCase *tc_memeq = tcase_create("URL encoded name matching");
+    tcase_add_checked_fixture(tc_memeq, setup_ev_data, teardown_ev_data);
+    tcase_add_test(tc_memeq, test_url_encoded_memeq);
+    tcase_add_test(tc_memeq, test_find_matching_param_order);
+    tcase_add_test(tc_memeq, test_find_matching_param_invalid);
+
+    TCase *tc_target = tcase_create("Request target tokenizer");
+    tcase_add_checked_fixture(tc_target, setup_ev_data, teardown_ev_data);
+    tcase_add_test(tc_target, test_target_dir_traversal);
+    tcase_add_test(tc_target, test_target_invalid_encoding);
+    tcase_add_test(tc_target, test_target_query_args);
+    tcase_add_test(tc_target, test_target_args_overflow);
+
+    suite_add_tcase(s, tc_memeq);
+    suite_add_tcase(s, tc_target);
+
+    return s;
+}
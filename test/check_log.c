@@ -0,0 +1,170 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <check.h>
+#include "check_all.h"
+#include "../src/log.h"
+
+static char *drained;
+static size_t drained_len;
+
+/* Drains queued log records into drained */
+static size_t drain_to_buf() {
+    FILE *out = open_memstream(&drained, &drained_len);
+    ck_assert(out != NULL);
+    size_t num = log_drain(out);
+    fclose(out);
+    return num;
+}
+
+/* Returns number of occurrences of s in drained */
+static int count_drained(const char *s) {
+    int n = 0;
+    char *p = drained;
+    while ((p = strstr(p, s)) != NULL) {
+        n++;
+        p += strlen(s);
+    }
+    return n;
+}
+
+static void setup() {
+    drained = NULL;
+    log_enable_async();
+    /* Discard records queued by earlier tests */
+    drain_to_buf();
+    free(drained);
+    drained = NULL;
+}
+
+static void teardown() {
+    free(drained);
+    log_stop_writer();
+}
+
+START_TEST(test_log_queued_until_drained) {
+    log_warn("first %d\n", 1);
+    log_error("second %s\n", "two");
+    ck_assert_int_eq(drain_to_buf(), 2);
+    ck_assert_str_eq(drained, "[warn ] first 1\n[error] second two\n");
+}
+END_TEST
+
+/* Logs from a single call site */
+static void log_flood(int i) {
+    log_info("flooding site %d\n", i);
+}
+
+START_TEST(test_log_rate_limited_per_site) {
+    int i;
+    for (i = 0; i < LOG_RATE_BURST + 5; i++) {
+        log_flood(i);
+        log_info("other site\n");
+        if (i == 0) {
+            log_info("other site\n");
+        }
+    }
+    drain_to_buf();
+    ck_assert_int_eq(count_drained("flooding site"), LOG_RATE_BURST);
+    /* The second call site with the same format has its own limit */
+    ck_assert_int_eq(count_drained("other site"), LOG_RATE_BURST + 1);
+    free(drained);
+
+    /* Suppressed count is reported with the next record of the new window */
+    sleep(LOG_RATE_INTERVAL_SEC + 1);
+    log_flood(0);
+    drain_to_buf();
+    ck_assert_str_eq(drained,
+            "[info ] flooding site 0 [5 similar messages suppressed]\n");
+}
+END_TEST
+
+START_TEST(test_log_rate_limited_alternating_sites) {
+    static struct log_rate_site sites[2 * LOG_RATE_BURST];
+    int i, j;
+
+    /* Interleaved sites do not reset each other's limit */
+    for (i = 0; i < LOG_RATE_BURST + 5; i++) {
+        for (j = 0; j < 2 * LOG_RATE_BURST; j++) {
+            log_submit(&sites[j], LOG_LEVEL_WARN, "rejected\n");
+        }
+    }
+    ck_assert_int_eq(drain_to_buf(), 2 * LOG_RATE_BURST * LOG_RATE_BURST);
+    for (j = 0; j < 2 * LOG_RATE_BURST; j++) {
+        ck_assert_int_eq(sites[j].suppressed, 5);
+    }
+}
+END_TEST
+
+START_TEST(test_log_ring_full) {
+    static struct log_rate_site sites[LOG_RING_SLOTS + 3];
+    int i;
+
+    for (i = 0; i < LOG_RING_SLOTS + 3; i++) {
+        log_submit(&sites[i], LOG_LEVEL_WARN, "site\n");
+    }
+    ck_assert_int_eq(drain_to_buf(), LOG_RING_SLOTS);
+    ck_assert(strstr(drained, "dropped 3 messages") != NULL);
+}
+END_TEST
+
+START_TEST(test_log_writer_wakes) {
+    int i;
+
+    /* Records are written promptly by the writer thread */
+    ck_assert_int_eq(log_start_writer(), 0);
+    for (i = 0; i < 3; i++) {
+        usleep(20000);
+        log_warn("wake %d\n", i);
+    }
+    log_stop_writer();
+    ck_assert_int_eq(drain_to_buf(), 0);
+}
+END_TEST
+
+START_TEST(test_log_truncated) {
+    char long_msg[LOG_MSG_MAX_LEN * 2];
+    memset(long_msg, 'a', sizeof(long_msg) - 1);
+    long_msg[sizeof(long_msg) - 1] = '\0';
+
+    log_warn("%s\n", long_msg);
+    drain_to_buf();
+    ck_assert_int_eq(drained_len,
+            strlen("[warn ] ") + LOG_MSG_MAX_LEN - 1);
+    ck_assert_str_eq(drained + drained_len - 4, "...\n");
+}
+END_TEST
+
+Suite *log_suite() {
+    Suite *s = suite_create("Log");
+
+    TCase *tc_ring = tcase_create("Log ring");
+    tcase_add_checked_fixture(tc_ring, setup, teardown);
+    tcase_add_test(tc_ring, test_log_queued_until_drained);
+    tcase_add_test(tc_ring, test_log_rate_limited_per_site);
+    tcase_add_test(tc_ring, test_log_rate_limited_alternating_sites);
+    tcase_add_test(tc_ring, test_log_ring_full);
+    tcase_add_test(tc_ring, test_log_writer_wakes);
+    tcase_add_test(tc_ring, test_log_truncated);
+    tcase_set_timeout(tc_ring, LOG_RATE_INTERVAL_SEC + 5);
+
+    suite_add_tcase(s, tc_ring);
+
+    return s;
+}
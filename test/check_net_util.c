@@ -0,0 +1,294 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <netinet/in.h>
+#include <sys/epoll.h>
+#include <sys/resource.h>
+#include <sys/socket.h>
+#include <check.h>
+#include "check_all.h"
+#include "../src/net_util.h"
+#include "../src/http_util.h"
+
+#if ENABLE_HTTPS
+#include <openssl/evp.h>
+#include <openssl/x509.h>
+
+#define HANDSHAKE_MAX_ROUNDS 100
+#define RESPONSE_MAX_LEN (4 * SENDALL_IOV_TLS_BUF_LEN)
+
+static SSL_CTX *server_ctx = NULL, *client_ctx = NULL;
+static SSL *server_ssl = NULL, *client_ssl = NULL;
+static struct fd_ctx server_fd_ctx;
+static int sock_fds[2] = {-1, -1};
+
+/* Application data records read by the client */
+static int records_read = 0;
+
+static void count_records(int write_p, int version, int content_type,
+        const void *buf, size_t len, SSL *ssl, void *arg) {
+    if (!write_p && content_type == SSL3_RT_HEADER && len > 0
+            && ((const unsigned char *) buf)[0] == SSL3_RT_APPLICATION_DATA) {
+        records_read++;
+    }
+}
+
+/* Creates self-signed certificate and private key for the server */
+static void use_test_cert(SSL_CTX *ctx) {
+    EVP_PKEY_CTX *key_ctx;
+    EVP_PKEY *key = NULL;
+    X509 *cert;
+
+    key_ctx = EVP_PKEY_CTX_new_id(EVP_PKEY_EC, NULL);
+    ck_assert(key_ctx != NULL);
+    ck_assert(EVP_PKEY_keygen_init(key_ctx) == 1);
+    ck_assert(EVP_PKEY_CTX_set_ec_paramgen_curve_nid(key_ctx,
+            NID_X9_62_prime256v1) == 1);
+    ck_assert(EVP_PKEY_keygen(key_ctx, &key) == 1);
+    EVP_PKEY_CTX_free(key_ctx);
+
+    cert = X509_new();
+    ck_assert(cert != NULL);
+    X509_set_version(cert, 2);
+    ASN1_INTEGER_set(X509_get_serialNumber(cert), 1);
+    X509_gmtime_adj(X509_get_notBefore(cert), 0);
+    X509_gmtime_adj(X509_get_notAfter(cert), 3600);
+    X509_set_pubkey(cert, key);
+    X509_NAME_add_entry_by_txt(X509_get_subject_name(cert), "CN", MBSTRING_ASC,
+            (const unsigned char *) "localhost", -1, -1, 0);
+    X509_set_issuer_name(cert, X509_get_subject_name(cert));
+    ck_assert(X509_sign(cert, key, EVP_sha256()) > 0);
+
+    ck_assert(SSL_CTX_use_certificate(ctx, cert) == 1);
+    ck_assert(SSL_CTX_use_PrivateKey(ctx, key) == 1);
+    X509_free(cert);
+    EVP_PKEY_free(key);
+}
+
+/* Connects TLS client and server over a socket pair */
+static void setup_tls() {
+    int server_done = 0, client_done = 0, i;
+
+    server_ctx = SSL_CTX_new(TLS_server_method());
+    client_ctx = SSL_CTX_new(TLS_client_method());
+    ck_assert(server_ctx != NULL && client_ctx != NULL);
+    use_test_cert(server_ctx);
+#ifdef TLS1_3_VERSION
+    /* Session tickets would be sent as application data records */
+    SSL_CTX_set_num_tickets(server_ctx, 0);
+#endif
+
+    ck_assert(socketpair(AF_UNIX, SOCK_STREAM, 0, sock_fds) == 0);
+    ck_assert(make_socket_non_blocking(sock_fds[0]) == 0);
+    ck_assert(make_socket_non_blocking(sock_fds[1]) == 0);
+
+    server_ssl = SSL_new(server_ctx);
+    client_ssl = SSL_new(client_ctx);
+    ck_assert(server_ssl != NULL && client_ssl != NULL);
+    SSL_set_fd(server_ssl, sock_fds[0]);
+    SSL_set_fd(client_ssl, sock_fds[1]);
+    SSL_set_accept_state(server_ssl);
+    SSL_set_connect_state(client_ssl);
+
+    for (i = 0; i < HANDSHAKE_MAX_ROUNDS && !(server_done && client_done);
+            i++) {
+        if (!client_done) {
+            client_done = SSL_do_handshake(client_ssl) == 1;
+        }
+        if (!server_done) {
+            server_done = SSL_do_handshake(server_ssl) == 1;
+        }
+    }
+    ck_assert(server_done && client_done);
+
+    records_read = 0;
+    SSL_set_msg_callback(client_ssl, count_records);
+
+    server_fd_ctx.sock_fd = sock_fds[0];
+    server_fd_ctx.is_tls = true;
+    server_fd_ctx.ssl = server_ssl;
+}
+
+static void teardown_tls() {
+    SSL_free(server_ssl);
+    SSL_free(client_ssl);
+    SSL_CTX_free(server_ctx);
+    SSL_CTX_free(client_ctx);
+    close_fd_if_valid(sock_fds[0]);
+    close_fd_if_valid(sock_fds[1]);
+}
+
+/* Reads len bytes of application data on the client */
+static void read_response(char *buf, size_t len) {
+    size_t got = 0;
+    int rc, i;
+
+    for (i = 0; i < HANDSHAKE_MAX_ROUNDS && got < len; i++) {
+        rc = SSL_read(client_ssl, buf + got, len - got);
+        if (rc > 0) {
+            got += rc;
+        }
+    }
+    ck_assert_int_eq(got, len);
+}
+
+/* Sends iov from the server and checks the client receives it in
+ * expected_records records */
+static void assert_sent_records(const struct iovec *iov, int iovcnt,
+        int expected_records) {
+    static char expected[RESPONSE_MAX_LEN], received[RESPONSE_MAX_LEN];
+    size_t len = 0;
+    int i;
+
+    for (i = 0; i < iovcnt; i++) {
+        memcpy(expected + len, iov[i].iov_base, iov[i].iov_len);
+        len += iov[i].iov_len;
+    }
+
+    ck_assert_int_eq(sendall_iov(&server_fd_ctx, iov, iovcnt), 0);
+    read_response(received, len);
+    ck_assert(memcmp(received, expected, len) == 0);
+    ck_assert_int_eq(records_read, expected_records);
+}
+
+START_TEST(test_sendall_iov_tls_one_record) {
+    struct iovec headers[] = {
+        {"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n", 42},
+        {"Set-Cookie: sessid=", 19},
+        {"0123456789abcdef0123456789abcdef", 32},
+        {"; HttpOnly", 10},
+        {"; Secure", 0},
+        {"\r\n", 2},
+        {"\r\n", 2},
+    };
+    struct iovec error[] = {
+        {HTTP_RESPONSE_FORBIDDEN, sizeof(HTTP_RESPONSE_FORBIDDEN) - 1},
+        {"<html>Forbidden</html>", 22},
+    };
+
+    /* Templated responses go out as one record */
+    assert_sent_records(headers, sizeof(headers) / sizeof(*headers), 1);
+    records_read = 0;
+    assert_sent_records(error, sizeof(error) / sizeof(*error), 1);
+}
+END_TEST
+
+START_TEST(test_sendall_iov_tls_large) {
+    static char page[SENDALL_IOV_TLS_BUF_LEN];
+    struct iovec fits[] = {
+        {HTTP_RESPONSE_FORBIDDEN, sizeof(HTTP_RESPONSE_FORBIDDEN) - 1},
+        {page, sizeof(page) - (sizeof(HTTP_RESPONSE_FORBIDDEN) - 1)},
+    };
+    struct iovec too_large[] = {
+        {HTTP_RESPONSE_FORBIDDEN, sizeof(HTTP_RESPONSE_FORBIDDEN) - 1},
+        {page, sizeof(page)},
+    };
+
+    memset(page, 'x', sizeof(page));
+    assert_sent_records(fits, 2, 1);
+
+    /* Response that does not fit is sent one buffer at a time */
+    records_read = 0;
+    assert_sent_records(too_large, 2, 2);
+}
+END_TEST
+#endif
+
+#define NUM_CLIENTS 4
+
+START_TEST(test_accept_out_of_fds) {
+    struct sockaddr_in addr = {0};
+    socklen_t addr_len = sizeof(addr);
+    struct fd_ctx listen_fd_ctx = {0};
+    struct event_data listen_ev_data = {0};
+    struct epoll_event ev = {0};
+    struct rlimit limit, saved_limit;
+    char buf[sizeof(HTTP_SERVICE_UNAVAILABLE) - 1];
+    int clients[NUM_CLIENTS];
+    int sfd, efd, fd, i;
+
+    sfd = socket(AF_INET, SOCK_STREAM, 0);
+    ck_assert(sfd >= 0);
+    addr.sin_family = AF_INET;
+    addr.sin_addr.s_addr = htonl(INADDR_LOOPBACK);
+    ck_assert(bind(sfd, (struct sockaddr *) &addr, sizeof(addr)) == 0);
+    ck_assert(listen(sfd, NUM_CLIENTS) == 0);
+    ck_assert(make_socket_non_blocking(sfd) == 0);
+    ck_assert(getsockname(sfd, (struct sockaddr *) &addr, &addr_len) == 0);
+
+    efd = epoll_create(1);
+    ck_assert(efd >= 0);
+    listen_fd_ctx.sock_fd = sfd;
+    listen_ev_data.listen_fd = &listen_fd_ctx;
+    ev.data.ptr = &listen_ev_data;
+    ev.events = EPOLLIN | EPOLLET;
+    ck_assert(epoll_ctl(efd, EPOLL_CTL_ADD, sfd, &ev) == 0);
+
+    for (i = 0; i < NUM_CLIENTS; i++) {
+        clients[i] = socket(AF_INET, SOCK_STREAM, 0);
+        ck_assert(clients[i] >= 0);
+        ck_assert(connect(clients[i], (struct sockaddr *) &addr, addr_len)
+                == 0);
+    }
+    ck_assert_int_eq(open_spare_fd(), 0);
+
+    /* Run out of descriptors before the connections are accepted */
+    fd = dup(sfd);
+    ck_assert(fd >= 0);
+    close(fd);
+    ck_assert(getrlimit(RLIMIT_NOFILE, &saved_limit) == 0);
+    limit = saved_limit;
+    limit.rlim_cur = fd;
+    ck_assert(setrlimit(RLIMIT_NOFILE, &limit) == 0);
+    ck_assert(dup(sfd) == -1 && errno == EMFILE);
+
+    /* Every pending connection is shed rather than left in the backlog */
+    ck_assert_int_eq(handle_new_connection(efd, &ev, sfd, false), 0);
+    for (i = 0; i < NUM_CLIENTS; i++) {
+        ck_assert_int_eq(recv(clients[i], buf, sizeof(buf), MSG_DONTWAIT),
+                sizeof(buf));
+        ck_assert(memcmp(buf, HTTP_SERVICE_UNAVAILABLE, sizeof(buf)) == 0);
+        close(clients[i]);
+    }
+
+    ck_assert(setrlimit(RLIMIT_NOFILE, &saved_limit) == 0);
+    ck_assert(accept(sfd, NULL, NULL) == -1 && errno == EAGAIN);
+    close(efd);
+    close(sfd);
+}
+END_TEST
+
+Suite *net_util_suite() {
+    Suite *s = suite_create("Network utilities");
+
+    TCase *tc_accept = tcase_create("Accept");
+    tcase_add_test(tc_accept, test_accept_out_of_fds);
+    suite_add_tcase(s, tc_accept);
+
+#if ENABLE_HTTPS
+    TCase *tc_tls = tcase_create("TLS sendall_iov");
+    tcase_add_checked_fixture(tc_tls, setup_tls, teardown_tls);
+    tcase_add_test(tc_tls, test_sendall_iov_tls_one_record);
+    tcase_add_test(tc_tls, test_sendall_iov_tls_large);
+    suite_add_tcase(s, tc_tls);
+#endif
+
+    return s;
+}
@@ -0,0 +1,107 @@
+/**
+ * Copyright 2015 Regents of the University of Michigan
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+#include <stdlib.h>
+#include <check.h>
+#include "check_all.h"
+#include "../src/whitelist_scan.h"
+
+#define SCAN_DATA_LEN 300
+
+/* Builds scan table from whitelist bitmap, like parse_config.py does */
+static void build_scan_table(const char *bitmap, char *scan_table) {
+    int i;
+    memset(scan_table, 0, WHITELIST_SCAN_LEN);
+    for (i = 0; i < 0x100; i++) {
+        if (i != '%' && whitelist_char_allowed(bitmap, i)) {
+            scan_table[((i >> 7) << 4) | (i & 0x0f)] |= 1 << ((i >> 4) & 0x7);
+        }
+    }
+}
+
+/* Returns length of allowed prefix one byte at a time */
+static size_t reference_scan_run(const char *bitmap, const char *data,
+        size_t len) {
+    size_t i;
+    for (i = 0; i < len; i++) {
+        if (data[i] == '%' || !whitelist_char_allowed(bitmap, data[i])) {
+            break;
+        }
+    }
+    return i;
+}
+
+START_TEST(test_scan_table_matches_bitmap) {
+    char bitmap[WHITELIST_PARAM_LEN], scan_table[WHITELIST_SCAN_LEN];
+    int i, c;
+
+    srand(_i + 1);
+    for (i = 0; i < WHITELIST_PARAM_LEN; i++) {
+        bitmap[i] = rand();
+    }
+    build_scan_table(bitmap, scan_table);
+
+    for (c = 0; c < 0x100; c++) {
+        ck_assert_int_eq(whitelist_scan_byte_allowed(scan_table, c),
+                c != '%' && whitelist_char_allowed(bitmap, c));
+    }
+}
+END_TEST
+
+START_TEST(test_scan_run_matches_reference) {
+    char bitmap[WHITELIST_PARAM_LEN], scan_table[WHITELIST_SCAN_LEN];
+    char data[SCAN_DATA_LEN];
+    size_t len, bad_pos;
+    int i;
+
+    /* Mostly allowed whitelist, so that runs are long */
+    srand(_i + 1);
+    memset(bitmap, 0xff, sizeof(bitmap));
+    for (i = 0; i < 8; i++) {
+        int c = rand() % 0x100;
+        bitmap[c / 8] &= ~(1 << (c % 8));
+    }
+    build_scan_table(bitmap, scan_table);
+
+    for (len = 0; len < SCAN_DATA_LEN; len += 7) {
+        for (i = 0; i < len; i++) {
+            data[i] = rand();
+        }
+        ck_assert_int_eq(whitelist_scan_run(scan_table, data, len),
+                reference_scan_run(bitmap, data, len));
+
+        /* Force a stop at a chosen position */
+        if (len > 0) {
+            bad_pos = rand() % len;
+            data[bad_pos] = '%';
+            ck_assert_int_eq(whitelist_scan_run(scan_table, data, len),
+                    reference_scan_run(bitmap, data, len));
+        }
+    }
+}
+END_TEST
+
+Suite *whitelist_scan_suite() {
+    Suite *s = suite_create("Whitelist scan");
+
+    TCase *tc_scan = tcase_create("Whitelist scan run");
+    tcase_add_loop_test(tc_scan, test_scan_table_matches_bitmap, 0, 16);
+    tcase_add_loop_test(tc_scan, test_scan_run_matches_reference, 0, 16);
+
+    suite_add_tcase(s, tc_scan);
+
+    return s;
+}
@@ -0,0 +1,742 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end load test for the Umbra shim.
+
+Builds the shim with a generated configuration, starts a stub HTTP(S) backend
+and the shim on localhost, and drives a configurable traffic mix through the
+shim. Reports throughput, latency percentiles, shim CPU time per request and
+shim RSS over time. Runs entirely offline.
+
+Example:
+
+    python3 test/loadtest.py --duration 30 --concurrency 64 \\
+        --mix get=40,post=20,cookie=15,chunked=15,csrf=10 \\
+        --requests-per-connection 20 --json results.json
+
+Use --baseline with the JSON output of an earlier run to exit with a non-zero
+status when throughput or p99 latency regress by more than --max-regression.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import shutil
+import signal
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+CONFIG_DIR = os.path.join(REPO_DIR, 'config')
+
+SHIM_SESSID_NAME = 'SHIM_SESSID'
+CSRF_TOKEN_NAME = '_umbra_csrf_token'
+AUTH_USER = 'loadtest'
+AUTH_PASSWD = 'loadtest'
+
+BACKEND_BODY = (b'<html><head><title>Load test</title></head><body>'
+                b'<form action="/cgi-bin/comment" method="post">'
+                b'<input type="text" name="comment"></form>'
+                + b'x' * 2048 + b'</body></html>')
+
+# Kind of request -> description, used for --mix and in the report
+REQUEST_KINDS = {
+    'get': 'GET of a static page with URL parameters',
+    'post': 'form POST without session state',
+    'cookie': 'GET carrying the session cookie and application cookies',
+    'chunked': 'GET of a CSRF protected page sent with chunked encoding',
+    'csrf': 'POST to a CSRF protected form action with a valid token',
+    'auth': 'GET of a page that requires HTTP Basic authentication',
+}
+
+DEFAULT_MIX = 'get=40,post=20,cookie=15,chunked=15,csrf=10'
+
+
+class LoadTestError(Exception):
+    """Load test could not be set up or run"""
+    pass
+
+
+def parse_mix(mix_str):
+    """Parses "kind=weight,..." into a list of (kind, weight) pairs"""
+    mix = []
+    for item in mix_str.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise LoadTestError('Unknown request kind "%s"; expected one of %s'
+                                % (kind, ', '.join(sorted(REQUEST_KINDS))))
+        try:
+            weight = float(weight) if weight else 1.0
+        except ValueError:
+            raise LoadTestError('Invalid weight for "%s"' % kind)
+        if weight < 0:
+            raise LoadTestError('Negative weight for "%s"' % kind)
+        mix.append((kind, weight))
+    if not any(weight > 0 for _, weight in mix):
+        raise LoadTestError('Traffic mix has no positive weights')
+    return mix
+
+
+def make_config(args):
+    """Returns shim configuration matching the pages the clients request"""
+    return {
+        'global_config': {
+            'max_header_field_len': 40,
+            'max_header_value_len': 400,
+            'enable_header_field_len_check': True,
+            'enable_header_value_len_check': True,
+            'enable_request_type_check': True,
+            'enable_param_len_check': True,
+            'enable_param_whitelist_check': True,
+            'enable_url_directory_traversal_check': True,
+            'enable_csrf_protection': True,
+            'enable_https': args.tls,
+            'enable_authentication_check': True,
+            'enable_compiled_page_checks': args.compiled_page_checks,
+            # Every client connection may create a session
+            'max_num_sessions': max(1024, 4 * args.concurrency),
+            'session_life_seconds': 3600,
+            'max_connections': max(500, 2 * args.concurrency),
+            'max_pending_connections': max(128, args.concurrency),
+        },
+        'default_page_config': {
+            'request_types': ['GET', 'HEAD'],
+            'restrict_params': False,
+            'requires_login': True,
+            'has_csrf_form': False,
+            'receives_csrf_form_action': False,
+            'max_param_len': 30,
+            'whitelist': '[a-zA-Z0-9_]',
+        },
+        'page_config': {
+            '/': {
+                'restrict_params': True,
+                'requires_login': False,
+                'has_csrf_form': True,
+            },
+            '/static.html': {
+                'requires_login': False,
+            },
+            '/chunked.html': {
+                'restrict_params': True,
+                'requires_login': False,
+                'has_csrf_form': True,
+            },
+            '/private.html': {
+                'restrict_params': True,
+            },
+            '/cgi-bin/login': {
+                'request_types': ['POST'],
+                'requires_login': False,
+                'params': {
+                    'user': {'whitelist': '[a-z0-9_]'},
+                    'passwd': {'whitelist': '[a-zA-Z0-9_]'},
+                },
+            },
+            '/cgi-bin/comment': {
+                'request_types': ['POST'],
+                'requires_login': False,
+                'receives_csrf_form_action': True,
+                'params': {
+                    'comment': {
+                        'max_param_len': 200,
+                        'whitelist': '[A-Za-z0-9 .,!?+]',
+                    },
+                },
+            },
+        },
+    }
+
+
+def build_shim(args, work_dir):
+    """Builds the shim with the generated configuration in a copy of the
+    source tree. Returns the path of the shim binary."""
+    build_src = os.path.join(work_dir, 'src')
+    build_config = os.path.join(work_dir, 'config')
+    shutil.copytree(SRC_DIR, build_src, ignore=shutil.ignore_patterns(
+        '*.o', '.deps', 'shim', 'shim-dbg', 'shim-trace', 'config_printer',
+        'config.h', 'config.c'))
+    os.mkdir(build_config)
+    shutil.copy(os.path.join(CONFIG_DIR, 'parse_config.py'), build_config)
+
+    config_file = os.path.join(build_config, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(make_config(args), f, indent=4, sort_keys=True)
+
+    # Generate config after copying so make considers it up to date
+    run_checked([args.config_python, '../config/parse_config.py',
+                 '../config/config.json', 'config.h', 'config.c'],
+                cwd=build_src)
+    make_args = ['make', 'shim']
+    if args.cflags:
+        make_args.append('CFLAGS=%s' % args.cflags)
+    run_checked(make_args, cwd=build_src)
+    return os.path.join(build_src, 'shim')
+
+
+def run_checked(cmd, cwd=None):
+    """Runs command, raising LoadTestError with its output on failure"""
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        raise LoadTestError('Command failed: %s\n%s' % (
+            ' '.join(cmd), proc.stdout.decode('utf-8', 'replace')))
+
+
+def make_tls_files(work_dir):
+    """Creates a self-signed certificate for localhost"""
+    cert = os.path.join(work_dir, 'cert.pem')
+    key = os.path.join(work_dir, 'key.pem')
+    run_checked(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                 '-keyout', key, '-out', cert, '-days', '1',
+                 '-subj', '/CN=localhost'])
+    return cert, key
+
+
+# Stub backend
+
+async def read_http_message(reader, is_response=False, method=None):
+    """Reads one HTTP message. Returns (first line, headers, body, keep_alive)
+    or None if the connection closed before a message started."""
+    first_line = await reader.readline()
+    if not first_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed in headers')
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    first = first_line.decode('latin-1').split()
+    version = first[0] if is_response else first[2]
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        keep_alive = connection != 'close'
+    else:
+        keep_alive = connection == 'keep-alive'
+
+    no_body = is_response and (method == 'HEAD' or first[1] in ('204', '304'))
+    if no_body:
+        body = b''
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        body = await read_chunked_body(reader)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif is_response:
+        body = await reader.read()
+        keep_alive = False
+    else:
+        body = b''
+    return first, headers, body, keep_alive
+
+
+async def read_chunked_body(reader):
+    """Reads a chunked body, returning the decoded bytes"""
+    chunks = []
+    while True:
+        size_line = await reader.readline()
+        size = int(size_line.split(b';')[0].strip(), 16)
+        if size == 0:
+            # Skip trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return b''.join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+async def handle_backend_conn(reader, writer):
+    """Serves requests on one backend connection"""
+    try:
+        while True:
+            msg = await read_http_message(reader)
+            if msg is None:
+                break
+            first, _, _, keep_alive = msg
+            path = first[1]
+            head = ['HTTP/1.1 200 OK', 'Content-Type: text/html']
+            if not keep_alive:
+                head.append('Connection: close')
+            if path.startswith('/chunked'):
+                head.append('Transfer-Encoding: chunked')
+                half = len(BACKEND_BODY) // 2
+                body = b''.join(b'%x\r\n%s\r\n' % (len(part), part) for part in
+                                (BACKEND_BODY[:half], BACKEND_BODY[half:]))
+                body += b'0\r\n\r\n'
+            else:
+                body = BACKEND_BODY
+                head.append('Content-Length: %d' % len(body))
+            if first[0] == 'HEAD':
+                body = b''
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError,
+            asyncio.CancelledError):
+        # Cancelled when the load test shuts down
+        pass
+    finally:
+        writer.close()
+
+
+# Clients
+
+class Stats(object):
+    """Results collected by the clients"""
+
+    def __init__(self):
+        self.latencies = []
+        self.by_kind = {}
+        self.errors = {}
+        self.connections = 0
+        self.recording = False
+        self.draining = False
+
+    def record(self, kind, latency, ok):
+        """Records one completed request"""
+        if not self.recording:
+            return
+        self.latencies.append(latency)
+        counts = self.by_kind.setdefault(kind, [0, 0])
+        counts[0 if ok else 1] += 1
+
+    def record_error(self, kind, exc):
+        """Records a request that failed at the connection level, including
+        requests still outstanding when the measurement ends"""
+        if not (self.recording or self.draining):
+            return
+        key = '%s: %s' % (kind, type(exc).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+class Client(object):
+    """A browser-like client with a cookie jar that issues requests over a
+    series of keep-alive connections"""
+
+    def __init__(self, args, stats, mix, ssl_ctx):
+        self.args = args
+        self.stats = stats
+        self.kinds = [kind for kind, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.ssl_ctx = ssl_ctx
+        self.session_id = None
+        self.rand = random.Random()
+
+    def build_request(self, kind):
+        """Returns (method, raw request) for a request of the given kind"""
+        path, body = '/', None
+        headers = ['Host: localhost']
+        cookies = []
+
+        if kind == 'get':
+            path = '/static.html?page=%d&sort=name' % self.rand.randint(1, 99)
+        elif kind == 'post':
+            path = '/cgi-bin/login'
+            body = 'user=user%d&passwd=Secret_%d' % (
+                self.rand.randint(1, 99), self.rand.randint(1, 9999))
+        elif kind == 'cookie':
+            path = '/'
+            cookies = ['theme=dark', 'lang=en', 'tracking=%016x'
+                       % self.rand.getrandbits(64)]
+        elif kind == 'chunked':
+            path = '/chunked.html'
+        elif kind == 'csrf':
+            path = '/cgi-bin/comment'
+            body = 'comment=Load+test+comment+%d&%s=%s' % (
+                self.rand.randint(1, 9999), CSRF_TOKEN_NAME,
+                self.session_id or '')
+        elif kind == 'auth':
+            path = '/private.html'
+            creds = base64.b64encode(
+                ('%s:%s' % (AUTH_USER, AUTH_PASSWD)).encode()).decode()
+            headers.append('Authorization: Basic %s' % creds)
+
+        if self.session_id is not None:
+            cookies.insert(0, '%s=%s' % (SHIM_SESSID_NAME, self.session_id))
+        if cookies:
+            headers.append('Cookie: %s' % '; '.join(cookies))
+
+        method = 'GET' if body is None else 'POST'
+        if body is not None:
+            headers.append('Content-Type: application/x-www-form-urlencoded')
+            headers.append('Content-Length: %d' % len(body))
+        raw = '%s %s HTTP/1.1\r\n%s\r\n\r\n%s' % (
+            method, path, '\r\n'.join(headers), body or '')
+        return method, raw.encode()
+
+    def update_cookies(self, headers):
+        """Keeps the session ID sent by the shim"""
+        cookie = headers.get('set-cookie', '')
+        prefix = SHIM_SESSID_NAME + '='
+        if cookie.startswith(prefix):
+            self.session_id = cookie[len(prefix):].split(';')[0]
+
+    async def run(self, stop_time):
+        """Issues requests until stop_time"""
+        port = self.args.shim_tls_port if self.args.tls else self.args.shim_port
+        while time.monotonic() < stop_time:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port, ssl=self.ssl_ctx)
+            except OSError as exc:
+                self.stats.record_error('connect', exc)
+                await asyncio.sleep(0.01)
+                continue
+            if self.stats.recording:
+                self.stats.connections += 1
+            try:
+                await self.run_connection(reader, writer, stop_time)
+            finally:
+                writer.close()
+
+    async def run_connection(self, reader, writer, stop_time):
+        """Issues up to --requests-per-connection requests on a connection"""
+        for _ in range(self.args.requests_per_connection):
+            if time.monotonic() >= stop_time:
+                return
+            kind = self.rand.choices(self.kinds, self.weights)[0]
+            if kind == 'csrf' and self.session_id is None:
+                kind = 'cookie' # Need a session for a valid token
+            method, raw = self.build_request(kind)
+            start = time.monotonic()
+            try:
+                writer.write(raw)
+                await writer.drain()
+                msg = await asyncio.wait_for(
+                    read_http_message(reader, is_response=True, method=method),
+                    self.args.timeout)
+                if msg is None:
+                    raise ConnectionError('Connection closed')
+            except (OSError, ConnectionError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError, ValueError) as exc:
+                self.stats.record_error(kind, exc)
+                return
+            first, headers, _, keep_alive = msg
+            self.stats.record(kind, time.monotonic() - start,
+                              first[1].startswith('2'))
+            self.update_cookies(headers)
+            if not keep_alive:
+                return
+
+
+# Process measurements
+
+def read_cpu_seconds(pid):
+    """Returns user + system CPU seconds used by process"""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    return (int(fields[11]) + int(fields[12])) / float(ticks)
+
+
+def read_rss_kb(pid):
+    """Returns resident set size of process in KiB"""
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+async def sample_rss(pid, interval, start, samples):
+    """Appends (seconds since start, RSS KiB) to samples every interval"""
+    while True:
+        samples.append((round(time.monotonic() - start, 3), read_rss_kb(pid)))
+        await asyncio.sleep(interval)
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+async def wait_for_port(port, timeout):
+    """Waits until something listens on localhost port"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise LoadTestError('Nothing listening on port %d' % port)
+            await asyncio.sleep(0.05)
+
+
+async def run_load(args, shim_path, work_dir):
+    """Starts backend and shim, runs the clients and returns the results"""
+    mix = parse_mix(args.mix)
+    backend_ssl = client_ssl = None
+    shim_args = [shim_path,
+                 '--shim-http-port', str(args.shim_port),
+                 '--server-http-port', str(args.backend_port)]
+
+    if args.tls:
+        cert, key = make_tls_files(work_dir)
+        backend_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        backend_ssl.load_cert_chain(cert, key)
+        client_ssl = ssl.create_default_context()
+        client_ssl.check_hostname = False
+        client_ssl.verify_mode = ssl.CERT_NONE
+        shim_args += ['--shim-tls-port', str(args.shim_tls_port),
+                      '--server-tls-port', str(args.backend_tls_port),
+                      '--tls-cert', cert, '--tls-key', key]
+
+    passwd_file = os.path.join(work_dir, 'passwd')
+    with open(passwd_file, 'w') as f:
+        f.write(base64.b64encode(
+            ('%s:%s' % (AUTH_USER, AUTH_PASSWD)).encode()).decode() + '\n')
+    shim_args += ['--passwd-file', passwd_file]
+
+    servers = [await asyncio.start_server(
+        handle_backend_conn, '127.0.0.1', args.backend_port,
+        backlog=1024)]
+    if args.tls:
+        servers.append(await asyncio.start_server(
+            handle_backend_conn, '127.0.0.1', args.backend_tls_port,
+            ssl=backend_ssl, backlog=1024))
+
+    shim_log = open(os.path.join(work_dir, 'shim.log'), 'wb')
+    shim = subprocess.Popen(shim_args, stdout=shim_log,
+                            stderr=subprocess.STDOUT)
+    rss_task = None
+    try:
+        await wait_for_port(args.shim_tls_port if args.tls else args.shim_port,
+                            5.0)
+        stats = Stats()
+        clients = [Client(args, stats, mix, client_ssl)
+                   for _ in range(args.concurrency)]
+        start = time.monotonic()
+        stop_time = start + args.warmup + args.duration
+        tasks = [asyncio.ensure_future(c.run(stop_time)) for c in clients]
+
+        await asyncio.sleep(args.warmup)
+        if shim.poll() is not None:
+            raise LoadTestError('Shim exited during warmup; see %s'
+                                % shim_log.name)
+        rss_samples = []
+        measure_start = time.monotonic()
+        cpu_start = read_cpu_seconds(shim.pid)
+        stats.recording = True
+        rss_task = asyncio.ensure_future(sample_rss(
+            shim.pid, args.sample_interval, measure_start, rss_samples))
+
+        await asyncio.sleep(max(0.0, stop_time - time.monotonic()))
+        stats.recording = False
+        stats.draining = True
+        elapsed = time.monotonic() - measure_start
+        if shim.poll() is not None:
+            raise LoadTestError('Shim exited during test; see %s'
+                                % shim_log.name)
+        cpu_seconds = read_cpu_seconds(shim.pid) - cpu_start
+        rss_samples.append((round(elapsed, 3), read_rss_kb(shim.pid)))
+        await asyncio.wait(tasks, timeout=args.timeout + 1)
+    finally:
+        if rss_task is not None:
+            rss_task.cancel()
+        if shim.poll() is None:
+            shim.send_signal(signal.SIGINT)
+            try:
+                shim.wait(5)
+            except subprocess.TimeoutExpired:
+                shim.kill()
+        shim_log.close()
+        for server in servers:
+            server.close()
+
+    return summarize(args, stats, elapsed, cpu_seconds, rss_samples)
+
+
+def summarize(args, stats, elapsed, cpu_seconds, rss_samples):
+    """Returns dictionary of results"""
+    latencies = sorted(stats.latencies)
+    completed = len(latencies)
+    return {
+        'config': {
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'mix': args.mix,
+            'requests_per_connection': args.requests_per_connection,
+            'tls': args.tls,
+            'compiled_page_checks': args.compiled_page_checks,
+        },
+        'requests': completed,
+        'connections': stats.connections,
+        'requests_per_sec': completed / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1e3,
+            'p99': percentile(latencies, 99) * 1e3,
+            'p999': percentile(latencies, 99.9) * 1e3,
+            'max': latencies[-1] * 1e3 if latencies else 0.0,
+        },
+        'cpu_us_per_request': (cpu_seconds / completed * 1e6
+                               if completed else 0.0),
+        'rss_kb': rss_samples,
+        'by_kind': {kind: {'ok': ok, 'not_ok': not_ok}
+                    for kind, (ok, not_ok) in stats.by_kind.items()},
+        'errors': stats.errors,
+    }
+
+
+def print_report(results):
+    """Prints human readable results"""
+    lat = results['latency_ms']
+    rss = [kb for _, kb in results['rss_kb']]
+    print('Requests:          %d over %d connections'
+          % (results['requests'], results['connections']))
+    print('Throughput:        %.1f req/s' % results['requests_per_sec'])
+    print('Latency (ms):      p50=%.3f p99=%.3f p999=%.3f max=%.3f'
+          % (lat['p50'], lat['p99'], lat['p999'], lat['max']))
+    print('Shim CPU/request:  %.1f us' % results['cpu_us_per_request'])
+    if rss:
+        print('Shim RSS (KiB):    start=%d end=%d max=%d'
+              % (rss[0], rss[-1], max(rss)))
+    print('RSS over time (s, KiB):')
+    for secs, kb in results['rss_kb']:
+        print('  %8.2f %8d' % (secs, kb))
+    print('Responses by kind (2xx / other):')
+    for kind in sorted(results['by_kind']):
+        counts = results['by_kind'][kind]
+        print('  %-8s %8d / %d' % (kind, counts['ok'], counts['not_ok']))
+    if results['errors']:
+        print('Connection errors:')
+        for key in sorted(results['errors']):
+            print('  %-30s %d' % (key, results['errors'][key]))
+
+
+def check_regression(results, baseline_file, max_regression):
+    """Returns list of regressions compared to baseline results"""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    allowed = 1.0 + max_regression / 100.0
+    regressions = []
+    if results['requests_per_sec'] * allowed < baseline['requests_per_sec']:
+        regressions.append('throughput %.1f req/s < baseline %.1f req/s' % (
+            results['requests_per_sec'], baseline['requests_per_sec']))
+    if results['latency_ms']['p99'] > baseline['latency_ms']['p99'] * allowed:
+        regressions.append('p99 latency %.3f ms > baseline %.3f ms' % (
+            results['latency_ms']['p99'], baseline['latency_ms']['p99']))
+    total = sum(c['ok'] + c['not_ok'] for c in results['by_kind'].values())
+    not_ok = sum(c['not_ok'] for c in results['by_kind'].values())
+    if total == 0 or not_ok or results['errors']:
+        regressions.append('%d of %d responses were not 2xx, %d connection '
+                           'errors' % (not_ok, total,
+                                       sum(results['errors'].values())))
+    return regressions
+
+
+def parse_args():
+    """Parses command line arguments"""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        epilog='Request kinds: ' + '; '.join(
+            '%s: %s' % item for item in sorted(REQUEST_KINDS.items())))
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to measure (default: %(default)s)')
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help='seconds of load before measuring '
+                        '(default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='number of concurrent clients '
+                        '(default: %(default)s)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted request kinds (default: %(default)s)')
+    parser.add_argument('--requests-per-connection', type=int, default=20,
+                        help='keep-alive requests before a client reconnects; '
+                        '1 gives full connection churn (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='per-request timeout in seconds')
+    parser.add_argument('--tls', action='store_true',
+                        help='build the shim with HTTPS and send all traffic '
+                        'over TLS')
+    parser.add_argument('--compiled-page-checks', action='store_true',
+                        help='build with enable_compiled_page_checks')
+    parser.add_argument('--shim', help='use this shim binary instead of '
+                        'building one; it must be built from the --write-config '
+                        'output')
+    parser.add_argument('--write-config', metavar='FILE',
+                        help='write the generated configuration and exit')
+    parser.add_argument('--config-python', default='python2.7',
+                        help='Python used to run parse_config.py '
+                        '(default: %(default)s)')
+    parser.add_argument('--cflags', help='CFLAGS for building the shim')
+    parser.add_argument('--shim-port', type=int, default=18080)
+    parser.add_argument('--backend-port', type=int, default=18000)
+    parser.add_argument('--shim-tls-port', type=int, default=18443)
+    parser.add_argument('--backend-tls-port', type=int, default=14430)
+    parser.add_argument('--sample-interval', type=float, default=1.0,
+                        help='seconds between RSS samples')
+    parser.add_argument('--json', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='JSON results to compare against')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='allowed regression against baseline in percent '
+                        '(default: %(default)s)')
+    parser.add_argument('--keep-work-dir', action='store_true',
+                        help='keep build directory and shim log')
+    return parser.parse_args()
+
+
+def main():
+    """Main driver function"""
+    args = parse_args()
+
+    if args.write_config:
+        with open(args.write_config, 'w') as f:
+            json.dump(make_config(args), f, indent=4, sort_keys=True)
+        return 0
+
+    try:
+        parse_mix(args.mix)
+    except LoadTestError as exc:
+        print('Error: %s' % exc, file=sys.stderr)
+        return 2
+
+    work_dir = tempfile.mkdtemp(prefix='umbra-loadtest-')
+    try:
+        shim_path = args.shim or build_shim(args, work_dir)
+        results = asyncio.run(run_load(args, shim_path, work_dir))
+    except LoadTestError as exc:
+        print('Error: %s' % exc, file=sys.stderr)
+        args.keep_work_dir = True
+        return 2
+    finally:
+        if args.keep_work_dir:
+            print('Work directory: %s' % work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        regressions = check_regression(results, args.baseline,
+                                       args.max_regression)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+"""
+Replay test for config/policy_sim.py.
+
+Replays one request per shim check through the policy simulator and through a
+debug build of the shim with the same configuration, and compares the cancel
+reasons of both with the expected ones. The shim's reason is read from the
+"Canceling connection" trace of cancel_connection(). Runs entirely offline.
+
+Example:
+
+    python3 test/policy_sim_replay.py
+
+Use --no-shim to only check the simulator against the expected reasons.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest import (CONFIG_DIR, CSRF_TOKEN_NAME, SHIM_SESSID_NAME, SRC_DIR,
+                      LoadTestError, handle_backend_conn, run_checked,
+                      wait_for_port)
+
+AUTH_USER = 'replay'
+AUTH_PASSWD = 'replay'
+
+CONFIG = {
+    'global_config': {
+        'max_header_field_len': 40,
+        'max_header_value_len': 400,
+        'enable_header_field_len_check': True,
+        'enable_header_value_len_check': True,
+        'enable_request_type_check': True,
+        'enable_param_len_check': True,
+        'enable_param_whitelist_check': True,
+        'enable_url_directory_traversal_check': True,
+        'enable_csrf_protection': True,
+        'enable_https': False,
+        'enable_authentication_check': True,
+        'enable_compiled_page_checks': False,
+        'session_life_seconds': 3600,
+    },
+    'default_page_config': {
+        'request_types': ['GET', 'HEAD'],
+        'restrict_params': False,
+        'requires_login': False,
+        'has_csrf_form': False,
+        'receives_csrf_form_action': False,
+        'max_param_len': 30,
+        'whitelist': '[a-z0-9]',
+    },
+    'page_config': {
+        '/': {
+            'restrict_params': True,
+            'params': {
+                'user': {'max_param_len': 4, 'whitelist': '[a-z]'},
+            },
+        },
+        '/secret': {
+            'requires_login': True,
+        },
+        '/form': {
+            'request_types': ['GET', 'POST', 'PUT'],
+            'receives_csrf_form_action': True,
+        },
+    },
+}
+
+# (description, logged user, method, target, expected reason, shim code path)
+CASES = [
+    ('allowed', '-', 'GET', '/?user=abc', 'REASON_NOT_CANCELLED', ''),
+    ('method', '-', 'DELETE', '/', 'REASON_INTERNAL_ERROR',
+     'check_request_type()'),
+    ('traversal', '-', 'GET', '/a/../b', 'REASON_DIR_TRAVERSAL',
+     'check_url_dir_traversal()'),
+    ('invalid encoding', '-', 'GET', '/a%zz', 'REASON_INVALID_HTTP',
+     'check_url_dir_traversal()'),
+    ('param not allowed', '-', 'GET', '/?other=1', 'REASON_PARAM_NOT_ALLOWED',
+     'match_page_param()'),
+    ('whitelist', '-', 'GET', '/?user=aB', 'REASON_PARAM_CHARACTER_NOT_ALLOWED',
+     'check_char_whitelist()'),
+    ('length', '-', 'GET', '/?user=abcde', 'REASON_PARAM_LEN_EXCEEDED',
+     'check_arg_len_whitelist()'),
+    ('auth', '-', 'GET', '/secret', 'REASON_NO_AUTH_HEADER',
+     'check_page_auth()'),
+    ('auth with user', AUTH_USER, 'GET', '/secret', 'REASON_NOT_CANCELLED',
+     ''),
+    ('CSRF token on POST', '-', 'POST', '/form', 'REASON_NOT_CANCELLED', ''),
+    ('CSRF token missing', '-', 'GET', '/form', 'REASON_INVALID_CSRF_TOKEN',
+     'on_message_complete_cb()'),
+    ('CSRF token in PUT body', '-', 'PUT', '/form',
+     'REASON_INVALID_CSRF_TOKEN', 'on_message_complete_cb()'),
+    ('CSRF cookie', '-', 'GET', '/form?%s=x' % CSRF_TOKEN_NAME,
+     'REASON_INVALID_CSRF_COOKIE', 'check_csrf_token_arg()'),
+]
+
+SIMULATE_SCRIPT = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import policy_sim
+simulator = policy_sim.PolicySimulator(policy_sim.parse_config(sys.argv[2]))
+requests = [tuple(str(x) for x in r) for r in json.load(sys.stdin)]
+_, reasons = simulator.simulate(requests)
+print(json.dumps([policy_sim.REASON_NAMES[x] for x in reasons]))
+'''
+
+CANCEL_RE = re.compile(r'Canceling connection:\s*\n[^\n]*?(REASON_\w+)')
+
+
+def simulate(args, config_file):
+    """Returns simulator cancel reason names of CASES"""
+    requests = [[user, method, target]
+                for _, user, method, target, _, _ in CASES]
+    proc = subprocess.run(
+        [args.config_python, '-c', SIMULATE_SCRIPT, CONFIG_DIR, config_file],
+        input=json.dumps(requests).encode(), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise LoadTestError('Simulator failed:\n%s'
+                            % proc.stderr.decode('utf-8', 'replace'))
+    # parse_config() reports progress on stdout
+    return json.loads(proc.stdout.decode().splitlines()[-1])
+
+
+def build_shim_dbg(args, work_dir):
+    """Builds shim-dbg with CONFIG in a copy of the source tree, like
+    loadtest.build_shim(). Returns the path of the binary."""
+    build_src = os.path.join(work_dir, 'src')
+    shutil.copytree(SRC_DIR, build_src, ignore=shutil.ignore_patterns(
+        '*.o', '.deps', 'shim', 'shim-dbg', 'shim-trace', 'config_printer',
+        'config.h', 'config.c'))
+    shutil.copytree(CONFIG_DIR, os.path.join(work_dir, 'config'),
+                    ignore=shutil.ignore_patterns('*.pyc', 'config.json'))
+    with open(os.path.join(work_dir, 'config', 'config.json'), 'w') as f:
+        json.dump(CONFIG, f, indent=4, sort_keys=True)
+    run_checked([args.config_python, '../config/parse_config.py',
+                 '../config/config.json', 'config.h', 'config.c'],
+                cwd=build_src)
+    run_checked(['make', 'shim-dbg'], cwd=build_src)
+    return os.path.join(build_src, 'shim-dbg')
+
+
+async def send_request(args, raw):
+    """Sends raw request to the shim. Returns the response."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', args.shim_port)
+    writer.write(raw)
+    await writer.drain()
+    try:
+        response = await asyncio.wait_for(reader.read(), args.timeout)
+    except asyncio.TimeoutError:
+        response = b''
+    writer.close()
+    return response
+
+
+def build_request(user, method, target, session_id):
+    """Returns request as the simulator assumes it was sent: logged users are
+    authenticated, and request bodies carry a valid CSRF token"""
+    head = ['%s %s HTTP/1.1' % (method, target), 'Host: localhost',
+            'Connection: close',
+            'Cookie: %s=%s' % (SHIM_SESSID_NAME, session_id)]
+    if user != '-':
+        head.append('Authorization: Basic ' + base64.b64encode(
+            ('%s:%s' % (AUTH_USER, AUTH_PASSWD)).encode()).decode())
+    body = ''
+    if method in ('POST', 'PUT'):
+        body = '%s=%s' % (CSRF_TOKEN_NAME, session_id)
+        head.append('Content-Type: application/x-www-form-urlencoded')
+        head.append('Content-Length: %d' % len(body))
+    return ('\r\n'.join(head) + '\r\n\r\n' + body).encode()
+
+
+async def replay_shim(args, shim_path, work_dir):
+    """Returns shim cancel reason names of CASES"""
+    passwd_file = os.path.join(work_dir, 'passwd')
+    with open(passwd_file, 'w') as f:
+        f.write(base64.b64encode(
+            ('%s:%s' % (AUTH_USER, AUTH_PASSWD)).encode()).decode() + '\n')
+    shim_args = [shim_path,
+                 '--shim-http-port', str(args.shim_port),
+                 '--server-http-port', str(args.backend_port),
+                 '--passwd-file', passwd_file]
+
+    server = await asyncio.start_server(handle_backend_conn, '127.0.0.1',
+                                        args.backend_port)
+    log_path = os.path.join(work_dir, 'shim.log')
+    shim_log = open(log_path, 'wb')
+    shim = subprocess.Popen(shim_args, stdout=shim_log,
+                            stderr=subprocess.STDOUT)
+    reasons = []
+    try:
+        await wait_for_port(args.shim_port, 5.0)
+
+        # Any response starts a session
+        response = await send_request(
+            args, b'GET / HTTP/1.1\r\nHost: localhost\r\n'
+            b'Connection: close\r\n\r\n')
+        match = re.search(SHIM_SESSID_NAME.encode() + b'=([0-9A-Fa-f]+)',
+                          response)
+        if match is None:
+            raise LoadTestError('No session cookie in response')
+        session_id = match.group(1).decode()
+
+        with open(log_path, 'rb') as log:
+            for _, user, method, target, _, _ in CASES:
+                log.seek(0, os.SEEK_END)
+                response = await send_request(
+                    args, build_request(user, method, target, session_id))
+                if not response:
+                    raise LoadTestError('No response to %s %s'
+                                        % (method, target))
+                # DEBUG builds log synchronously
+                time.sleep(0.05)
+                cancel = CANCEL_RE.search(log.read().decode('latin-1'))
+                reasons.append(cancel.group(1) if cancel
+                               else 'REASON_NOT_CANCELLED')
+    finally:
+        if shim.poll() is None:
+            shim.send_signal(signal.SIGINT)
+            try:
+                shim.wait(5)
+            except subprocess.TimeoutExpired:
+                shim.kill()
+        shim_log.close()
+        server.close()
+    return reasons
+
+
+def parse_args():
+    """Parses command line arguments"""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--no-shim', action='store_true',
+                        help='only check the simulator')
+    parser.add_argument('--shim', help='use this shim-dbg binary instead of '
+                        'building one; it must be built from the '
+                        '--write-config output')
+    parser.add_argument('--write-config', metavar='FILE',
+                        help='write the configuration and exit')
+    parser.add_argument('--config-python', default='python2.7',
+                        help='Python used to run parse_config.py and the '
+                        'simulator (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='per-request timeout in seconds')
+    parser.add_argument('--shim-port', type=int, default=18081)
+    parser.add_argument('--backend-port', type=int, default=18001)
+    parser.add_argument('--keep-work-dir', action='store_true',
+                        help='keep build directory and shim log')
+    return parser.parse_args()
+
+
+def main():
+    """Main driver function"""
+    args = parse_args()
+
+    if args.write_config:
+        with open(args.write_config, 'w') as f:
+            json.dump(CONFIG, f, indent=4, sort_keys=True)
+        return 0
+
+    work_dir = tempfile.mkdtemp(prefix='umbra-policy-sim-')
+    try:
+        config_file = os.path.join(work_dir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(CONFIG, f, indent=4, sort_keys=True)
+        sim_reasons = simulate(args, config_file)
+        shim_reasons = None
+        if not args.no_shim:
+            shim_path = args.shim or build_shim_dbg(args, work_dir)
+            shim_reasons = asyncio.run(replay_shim(args, shim_path, work_dir))
+    except LoadTestError as exc:
+        print('Error: %s' % exc, file=sys.stderr)
+        args.keep_work_dir = True
+        return 2
+    finally:
+        if args.keep_work_dir:
+            print('Work directory: %s' % work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    failures = 0
+    for i, (desc, _, method, target, expected, code_path) in enumerate(CASES):
+        got = [('simulator', sim_reasons[i])]
+        if shim_reasons is not None:
+            got.append(('shim', shim_reasons[i]))
+        bad = ['%s gave %s' % x for x in got if x[1] != expected]
+        failures += bool(bad)
+        print('%-4s %-24s %-6s %-30s %s%s' % (
+            'FAIL' if bad else 'ok', desc, method, target[:30], expected,
+            ' (%s)' % code_path if code_path else ''))
+        for line in bad:
+            print('         %s' % line)
+
+    print('%d cases, %d failed' % (len(CASES), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())